@@ -0,0 +1,114 @@
+'''
+Deterministic generator of logentry-shaped scan logs.
+
+Writes gzip CSVs with the columns load_data() COPYs into logentry (date, ip,
+risk, asn, country). Popularity is Zipf-skewed the way scan results are: a
+few IPs show up in most rows, a few ASNs hold most IPs and a few countries
+hold most ASNs. Every IP belongs to one ASN and every ASN to one country.
+The same arguments always produce the same files.
+'''
+from __future__ import print_function, division
+
+from bisect import bisect
+from os.path import join
+
+import argparse
+import datetime
+import random
+import string
+import gzip
+import csv
+import io
+
+HEADER = ['date', 'ip', 'risk', 'asn', 'country']
+
+
+class Zipf(object):
+    '''
+    Draws 0..n-1 with probability proportional to 1 / (k + 1) ** skew
+    '''
+    def __init__(self, n, skew, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for k in range(n):
+            total += 1.0 / (k + 1) ** skew
+            self.cumulative.append(total)
+        self.total = total
+
+
+    def draw(self):
+        return min(bisect(self.cumulative, self.rng.random() * self.total),
+                   len(self.cumulative) - 1)
+
+
+def country_codes(n):
+    letters = string.ascii_uppercase
+    return [a + b for a in letters for b in letters][:n]
+
+
+def generate(directory, rows=100000, files=4, days=7, ips=20000, asns=2000,
+             countries=100, risks=(1, 2, 4, 5), skew=1.1, seed=0,
+             start=datetime.datetime(2016, 1, 1)):
+    '''
+    Writes `files` gzip CSVs holding `rows` rows in total and returns
+    their names
+    '''
+    rng = random.Random(seed)
+    codes = country_codes(countries)
+    pick_country = Zipf(countries, skew, rng)
+    asn_country = [codes[pick_country.draw()] for _ in range(asns)]
+    pick_asn = Zipf(asns, skew, rng)
+    ip_asn = [pick_asn.draw() for _ in range(ips)]
+    ip_address = []
+    for _ in range(ips):
+        x = rng.getrandbits(32)
+        ip_address.append('{}.{}.{}.{}'.format(x >> 24, (x >> 16) & 255, (x >> 8) & 255, x & 255))
+    pick_ip = Zipf(ips, skew, rng)
+    pick_risk = Zipf(len(risks), skew, rng)
+
+    names = []
+    for i in range(files):
+        name = 'scan-{:04d}.csv.gz'.format(i)
+        names.append(name)
+        count = rows // files + (1 if i < rows % files else 0)
+        with gzip.open(join(directory, name), 'wb') as raw:
+            f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(HEADER)
+            for _ in range(count):
+                ip = pick_ip.draw()
+                asn = ip_asn[ip]
+                date = start + datetime.timedelta(
+                    days=rng.randrange(days), seconds=rng.randrange(86400))
+                writer.writerow([
+                    date.strftime('%Y-%m-%d %H:%M:%S'), ip_address[ip],
+                    risks[pick_risk.draw()], asn + 1, asn_country[asn]
+                ])
+            f.close()
+    return names
+
+
+def add_arguments(parser):
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--ips', type=int, default=20000)
+    parser.add_argument('--asns', type=int, default=2000)
+    parser.add_argument('--countries', type=int, default=100)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def generator_args(args):
+    return dict((key, getattr(args, key)) for key in [
+        'rows', 'files', 'days', 'ips', 'asns', 'countries', 'skew', 'seed'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic scan logs')
+    parser.add_argument('directory')
+    add_arguments(parser)
+    args = parser.parse_args()
+    for name in generate(args.directory, **generator_args(args)):
+        print(join(args.directory, name))
@@ -0,0 +1,196 @@
+'''
+Benchmark harness for the aggregation pipeline.
+
+Generates synthetic scan logs (see generate.py), then runs every stage of
+Aggregator and LoadToRDS against a local Postgres, with file:// paths in
+place of S3 (see storage.py). Redshift-only statements are replaced by their
+Postgres equivalents: the manifest COPY by COPY FROM STDIN of every file,
+UNLOAD by COPY TO STDOUT. Stage timings are appended as one JSON line per run to the
+results file, and compared with the last run of the same size.
+
+    $ python benchmarks/harness.py --rows 1000000 --config tests/config.test.json
+'''
+from __future__ import print_function
+
+from os.path import abspath, dirname, exists, join
+
+import subprocess
+import argparse
+import datetime
+import tempfile
+import logging
+import shutil
+import gzip
+import json
+import sys
+import os
+
+try:
+    from ..main import Aggregator, LoadToRDS, load_config, split_path
+    from ..metrics import RunMetrics
+    from .generate import add_arguments, generate, generator_args
+except (ImportError, SystemError, ValueError):
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    from main import Aggregator, LoadToRDS, load_config, split_path
+    from metrics import RunMetrics
+    from benchmarks.generate import add_arguments, generate, generator_args
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+def load_logs(aggregator):
+    '''
+    Stands in for the Redshift COPY ... MANIFEST of load_data()
+    '''
+    bucket, key = split_path(aggregator.config['dest_path'])
+    manifest = json.loads(aggregator.storage.read(bucket, join(key, 'clean.manifest')).decode())
+    conn = aggregator.connRedshift.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for entry in manifest['entries']:
+            obj = aggregator.storage.get(*split_path(entry['url']))
+            with gzip.GzipFile(fileobj=obj['Body']) as f:
+                cursor.copy_expert('COPY {} FROM STDIN WITH CSV HEADER'.format(
+                    aggregator.load_table('logentry')), f)
+            aggregator.metrics.add('rows', cursor.rowcount)
+            obj['Body'].close()
+        conn.commit()
+    finally:
+        conn.close()
+    aggregator.encode_ips()
+
+
+def unload(aggregator, table):
+    '''
+    Stands in for the Redshift UNLOAD of unload()
+    '''
+    path = join(aggregator.tmpdir, '%s.csv' % table)
+    conn = aggregator.connRedshift.raw_connection()
+    try:
+        with open(path, 'wb') as f:
+            conn.cursor().copy_expert(
+                'COPY (SELECT * FROM {}) TO STDOUT WITH CSV'.format(table), f)
+    finally:
+        conn.close()
+    bucket, key = split_path(aggregator.config['agg_path'])
+    aggregator.storage.upload_file(path, bucket, join(key, '%s.csv' % table))
+
+
+def upload_logs(storage, source, directory, names):
+    bucket, key = split_path(source)
+    storage.upload_many([(join(directory, name), bucket, join(key, name)) for name in names])
+    datapackage = {'name': 'benchmark', 'resources': [
+        {'name': 'scan', 'path': names, 'format': 'csv', 'compression': 'gz'}]}
+    storage.put(bucket, join(key, 'datapackage.json'), json.dumps(datapackage).encode())
+
+
+def stages(aggregator, loader):
+    '''
+    The steps of Aggregator.run() and LoadToRDS.run(), the Redshift-only ones
+    replaced by their Postgres stand-ins
+    '''
+    stand_ins = {
+        'load_data': lambda: load_logs(aggregator),
+        'unload': lambda: unload(aggregator, 'count'),
+        'unload_sketches': lambda: unload(aggregator, 'count_sketch'),
+    }
+    steps = [('aggregate.{}'.format(name), stand_ins.get(name, func))
+             for name, func in aggregator.stages()]
+    steps.extend(('load.{}'.format(name), func) for name, func in loader.stages())
+    return steps
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(results_path, params):
+    previous = None
+    if exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                result = json.loads(line)
+                if result['params'] == params:
+                    previous = result
+    return previous
+
+
+def run(config, params, results_path, workdir=None):
+    '''
+    Runs one benchmark and returns its result
+    '''
+    workdir = tempfile.mkdtemp(dir=workdir)
+    try:
+        source = 'file://' + join(workdir, 'bucket', 'source')
+        config = dict(config, source_path=source, dest_path=source,
+                      agg_path='file://' + join(workdir, 'bucket', 'agg'),
+                      parallel_unload=False, parquet_output=False, incremental=False,
+                      engine='redshift')
+        metrics = RunMetrics()
+        aggregator = Aggregator(config, metrics)
+        loader = LoadToRDS(config, metrics)
+
+        logs = join(workdir, 'logs')
+        os.makedirs(logs)
+        risks = sorted(set(int(risk['id']) for risk in aggregator.risk_data()))
+        with metrics.stage('generate'):
+            names = generate(logs, risks=risks, **params)
+        upload_logs(aggregator.storage, source, logs, names)
+
+        for name, func in stages(aggregator, loader):
+            with metrics.stage(name):
+                func()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    params = dict(params, sketches=config.get('distinct_sketches', False))
+    result = {
+        'commit': git_commit(),
+        'run_at': datetime.datetime.utcnow().isoformat(),
+        'params': params,
+        'stages': [
+            {'name': stage['name'], 'wall_seconds': round(stage['wall_seconds'], 3),
+             'rows': stage['rows']}
+            for stage in metrics.report()['stages']
+        ],
+    }
+    previous = previous_result(results_path, params)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+    return result, previous
+
+
+def report(result, previous):
+    before = {}
+    if previous is not None:
+        before = dict((s['name'], s['wall_seconds']) for s in previous['stages'])
+        print('Compared with {} run at {}'.format(previous['commit'], previous['run_at']))
+    for stage in result['stages']:
+        line = '{:40} {:10.3f}s {:12d} rows'.format(
+            stage['name'], stage['wall_seconds'], stage['rows'])
+        if before.get(stage['name']):
+            line += '  {:+.1f}%'.format(
+                100.0 * (stage['wall_seconds'] - before[stage['name']]) / before[stage['name']])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the aggregation pipeline')
+    parser.add_argument('--config', default=join(ROOT, 'tests', 'config.test.json'))
+    parser.add_argument('--results', default=join(ROOT, 'benchmarks', 'results.jsonl'))
+    parser.add_argument('--workdir', help='where generated logs and fake s3 live')
+    parser.add_argument('--sketches', action='store_true')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    config['distinct_sketches'] = args.sketches
+    report(*run(config, generator_args(args), args.results, args.workdir))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
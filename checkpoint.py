@@ -0,0 +1,98 @@
+'''
+Stage checkpoints for resuming a failed run.
+
+A pipeline is a list of named stages. Every completed stage is recorded in a
+small JSON file together with the inputs of its pipeline and a fingerprint
+chained over the inputs and names of all stages up to it, so a stage is only
+treated as done when everything before it ran with the same inputs.
+
+`run_stages()` runs all stages by default and starts a fresh record. With
+`resume` it skips stages recorded as done, with `from_stage` it skips every
+stage before the named one.
+'''
+from __future__ import print_function
+
+from os.path import dirname, exists
+
+import datetime
+import tempfile
+import hashlib
+import logging
+import json
+import os
+
+
+def chain(fingerprint, name, inputs):
+    '''
+    Fingerprint of a stage given the fingerprint of the stage before it
+    '''
+    sha = hashlib.sha256(fingerprint.encode())
+    sha.update(name.encode())
+    sha.update(json.dumps(inputs, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+class CheckpointStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if exists(path):
+            with open(path) as f:
+                self.stages = json.load(f)
+
+
+    def is_done(self, stage, fingerprint):
+        return self.stages.get(stage, {}).get('fingerprint') == fingerprint
+
+
+    def mark_done(self, stage, fingerprint, inputs):
+        self.stages[stage] = {
+            'fingerprint': fingerprint,
+            'inputs': inputs,
+            'completed_at': datetime.datetime.utcnow().isoformat(),
+        }
+        self.save()
+
+
+    def clear(self):
+        self.stages = {}
+        self.save()
+
+
+    def save(self):
+        # write then rename, a crash never leaves a truncated file behind
+        fd, tmp = tempfile.mkstemp(dir=dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def run_stages(pipelines, store, resume=False, from_stage=None):
+    '''
+    Runs (prefix, inputs, [(name, func), ...]) pipelines in order. Stages are
+    recorded as `<prefix>.<name>`.
+    '''
+    names = ['{}.{}'.format(prefix, name)
+             for prefix, _, stages in pipelines for name, _ in stages]
+    if from_stage is not None and from_stage not in names:
+        raise ValueError('Unknown stage {}, expected one of: {}'.format(
+            from_stage, ', '.join(names)))
+    if not resume and from_stage is None:
+        store.clear()
+    skipping = from_stage is not None
+    fingerprint = ''
+    for prefix, inputs, stages in pipelines:
+        for name, func in stages:
+            stage = '{}.{}'.format(prefix, name)
+            fingerprint = chain(fingerprint, stage, inputs)
+            if stage == from_stage:
+                skipping = False
+            if skipping:
+                logging.info('Skipping {}, before {}'.format(stage, from_stage))
+                continue
+            if resume and store.is_done(stage, fingerprint):
+                logging.info('Skipping {}, already done'.format(stage))
+                continue
+            logging.info('Running {}'.format(stage))
+            func()
+            store.mark_done(stage, fingerprint, inputs)
@@ -0,0 +1,82 @@
+'''
+Parquet copy of the count table.
+
+Converts a count CSV, in the layout unload() writes, into a Parquet dataset
+partitioned by day (`date=YYYY-MM-DD/`), the same layout the Redshift
+`UNLOAD ... FORMAT AS PARQUET PARTITION BY (date)` produces. The CSV is read in
+blocks, so memory does not grow with its size. Needs pyarrow.
+
+    $ python columnar.py count.csv count-parquet/
+'''
+from __future__ import print_function
+
+import argparse
+import os
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ['date', 'risk', 'country', 'asn', 'count', 'count_amplified']
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def schema():
+    return pyarrow.schema([
+        ('date', pyarrow.date32()),
+        ('risk', pyarrow.int32()),
+        ('country', pyarrow.string()),
+        ('asn', pyarrow.int64()),
+        ('count', pyarrow.int64()),
+        ('count_amplified', pyarrow.float64()),
+    ])
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError('Parquet output needs pyarrow, pip install pyarrow')
+
+
+def count_batches(path, block_size=BLOCK_SIZE):
+    '''
+    Yields record batches of a count CSV with the columns typed
+    '''
+    target = schema()
+    column_types = dict((field.name, field.type) for field in target)
+    # dates are written as timestamps at midnight
+    column_types['date'] = pyarrow.timestamp('s')
+    reader = pyarrow.csv.open_csv(
+        path,
+        read_options=pyarrow.csv.ReadOptions(column_names=COLUMNS, block_size=block_size),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=True))
+    for batch in reader:
+        columns = [batch.column(0).cast(pyarrow.date32())] + batch.columns[1:]
+        yield pyarrow.RecordBatch.from_arrays(columns, schema=target)
+
+
+def write_count_parquet(csv_path, directory, block_size=BLOCK_SIZE):
+    '''
+    Writes csv_path as a Parquet dataset partitioned by date to directory and
+    returns the paths of the files written
+    '''
+    require_pyarrow()
+    written = []
+    pyarrow.dataset.write_dataset(
+        count_batches(csv_path, block_size), directory, schema=schema(),
+        format='parquet', partitioning=['date'], partitioning_flavor='hive',
+        existing_data_behavior='overwrite_or_ignore',
+        file_visitor=lambda f: written.append(f.path))
+    return sorted(written)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert count.csv to Parquet')
+    parser.add_argument('csv')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    for path in write_count_parquet(args.csv, args.directory):
+        print(os.path.relpath(path, args.directory))
@@ -0,0 +1,85 @@
+'''
+Static JSON export of the cube time series.
+
+Every cube is rendered as one document per country, holding a series per
+risk, and one per risk, holding a series per country. Documents are gzip
+compressed and stored under a key carrying the hash of their content, so they
+can be cached forever. index.json maps document names like
+`month/country/AA` to their current key and is the only object that changes
+between runs.
+
+Documents dropped from index.json are listed in retired.json with the time they
+were dropped, and deleted once a grace period has passed, so clients holding
+an older index can still fetch them.
+'''
+from __future__ import print_function
+
+from io import BytesIO
+
+import hashlib
+import gzip
+import json
+
+# columns of every series point
+FIELDS = ['date', 'count', 'count_amplified', 'count_distinct']
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+INDEX_CACHE_CONTROL = 'public, max-age=300'
+RETIRED = 'retired.json'
+# seconds a document outlives the last index.json pointing at it
+DEFAULT_GRACE = 24 * 3600
+
+
+def build_documents(granularity, rows):
+    '''
+    Returns {name: document} for (date, risk, country, count,
+    count_amplified, count_distinct) rows ordered by date
+    '''
+    countries = {}
+    risks = {}
+    for date, risk, country, count, amplified, distinct in rows:
+        point = [date.isoformat(), count, amplified, distinct]
+        countries.setdefault(country, {}).setdefault(str(risk), []).append(point)
+        risks.setdefault(risk, {}).setdefault(country, []).append(point)
+    documents = {}
+    for country, series in countries.items():
+        documents['{}/country/{}'.format(granularity, country)] = {
+            'granularity': granularity, 'country': country,
+            'fields': FIELDS, 'series': series}
+    for risk, series in risks.items():
+        documents['{}/risk/{}'.format(granularity, risk)] = {
+            'granularity': granularity, 'risk': risk,
+            'fields': FIELDS, 'series': series}
+    return documents
+
+
+def render(document):
+    '''
+    Compact gzip compressed JSON. The same document always gives the same
+    bytes, the gzip header carries no timestamp.
+    '''
+    body = json.dumps(document, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+def content_key(name, body):
+    return '{}.{}.json.gz'.format(name, hashlib.sha256(body).hexdigest()[:16])
+
+
+def prune(documents, current, retired, now, grace):
+    '''
+    Returns ({key: retired since}, expired keys) for the document keys found
+    in storage. Keys not in current are retired at now unless they already
+    were, and expire grace seconds later.
+    '''
+    retired = dict((key, since) for key, since in retired.items()
+                   if key in documents and key not in current)
+    for key in documents:
+        if key not in current:
+            retired.setdefault(key, now)
+    expired = sorted(key for key, since in retired.items() if now - since >= grace)
+    for key in expired:
+        del retired[key]
+    return retired, expired
@@ -0,0 +1,259 @@
+'''
+Compact in-memory store of count / fact_count rows.
+
+Rows are kept as typed column arrays instead of tuples: dates as day
+ordinals, risk as a small int, country and ASN as codes into a dictionary of
+their distinct values, count as a 32 bit int like the count table and
+count_amplified as a double. That is 24 bytes per row, where a row tuple with
+its objects takes a few hundred.
+
+`select()` filters rows, `group_by()` sums them per key and `cube()` gives the
+rows of agg_risk_country_<time> as populate_tables() builds them.
+
+    store = FactStore.from_csv(open('count.csv'))
+    store.group_by(['country'], selection=store.select(risk=1))
+'''
+from __future__ import print_function
+
+from array import array
+
+import datetime
+import csv
+
+TIME_GRANULARITIES = ['day', 'week', 'month', 'quarter', 'year']
+KEYS = ['date', 'risk', 'country', 'asn']
+# risk is stored as a signed short, NULL as -1
+NULL_RISK = -1
+
+
+def truncate(ordinal, time):
+    '''
+    date_trunc(time, date) on a day ordinal
+    '''
+    if time == 'day':
+        return ordinal
+    if time == 'week':
+        # day 1 was a Monday
+        return ordinal - (ordinal - 1) % 7
+    date = datetime.date.fromordinal(ordinal)
+    if time == 'month':
+        return date.replace(day=1).toordinal()
+    if time == 'quarter':
+        return datetime.date(date.year, 3 * ((date.month - 1) // 3) + 1, 1).toordinal()
+    if time == 'year':
+        return datetime.date(date.year, 1, 1).toordinal()
+    raise ValueError('Unknown time granularity {}'.format(time))
+
+
+def parse_date(value):
+    '''
+    Day ordinal of a '2016-09-03' or '2016-09-03 00:00:00' string
+    '''
+    return datetime.date(int(value[:4]), int(value[5:7]), int(value[8:10])).toordinal()
+
+
+class Dictionary(object):
+    '''
+    Codes 0..n-1 for the distinct values of a column, in order of appearance
+    '''
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+    def decode(self, code):
+        return self.values[code]
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+class FactStore(object):
+    def __init__(self):
+        self.dates = array('i')
+        self.risks = array('h')
+        self.countries = array('H')
+        self.asns = array('I')
+        self.counts = array('i')
+        self.amplified = array('d')
+        self.country_values = Dictionary()
+        self.asn_values = Dictionary()
+        # day strings seen by from_csv, there are few of them
+        self.date_cache = {}
+
+
+    @classmethod
+    def from_csv(cls, fileobj):
+        '''
+        Loads a CSV in the layout unload() writes, NULL as empty
+        '''
+        store = cls()
+        for date, risk, country, asn, count, amplified in csv.reader(fileobj):
+            ordinal = store.date_cache.get(date[:10])
+            if ordinal is None:
+                ordinal = store.date_cache[date[:10]] = parse_date(date)
+            store.append_encoded(
+                ordinal, int(risk) if risk else None, country or None,
+                int(asn) if asn else None, int(count or 0), float(amplified or 0))
+        return store
+
+
+    @classmethod
+    def from_table(cls, conn, table='fact_count'):
+        store = cls()
+        store.extend(conn.execute(
+            'SELECT date, risk, country, asn, count, count_amplified FROM {}'.format(table)))
+        return store
+
+
+    def append(self, date, risk, country, asn, count, amplified):
+        self.append_encoded(
+            date.toordinal(), risk, country, asn, count or 0, amplified or 0)
+
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(*row)
+
+
+    def append_encoded(self, ordinal, risk, country, asn, count, amplified):
+        self.dates.append(ordinal)
+        self.risks.append(NULL_RISK if risk is None else risk)
+        self.countries.append(self.country_values.encode(country))
+        self.asns.append(self.asn_values.encode(asn))
+        self.counts.append(count)
+        self.amplified.append(amplified)
+
+
+    def __len__(self):
+        return len(self.dates)
+
+
+    def memory_bytes(self):
+        '''
+        Bytes held by the column arrays
+        '''
+        return sum(column.itemsize * len(column) for column in [
+            self.dates, self.risks, self.countries, self.asns, self.counts, self.amplified])
+
+
+    def row(self, i):
+        risk = self.risks[i]
+        return (datetime.date.fromordinal(self.dates[i]),
+                None if risk == NULL_RISK else risk,
+                self.country_values.decode(self.countries[i]),
+                self.asn_values.decode(self.asns[i]),
+                self.counts[i], self.amplified[i])
+
+
+    def rows(self, selection=None):
+        for i in (range(len(self)) if selection is None else selection):
+            yield self.row(i)
+
+
+    def select(self, date_from=None, date_to=None, risk=None, country=None, asn=None):
+        '''
+        Returns the indexes of rows with date_from <= date < date_to and the
+        given risk, country and asn. Each of those can also be a list of values.
+        '''
+        tests = []
+        if date_from is not None:
+            start = date_from.toordinal()
+            tests.append((self.dates, lambda value: value >= start))
+        if date_to is not None:
+            end = date_to.toordinal()
+            tests.append((self.dates, lambda value: value < end))
+        for column, values, encode in [
+                (self.risks, risk, lambda v: NULL_RISK if v is None else v),
+                (self.countries, country, self.country_values.codes.get),
+                (self.asns, asn, self.asn_values.codes.get)]:
+            if values is None:
+                continue
+            if not isinstance(values, (list, tuple, set, frozenset)):
+                values = [values]
+            codes = frozenset(encode(value) for value in values)
+            tests.append((column, codes.__contains__))
+        selection = array('l')
+        for i in range(len(self)):
+            if all(test(column[i]) for column, test in tests):
+                selection.append(i)
+        return selection
+
+
+    def key_columns(self, keys, time):
+        '''
+        Returns (column, decode) per key, dates truncated to time
+        '''
+        columns = []
+        for key in keys:
+            if key == 'date':
+                truncated = {}
+                for ordinal in set(self.dates):
+                    truncated[ordinal] = truncate(ordinal, time)
+                columns.append((
+                    array('i', (truncated[ordinal] for ordinal in self.dates)),
+                    datetime.date.fromordinal))
+            elif key == 'risk':
+                columns.append((self.risks, lambda v: None if v == NULL_RISK else v))
+            elif key == 'country':
+                columns.append((self.countries, self.country_values.decode))
+            elif key == 'asn':
+                columns.append((self.asns, self.asn_values.decode))
+            else:
+                raise ValueError('Unknown key {}, one of {}'.format(key, KEYS))
+        return columns
+
+
+    def group_by(self, keys, time='day', selection=None):
+        '''
+        Returns {key tuple: (count, count_amplified)} summed over the
+        selected rows
+        '''
+        columns = self.key_columns(keys, time)
+        sums = {}
+        for i in (range(len(self)) if selection is None else selection):
+            key = tuple(column[i] for column, _ in columns)
+            total = sums.get(key)
+            if total is None:
+                total = sums[key] = [0, 0.0]
+            total[0] += self.counts[i]
+            total[1] += self.amplified[i]
+        return dict(
+            (tuple(decode(value) for (_, decode), value in zip(columns, key)), tuple(total))
+            for key, total in sums.items())
+
+
+    def cube(self, time, selection=None):
+        '''
+        Returns the (date, risk, country, count, count_amplified) rows of
+        agg_risk_country_<time>: every combination of date, risk and country
+        rolled up, with risk 100, country 'T' and date NULL for all. Like
+        populate_tables(), fact rows with a NULL risk or country are not
+        merged into the rollup rows.
+        '''
+        base = self.group_by(['date', 'risk', 'country'], time, selection)
+        sums = {}
+        for (date, risk, country), (count, amplified) in base.items():
+            for rolled in range(8):
+                key = (None if rolled & 4 else date,
+                       bool(rolled & 2), bool(rolled & 1),
+                       100 if rolled & 2 or risk is None else risk,
+                       'T' if rolled & 1 or country is None else country)
+                total = sums.get(key)
+                if total is None:
+                    total = sums[key] = [0, 0.0]
+                total[0] += count
+                total[1] += amplified
+        rows = [(date, risk, country, total[0], total[1])
+                for (date, _, _, risk, country), total in sums.items()]
+        rows.sort(key=lambda row: (row[0] is None, row[0], row[1], row[2], row[3], row[4]))
+        return rows
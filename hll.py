@@ -0,0 +1,141 @@
+'''
+HyperLogLog sketches for distinct IP counts.
+
+Sketches are kept as sparse registers, one (reg, rank) row per non-empty
+register, next to the (date, risk, country, asn) key they belong to. Merging
+sketches is then a plain `GROUP BY ..., reg` with `MAX(rank)`, which Redshift
+and Postgres both run natively, and the estimate is a single aggregate.
+
+The register of a value is taken from its MD5 digest: the first three hex
+digits give the register index, the next 13 give the rank. `register()` and
+`register_sql()` are the Python and SQL forms of the same function, so sketches
+built in Redshift, in RDS and by local_engine.py can be merged with each other.
+'''
+from __future__ import division
+
+import hashlib
+import math
+
+# 3 hex digits of the digest address at most 2^12 registers
+MAX_PRECISION = 12
+DEFAULT_PRECISION = 12
+# hex digits used for the rank, i.e. 52 bits
+RANK_DIGITS = 13
+HEX = '0123456789abcdef'
+
+
+def alpha(m):
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+def register(value, precision=DEFAULT_PRECISION):
+    '''
+    Returns (register index, rank) for the given string
+    '''
+    digest = hashlib.md5(value.encode('utf-8')).hexdigest()
+    index = int(digest[:3], 16) % (1 << precision)
+    rest = digest[3:3 + RANK_DIGITS]
+    stripped = rest.lstrip('0')
+    if not stripped:
+        return index, RANK_DIGITS * 4 + 1
+    zeros = (len(rest) - len(stripped)) * 4 + 4 - int(stripped[0], 16).bit_length()
+    return index, zeros + 1
+
+
+def hash_sql(column, digits):
+    '''
+    Returns an SQL expression for the integer of the first `digits` hex digits
+    of the MD5 digest of a text column, with functions common to Redshift and
+    Postgres
+    '''
+    digest = 'MD5({})'.format(column)
+    value = '0'
+    for i in range(1, digits + 1):
+        value = "({} * 16 + POSITION(SUBSTRING({}, {}, 1) IN '{}') - 1)".format(
+            value, digest, i, HEX)
+    return value
+
+
+def register_sql(column, precision=DEFAULT_PRECISION):
+    '''
+    Returns SQL expressions (reg, rank) computing register() for a text column.
+    Only uses functions common to Redshift and Postgres.
+    '''
+    digest = 'MD5({})'.format(column)
+    reg = 'MOD({}, {})'.format(hash_sql(column, 3), 1 << precision)
+    rest = 'SUBSTRING({}, 4, {})'.format(digest, RANK_DIGITS)
+    stripped = "LTRIM({}, '0')".format(rest)
+    first = "(POSITION(SUBSTRING({}, 1, 1) IN '{}') - 1)".format(stripped, HEX)
+    rank = (
+        '(CASE WHEN LENGTH({stripped}) = 0 THEN {max_rank} '
+        'ELSE ({digits} - LENGTH({stripped})) * 4 + '
+        'CASE WHEN {first} >= 8 THEN 1 WHEN {first} >= 4 THEN 2 '
+        'WHEN {first} >= 2 THEN 3 ELSE 4 END END)'
+    ).format(stripped=stripped, max_rank=RANK_DIGITS * 4 + 1,
+             digits=RANK_DIGITS, first=first)
+    return reg, rank
+
+
+def estimate(registers, precision=DEFAULT_PRECISION):
+    '''
+    Cardinality estimate from a {reg: rank} mapping
+    '''
+    m = 1 << precision
+    zeros = m - len(registers)
+    raw = alpha(m) * m * m / (sum(2.0 ** -r for r in registers.values()) + zeros)
+    if raw <= 2.5 * m and zeros > 0:
+        return m * math.log(m / zeros)
+    return raw
+
+
+def estimate_sql(rank='rank', precision=DEFAULT_PRECISION):
+    '''
+    SQL aggregate computing estimate() over rows holding one register each
+    '''
+    m = 1 << precision
+    raw = '({alpha!r} * {m} * {m} / (SUM(POWER(CAST(2 AS FLOAT), -{rank})) + {m} - COUNT(*)))'.format(
+        alpha=alpha(m), m=m, rank=rank)
+    return (
+        'CAST(ROUND(CASE WHEN {raw} <= {limit} AND COUNT(*) < {m} '
+        'THEN {m} * LN({m}.0 / ({m} - COUNT(*))) ELSE {raw} END) AS BIGINT)'
+    ).format(raw=raw, limit=2.5 * m, m=m)
+
+
+class Sketch(object):
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= MAX_PRECISION:
+            raise ValueError('precision must be between 4 and {}'.format(MAX_PRECISION))
+        self.precision = precision
+        self.registers = dict(registers or {})
+
+
+    def add(self, value):
+        index, rank = register(value, self.precision)
+        if rank > self.registers.get(index, 0):
+            self.registers[index] = rank
+
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precision')
+        for index, rank in other.registers.items():
+            if rank > self.registers.get(index, 0):
+                self.registers[index] = rank
+        return self
+
+
+    def cardinality(self):
+        return int(round(estimate(self.registers, self.precision)))
+
@@ -0,0 +1,215 @@
+'''
+Pure-Python counterpart of the Redshift aggregation stage.
+
+Streams logentry-shaped gzip CSVs (date, ip, risk, asn, country), counts
+distinct IPs per (day, risk, country, asn), applies the country count threshold
+and the dim_risk amplification factors and writes rows in the layout `unload()`
+produces for the count table.
+
+With a sketch precision set, the HyperLogLog registers of every count row are
+written too, in the layout of the count_sketch table (see hll.py).
+
+Distinct keys are held in memory up to `max_keys` (day, risk, country, asn, ip)
+entries. Beyond that they are spilled to hash partitions on disk which are
+then aggregated one at a time. A partition holding more than `max_keys` entries
+is split again with a different hash before it is read, so every partition
+loaded fits the budget. The one exception is a single (day, risk, country, asn)
+group with more distinct IPs than `max_keys`, which cannot be split by key and
+is read whole once `max_depth` splits are reached.
+'''
+from __future__ import print_function
+
+import logging
+import tempfile
+import shutil
+import gzip
+import csv
+import io
+import os
+
+try:
+    from . import hll
+except (ImportError, SystemError, ValueError):
+    import hll
+
+
+def iter_log_rows(fileobj, header=True):
+    '''
+    Yields rows of a gzip compressed logentry CSV read from a binary stream
+    '''
+    text = io.TextIOWrapper(gzip.GzipFile(fileobj=fileobj, mode='rb'),
+                            encoding='utf-8', newline='')
+    reader = csv.reader(text)
+    if header:
+        next(reader, None)
+    for row in reader:
+        if row:
+            yield row
+
+
+class LocalAggregator(object):
+    def __init__(self, threshold=0, amplification=None, max_keys=5000000,
+                 partitions=64, tmpdir=None, sketch_precision=None, max_depth=4):
+        self.threshold = threshold
+        # risk id -> amplification factor (None for NULL), same role as dim_risk
+        self.amplification = amplification or {}
+        self.max_keys = max_keys
+        self.partitions = partitions
+        self.max_depth = max_depth
+        self.sketch_precision = sketch_precision
+        self.tmpdir = tempfile.mkdtemp(dir=tmpdir)
+        self.groups = {}
+        self.size = 0
+        self.spill_files = None
+        self.spill_rows = None
+
+
+    def add_file(self, fileobj, header=True):
+        self.add_rows(iter_log_rows(fileobj, header))
+
+
+    def add_rows(self, rows):
+        for date, ip, risk, asn, country in rows:
+            # date_trunc('day', date)
+            key = (date[:10], risk, country, asn)
+            ips = self.groups.get(key)
+            if ips is None:
+                ips = self.groups[key] = set()
+            if ip not in ips:
+                ips.add(ip)
+                self.size += 1
+                if self.size > self.max_keys:
+                    self.spill()
+
+
+    def spill(self):
+        '''
+        Moves the in-memory distinct keys into on-disk hash partitions
+        '''
+        if self.spill_files is None:
+            logging.info('Distinct keys exceed {}, spilling to {}'.format(
+                self.max_keys, self.tmpdir))
+            self.spill_files = [
+                open(os.path.join(self.tmpdir, 'part{}.csv'.format(i)), 'w', newline='')
+                for i in range(self.partitions)
+            ]
+            self.spill_rows = [0] * self.partitions
+        writers = [csv.writer(f) for f in self.spill_files]
+        for key, ips in self.groups.items():
+            i = hash(key) % self.partitions
+            for ip in ips:
+                writers[i].writerow(key + (ip,))
+            self.spill_rows[i] += len(ips)
+        self.groups = {}
+        self.size = 0
+
+
+    def iter_partitions(self):
+        if self.spill_files is None:
+            yield self.groups
+            return
+        self.spill()
+        for f in self.spill_files:
+            f.close()
+        self.spill_files = None
+        for i in range(self.partitions):
+            path = os.path.join(self.tmpdir, 'part{}.csv'.format(i))
+            for groups in self.read_partition(path, self.spill_rows[i]):
+                yield groups
+
+
+    def read_partition(self, path, rows, depth=0):
+        '''
+        Yields the groups of a spilled partition, splitting it into smaller
+        partitions first while it holds more than max_keys entries
+        '''
+        if rows <= self.max_keys or depth >= self.max_depth:
+            groups = {}
+            with open(path, newline='') as f:
+                for date, risk, country, asn, ip in csv.reader(f):
+                    groups.setdefault((date, risk, country, asn), set()).add(ip)
+            os.remove(path)
+            yield groups
+            return
+        logging.info('Partition {} holds {} entries, splitting it'.format(path, rows))
+        paths = ['{}.{}'.format(path, i) for i in range(self.partitions)]
+        counts = [0] * self.partitions
+        files = [open(p, 'w', newline='') for p in paths]
+        writers = [csv.writer(f) for f in files]
+        with open(path, newline='') as f:
+            for row in csv.reader(f):
+                # the next digits of the key hash, those above picked this partition
+                i = hash(tuple(row[:4])) // self.partitions ** (depth + 1) % self.partitions
+                writers[i].writerow(row)
+                counts[i] += 1
+        for f in files:
+            f.close()
+        os.remove(path)
+        for sub_path, sub_rows in zip(paths, counts):
+            for groups in self.read_partition(sub_path, sub_rows, depth + 1):
+                yield groups
+
+
+    def iter_groups(self):
+        '''
+        Yields ((date, risk, country, asn), ips) for groups above the threshold
+        '''
+        for groups in self.iter_partitions():
+            for key, ips in groups.items():
+                if len(ips) > self.threshold:
+                    yield key, ips
+
+
+    def count_row(self, key, ips):
+        date, risk, country, asn = key
+        count = len(ips)
+        # CASE WHEN r.id IS NULL THEN 0 ELSE count * r.amplification_factor END
+        risk_id = int(risk) if risk else None
+        if risk_id not in self.amplification:
+            amplified = 0.0
+        elif self.amplification[risk_id] is None:
+            amplified = None
+        else:
+            amplified = count * self.amplification[risk_id]
+        return ('{} 00:00:00'.format(date), risk, country, asn, count, amplified)
+
+
+    def sketch_rows(self, key, ips):
+        sketch = hll.Sketch(self.sketch_precision).update(ips)
+        date = '{} 00:00:00'.format(key[0])
+        for reg, rank in sorted(sketch.registers.items()):
+            yield (date,) + key[1:] + (reg, rank)
+
+
+    def counts(self):
+        '''
+        Yields (date, risk, country, asn, count, count_amplified) rows
+        '''
+        for key, ips in self.iter_groups():
+            yield self.count_row(key, ips)
+
+
+    def write_csv(self, fileobj, sketch_fileobj=None):
+        '''
+        Writes counts as comma delimited text without header, like UNLOAD does.
+        Sketch registers go to sketch_fileobj when given.
+        '''
+        writer = csv.writer(fileobj, lineterminator='\n')
+        sketch_writer = None
+        if sketch_fileobj is not None:
+            sketch_writer = csv.writer(sketch_fileobj, lineterminator='\n')
+        rows = 0
+        for key, ips in self.iter_groups():
+            writer.writerow(self.count_row(key, ips))
+            if sketch_writer is not None:
+                sketch_writer.writerows(self.sketch_rows(key, ips))
+            rows += 1
+        logging.info('{} count rows written'.format(rows))
+        return rows
+
+
+    def close(self):
+        if self.spill_files is not None:
+            for f in self.spill_files:
+                f.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
@@ -1,27 +1,84 @@
 from __future__ import print_function
 
-from datapackage import push_datapackage
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from psycopg2.extensions import AsIs
-from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy import create_engine, event
 from os.path import dirname, join
 from string import Template
 from textwrap import dedent
 
+import argparse
+import hashlib
 import logging
-import datapackage
+import datetime
+import heapq
+import re
 import tempfile
 import shutil
-import requests
-import boto3
 import json
+import time
 import csv
 import os
 
+try:
+    from .local_engine import LocalAggregator
+    from .checkpoint import CheckpointStore, run_stages
+    from .factstore import truncate
+    from .metrics import RunMetrics
+    from . import columnar
+    from . import refdata
+    from . import export
+    from .storage import LocalStorage
+    from . import s3io
+    from . import hll
+except (ImportError, SystemError, ValueError):
+    from local_engine import LocalAggregator
+    from checkpoint import CheckpointStore, run_stages
+    from factstore import truncate
+    from metrics import RunMetrics
+    import columnar
+    import refdata
+    import export
+    from storage import LocalStorage
+    import s3io
+    import hll
+
 #utils
 def rpath(*args):
     return join(dirname(__file__), *args)
 
 
+NAMESPACE_PATTERN = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+def get_namespace(config):
+    '''
+    Schema holding the working tables of a feed, None for the default schema.
+    Feeds with their own namespace can run at the same time against the same
+    databases, see run_feeds().
+    '''
+    namespace = config.get('namespace')
+    if namespace is not None and not NAMESPACE_PATTERN.match(namespace):
+        raise ValueError('namespace must be a lower case identifier, not {!r}'.format(namespace))
+    return namespace
+
+
+def set_search_path(engine, schema):
+    '''
+    Makes every connection of engine create and find tables in schema. Works
+    on Redshift, which takes no options at connect.
+    '''
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET search_path TO {}'.format(schema))
+        cursor.close()
+        dbapi_connection.commit()
+    return engine
+
+
 def load_config(config_path):
     '''
     Load the regular config file
@@ -50,40 +107,292 @@ def split_s3_path(s3_address):
     return (s3_bucket, s3_path)
 
 
+def is_local_path(str):
+    return str.startswith("file://")
+
+
+def split_path(address):
+    '''
+    (bucket, key) of an s3:// address, ('', path) of a file:// one
+    '''
+    if is_local_path(address):
+        return ('', address[len("file://"):])
+    return split_s3_path(address)
+
+
+def get_storage(config, metrics):
+    '''
+    LocalStorage when the pipeline paths are file:// URIs, S3 otherwise
+    '''
+    paths = [config.get(name) for name in ['source_path', 'dest_path', 'agg_path']]
+    local = [is_local_path(path) for path in paths if path]
+    if any(local) and not all(local):
+        raise ValueError('source_path, dest_path and agg_path must all be s3:// or all file://')
+    if local and all(local):
+        return LocalStorage(config, metrics)
+    return s3io.S3IO(config, metrics)
+
+
+# bytes handed to COPY per read when streaming into RDS
+COPY_BUFFER_SIZE = 64 * 1024
+
+# days touched by the files loaded in the current incremental run
+NEW_DAYS = "SELECT DISTINCT date_trunc('day', date) FROM logentry_stage"
+
+TIME_GRANULARITIES = ['week', 'month', 'quarter', 'year']
+
+# Physical layout of logentry, overridden by the logentry_layout config.
+# With "int" ip_encoding IPv4 addresses are kept as a 32 bit integer shifted
+# by -2^31 in ip4, anything else as text in ip6. ip_key is never NULL: ip4, or
+# a hash of ip6. Distributing on it keeps the DISTINCT of aggregate() on one
+# slice per IP without piling the IPv6 rows, whose ip4 is NULL, on one slice.
+# distkey, sortkey and encode only apply on Redshift.
+LOGENTRY_LAYOUT = {
+    'ip_encoding': 'int',
+    'distkey': 'ip',
+    'sortkey': ['date', 'risk', 'asn', 'country'],
+    'encode': {
+        'date': 'raw', 'ip4': 'az64', 'ip6': 'zstd', 'ip_key': 'az64', 'ip': 'zstd',
+        'risk': 'bytedict', 'asn': 'az64', 'country': 'bytedict'
+    },
+}
+IP_ENCODINGS = ['int', 'text']
+IPV4_OCTET = '(25[0-5]|2[0-4][0-9]|[01]?[0-9]?[0-9])'
+IPV4_PATTERN = '^' + '[.]'.join([IPV4_OCTET] * 4) + '$'
+IPV4_TO_INT = (
+    "(SPLIT_PART(ip, '.', 1)::BIGINT * 16777216 + SPLIT_PART(ip, '.', 2)::BIGINT * 65536"
+    " + SPLIT_PART(ip, '.', 3)::BIGINT * 256 + SPLIT_PART(ip, '.', 4)::BIGINT - 2147483648)::INT")
+# the dotted text of ip4, for hashes that must match the local engine
+IPV4_UNSIGNED = '(ip4::BIGINT + 2147483648)'
+IP_TEXT = (
+    "COALESCE(ip6, CAST({u} / 16777216 AS VARCHAR) || '.' || "
+    "CAST(MOD({u} / 65536, 256) AS VARCHAR) || '.' || "
+    "CAST(MOD({u} / 256, 256) AS VARCHAR) || '.' || CAST(MOD({u}, 256) AS VARCHAR))"
+).format(u=IPV4_UNSIGNED)
+# 7 hex digits of MD5 fit an INTEGER
+IP_HASH = hll.hash_sql('ip', 7)
+
+# partition_by values supported for fact_count and the cubes
+PARTITION_UNITS = ['month', 'year']
+
+# (table, index, columns) of the RDS tables, {time} expands over the cubes.
+# Indexes whose columns lead another index of the table are pruned, see
+# redundant_indexes().
+INDEX_SPEC = [
+    # Index to speedup /api/v1/count
+    ('fact_count', 'idx_date_country', 'date DESC, country'),
+    ('fact_count', 'idx_all', 'date, country, risk, asn'),
+    ('fact_count', 'idx_all_desc', 'date DESC, country, risk, asn'),
+    ('fact_count', 'idx_risk', 'risk'),
+    ('fact_count', 'idx_asn', 'asn'),
+    ('fact_count', 'idx_country', 'country'),
+    ('fact_count', 'idx_date', 'date'),
+    ('agg_risk_country_{time}', 'idx_all_cube_{time}', 'date, country, risk'),
+    ('agg_risk_country_{time}', 'idx_all_desc_cube_{time}', 'date DESC, country, risk'),
+    ('agg_risk_country_{time}', 'idx_risk_cube_{time}', 'risk'),
+    ('agg_risk_country_{time}', 'idx_country_cube_{time}', 'country'),
+    ('agg_risk_country_{time}', 'idx_date_cube_{time}', 'date'),
+]
+
+# (table, constraint, definition)
+PRIMARY_KEY_SPEC = [
+    ('dim_risk', 'dim_risk_pkey', 'PRIMARY KEY (id)'),
+    ('dim_country', 'dim_country_pkey', 'PRIMARY KEY (id)'),
+    ('dim_asn', 'dim_asn_pkey', 'PRIMARY KEY (number)'),
+    ('dim_date', 'dim_date_pkey', 'PRIMARY KEY (date)'),
+]
+FOREIGN_KEY_SPEC = [
+    ('dim_asn', 'fk_country_asn', 'FOREIGN KEY (country) REFERENCES dim_country(id)'),
+    ('fact_count', 'fk_count_risk', 'FOREIGN KEY (risk) REFERENCES dim_risk(id)'),
+    ('fact_count', 'fk_count_country', 'FOREIGN KEY (country) REFERENCES dim_country(id)'),
+    ('fact_count', 'fk_count_asn', 'FOREIGN KEY (asn) REFERENCES dim_asn(number)'),
+    ('fact_count', 'fk_count_time', 'FOREIGN KEY (date) REFERENCES dim_date(date)'),
+    ('agg_risk_country_{time}', 'fk_cube_risk_{time}', 'FOREIGN KEY (risk) REFERENCES dim_risk(id)'),
+    ('agg_risk_country_{time}', 'fk_cube_country_{time}', 'FOREIGN KEY (country) REFERENCES dim_country(id)'),
+]
+
+
 class Aggregator(object):
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
         self.config = config
         self.tmpdir = tempfile.mkdtemp()
-        self.connRedshift = create_engine(
-            config.get('redshift_uri'),
-            isolation_level='AUTOCOMMIT'
-        )
-        self.conns3 = boto3.resource(
-            's3'
-        )
+        # shared with LoadToRDS for one run report, see metrics.py
+        self.metrics = metrics or RunMetrics()
+        # "redshift" or "local", see local_engine.py
+        self.engine = config.get('engine', 'redshift')
+        self.connRedshift = None
+        # schema of the working tables, see get_namespace()
+        self.namespace = get_namespace(config)
+        if self.engine == 'redshift':
+            self.connRedshift = self.metrics.instrument_engine(create_engine(
+                config.get('redshift_uri'),
+                isolation_level='AUTOCOMMIT'
+            ))
+            if self.namespace:
+                set_search_path(self.connRedshift, self.namespace)
+        self.storage = get_storage(config, self.metrics)
         # only include country risk data for those with at least this many
         # results
         self.country_count_threshold = (
             self.config.get("country_count_threshold", 100))
         logging.info("Using country count threshold: {}".format(
             self.country_count_threshold))
+        # HyperLogLog registers per count row, see hll.py
+        self.sketches = self.config.get('distinct_sketches', False)
+        self.sketch_precision = self.config.get(
+            'sketch_precision', hll.DEFAULT_PRECISION)
+        self.refdata_cache = refdata.get_cache(config.get('refdata_cache_dir'))
+        self.layout = logentry_layout(config)
+        self.redshift = None
+        # Parquet copy of count partitioned by day, see columnar.py
+        self.parquet = self.config.get('parquet_output', False)
+        self.parquet_path = self.config.get('parquet_path') or join(
+            self.config.get('agg_path') or '', 'parquet', 'count')
+        if self.parquet and self.engine == 'local':
+            columnar.require_pyarrow()
+
+    @property
+    def conns3(self):
+        return self.storage.resource
+
+
+    @conns3.setter
+    def conns3(self, resource):
+        self.storage.resource = resource
+
+    # config the result of the stages depends on, recorded with checkpoints
+    checkpoint_keys = [
+        'engine', 'incremental', 'dest_path', 'agg_path', 'inventory',
+        'country_count_threshold', 'distinct_sketches', 'sketch_precision',
+        'parallel_unload', 'parquet_output', 'parquet_path', 'logentry_layout',
+        'namespace', 'manifest_shards', 'validate_manifest', 'role_arn_redshift'
+    ]
+
+
+    def checkpoint_inputs(self):
+        '''
+        The checkpoint_keys config and a hash of datapackage.json, so a
+        resumed run aggregates again once new files are listed in dest_path
+        '''
+        inputs = checkpoint_inputs(self.config, self.checkpoint_keys)
+        inputs['datapackage_sha256'] = hashlib.sha256(
+            self.get_datapackage().encode()).hexdigest()
+        return inputs
+
+    def stages(self):
+        '''
+        Returns the (name, func) steps of run(). The local and incremental
+        modes are one step each, incremental runs already skip the files they
+        ingested before.
+        '''
+        if self.engine == 'local':
+            return [('run_local', self.run_local)]
+        if self.config.get('incremental'):
+            return [('run_incremental', self.run_incremental)]
+        stages = [
+            ('upload_manifest', self.upload_manifest),
+            ('create_tables', self.create_tables),
+            ('load_ref_data', self.load_ref_data),
+            ('load_data', self.load_data),
+            ('count_data', self.count_data),
+            ('aggregate', self.aggregate),
+            ('unload', lambda: self.unload('count')),
+        ]
+        if self.parquet:
+            stages.append(('unload_parquet', self.unload_parquet))
+        if self.sketches:
+            stages.extend([
+                ('build_sketches', self.build_sketches),
+                ('unload_sketches', lambda: self.unload('count_sketch')),
+            ])
+        stages.append(('cleanup', self.cleanup))
+        return stages
+
 
     def run(self):
+        for name, func in self.stages():
+            with self.metrics.stage('aggregate.{}'.format(name)):
+                func()
+
+
+    def cleanup(self):
+        self.drop_tables(self.connRedshift.connect(), [
+            'dim_risk', 'logentry', 'logentry_load', 'count', 'count_sketch'
+        ])
+        shutil.rmtree(self.tmpdir)
+
+
+    def run_incremental(self):
+        '''
+        Keeps logentry and count between runs, loads only the files that are
+        not yet recorded in ingested_files and re-aggregates the days they touch
+        '''
         table_name = 'count'
-        self.upload_manifest()
-        self.create_tables()
-        self.load_ref_data()
-        self.load_data()
-        self.count_data()
-        self.aggregate()
-        self.update_amplified_count()
-        self.unload(table_name)
+        self.create_tables(keep_history=True)
+        entries = self.upload_manifest(skip=self.ingested_files())
+        if entries:
+            self.load_ref_data()
+            self.load_data(table='logentry_stage')
+            self.merge_new_files(entries)
+            self.unload(table_name)
+            if self.parquet:
+                self.unload_parquet()
+            if self.sketches:
+                self.unload('count_sketch')
+        else:
+            logging.info('No new files to ingest')
         self.drop_tables(self.connRedshift.connect(), [
-            'dim_risk', 'logentry', 'count'
+            'dim_risk', 'logentry_stage', 'logentry_stage_load'
         ])
         shutil.rmtree(self.tmpdir)
 
 
+    def run_local(self):
+        '''
+        Aggregates the files of the manifest in this process instead of Redshift
+        and uploads the result where unload() would put it
+        '''
+        table_name = 'count'
+        manifest = self.create_manifest(
+            self.get_datapackage(), self.config.get('dest_path'))
+        # a NULL factor is kept so the amplified count stays NULL, like the SQL
+        amplification = dict(
+            (risk['id'], risk['amplification_factor']) for risk in self.risk_data())
+        engine = LocalAggregator(
+            threshold=self.country_count_threshold,
+            amplification=amplification,
+            max_keys=self.config.get('local_max_keys', 5000000),
+            tmpdir=self.tmpdir,
+            sketch_precision=self.sketch_precision if self.sketches else None
+        )
+        for entry in manifest['entries']:
+            logging.info('Aggregating {}'.format(entry['url']))
+            bucket, key = split_path(entry['url'])
+            body = self.storage.get(bucket, key)['Body']
+            try:
+                engine.add_file(body)
+            finally:
+                body.close()
+
+        tables = [table_name]
+        if self.sketches:
+            tables.append('count_sketch')
+        paths = [join(self.tmpdir, '%s.csv' % table) for table in tables]
+        files = [open(path, 'w') for path in paths]
+        self.metrics.add('rows', engine.write_csv(*files))
+        for f in files:
+            f.close()
+        engine.close()
+
+        bucket, key = split_path(self.config.get('agg_path'))
+        self.storage.upload_many([
+            (path, bucket, join(key, '%s.csv' % table)) for table, path in zip(tables, paths)])
+        if self.parquet:
+            self.upload_parquet(paths[0])
+        logging.info('Data Aggregated Locally And Uploaded To s3')
+        shutil.rmtree(self.tmpdir)
+
+
     def drop_tables(self, cursor, tables):
         for tablename in tables:
             cursor.execute(
@@ -92,200 +401,640 @@ class Aggregator(object):
             )
 
 
-    def create_manifest(self, datapackage_string, source):
+    def create_manifest(self, datapackage_string, source, skip=()):
         datapackage = json.loads(datapackage_string)
         manifest = {"entries": []}
         keys = (p['path'] for p in datapackage.get('resources'))
         for key_list in keys:
             for key in key_list:
+                url = join(source, key)
+                if url in skip:
+                    continue
                 logging.info("Adding {} to manifest".format(key))
-                manifest['entries'].append({"url": join(source,key), "mandatory": True})
+                manifest['entries'].append({"url": url, "mandatory": True})
         return manifest
 
 
-    def upload_manifest(self):
-        tmp_manifest = join(self.tmpdir, 'clean.manifest')
-        s3bucket, key = split_s3_path(self.config.get('dest_path'))
+    def get_datapackage(self):
+        s3bucket, key = split_path(self.config.get('dest_path'))
         dp_key = join(key, 'datapackage.json')
         logging.info("dest_path from config is {}".format(self.config.get('dest_path')))
         logging.info("s3bucket is {}".format(s3bucket))
         logging.info("key is {}".format(key))
         logging.info("dp_key is {}".format(dp_key))
-        obj = self.conns3.Object(s3bucket, dp_key)
-        dp = obj.get()['Body'].read().decode()
-        manifest = self.create_manifest(dp, self.config.get('dest_path'))
+        return self.storage.read(s3bucket, dp_key).decode()
 
-        f = open(tmp_manifest, 'w')
-        json.dump(manifest, f)
-        f.close()
 
-        key = join(key, 'clean.manifest')
-        obj = self.conns3.Object(s3bucket, key)
-        obj.put(Body=open(tmp_manifest,"rb"))
-        logging.info('Manifest Updated')
+    def add_content_lengths(self, entries):
+        '''
+        Lists the directories of the manifest entries concurrently and sets
+        meta.content_length of every entry. Raises ValueError when entries are
+        missing, before the COPY starts.
+        '''
+        locations = []
+        for entry in entries:
+            bucket, key = split_path(entry['url'])
+            locations.append((bucket, join(dirname(key), '')))
+        sizes = self.storage.list_sizes(locations)
+        missing = []
+        for entry in entries:
+            size = sizes.get(split_path(entry['url']))
+            if size is None:
+                missing.append(entry['url'])
+            else:
+                entry['meta'] = {'content_length': size}
+        if missing:
+            raise ValueError('{} manifest entries not found in s3, e.g. {}'.format(
+                len(missing), ', '.join(missing[:5])))
 
 
-    def create_tables(self):
+    def upload_manifest(self, skip=()):
+        '''
+        Uploads clean.manifest and, with manifest_shards above 1, the
+        size-balanced clean.manifest.<n> shards listed in clean.shards.json
+        '''
+        s3bucket, key = split_path(self.config.get('dest_path'))
+        dp = self.get_datapackage()
+        manifest = self.create_manifest(dp, self.config.get('dest_path'), skip)
+        if self.config.get('validate_manifest', True):
+            self.add_content_lengths(manifest['entries'])
+        self.storage.put(s3bucket, join(key, 'clean.manifest'), json.dumps(manifest).encode())
+        shards = shard_manifest(manifest['entries'], self.config.get('manifest_shards', 1))
+        if self.config.get('manifest_shards', 1) > 1:
+            urls = []
+            for i, shard in enumerate(shards):
+                shard_key = join(key, 'clean.manifest.{:03d}'.format(i))
+                self.storage.put(s3bucket, shard_key, json.dumps(shard).encode())
+                urls.append(self.storage.url(s3bucket, shard_key))
+            self.storage.put(s3bucket, join(key, 'clean.shards.json'),
+                          json.dumps({'manifests': urls}).encode())
+        logging.info('Manifest Updated: {} files, {} bytes in {} shards of {} bytes'.format(
+            len(manifest['entries']), manifest_size(manifest['entries']), len(shards),
+            ', '.join(str(manifest_size(shard['entries'])) for shard in shards)))
+        return manifest['entries']
+
+
+    def create_tables(self, keep_history=False):
         conn = self.connRedshift.connect()
-        tablenames = [
-            'dim_risk', 'logentry', 'count'
-        ]
+        if keep_history:
+            # logentry and count survive between incremental runs
+            tablenames = ['dim_risk', 'logentry_stage', 'logentry_stage_load']
+            exists = 'IF NOT EXISTS '
+        else:
+            tablenames = ['dim_risk', 'logentry', 'logentry_load', 'count', 'count_sketch']
+            exists = ''
+        if self.namespace:
+            conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(self.namespace))
         self.drop_tables(conn, tablenames)
-        create_logentry = dedent('''
-        CREATE TABLE logentry(
-        date TIMESTAMP, ip VARCHAR(32), risk INT,
-        asn BIGINT, country VARCHAR(2)
+        redshift = self.is_redshift()
+        # COPY lands the CSV layout here, encode_ips() fills the table
+        load_layout = dict(self.layout, ip_encoding='text', distkey=None, sortkey=[])
+        # same Table Schema columns as dim_risk in RDS
+        inventory, resource = self.risk_inventory()
+        create_risk = refdata.create_table_sql(
+            'dim_risk', resource['schema'], inventory.get('column_types'))
+        create_count = dedent('''
+        CREATE TABLE {exists}count(
+        date TIMESTAMP, risk INT, country VARCHAR(2),
+        asn BIGINT, count INT, count_amplified FLOAT
         )
         ''')
-        create_risk = dedent('''
-        CREATE TABLE dim_risk(
-        id INT, slug VARCHAR(32), title VARCHAR(32),
-        is_archived BOOLEAN,
-        taxonomy VARCHAR(16), measurement_units VARCHAR(32),
-        amplification_factor FLOAT, description TEXT
+        create_sketch = dedent('''
+        CREATE TABLE {exists}count_sketch(
+        date TIMESTAMP, risk INT, country VARCHAR(2),
+        asn BIGINT, reg SMALLINT, rank SMALLINT
         )
         ''')
-        create_count = dedent('''
-        CREATE TABLE count(
-        date TIMESTAMP, risk INT, country VARCHAR(2),
-        asn BIGINT, count INT, count_amplified FLOAT
+        create_ingested = dedent('''
+        CREATE TABLE IF NOT EXISTS ingested_files(
+        url VARCHAR(1024), ingested_at TIMESTAMP
         )
         ''')
         conn.execute(create_risk)
-        conn.execute(create_logentry)
-        conn.execute(create_count)
+        conn.execute(create_logentry_sql('logentry', self.layout, redshift, exists))
+        conn.execute(create_count.format(exists=exists))
+        conn.execute(create_sketch.format(exists=exists))
+        tables = ['logentry_stage'] if keep_history else ['logentry']
+        for table in tables:
+            if keep_history:
+                conn.execute(create_logentry_sql(table, self.layout, redshift))
+            if self.load_table(table) != table:
+                conn.execute(create_logentry_sql(self.load_table(table), load_layout, redshift))
+        if keep_history:
+            conn.execute(create_ingested)
         conn.close()
         logging.info('Redshift tables created')
 
 
-    def load_data(self):
+    def ingested_files(self):
+        conn = self.connRedshift.connect()
+        urls = set(row[0] for row in conn.execute('SELECT url FROM ingested_files'))
+        conn.close()
+        logging.info('{} files already ingested'.format(len(urls)))
+        return urls
+
+
+    def record_ingested(self, entries, batch_size=500, conn=None):
+        close = conn is None
+        conn = conn or self.connRedshift.connect()
+        urls = [entry['url'] for entry in entries]
+        now = datetime.datetime.utcnow()
+        for start in range(0, len(urls), batch_size):
+            batch = urls[start:start + batch_size]
+            values = ', '.join(
+                '(%(url{})s, %(now)s)'.format(i) for i in range(len(batch)))
+            params = dict(('url{}'.format(i), url) for i, url in enumerate(batch))
+            params['now'] = now
+            conn.execute('INSERT INTO ingested_files VALUES ' + values, params)
+        if close:
+            conn.close()
+        logging.info('Recorded {} ingested files'.format(len(urls)))
+
+
+    def merge_stage(self, conn=None):
+        close = conn is None
+        conn = conn or self.connRedshift.connect()
+        conn.execute('INSERT INTO logentry (SELECT * FROM logentry_stage)')
+        if close:
+            conn.close()
+        logging.info('New entries merged into logentry')
+
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Yields a connection whose statements commit or roll back together.
+        The engine autocommits, so the transaction is opened by hand.
+        '''
+        conn = self.connRedshift.connect()
+        conn.execute('BEGIN')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+
+    def merge_new_files(self, entries):
+        '''
+        Merges logentry_stage into logentry, re-aggregates the days it
+        touches and records its files as ingested in one transaction. A run
+        failing halfway leaves nothing behind and the next one merges the
+        same files again without duplicating rows.
+        '''
+        with self.transaction() as conn:
+            self.merge_stage(conn)
+            self.aggregate(only_new_days=True, conn=conn)
+            if self.sketches:
+                self.build_sketches(only_new_days=True, conn=conn)
+            self.record_ingested(entries, conn=conn)
+
+
+    def is_redshift(self):
+        if self.redshift is None:
+            version = self.connRedshift.execute('SELECT version()').scalar()
+            self.redshift = 'Redshift' in version
+        return self.redshift
+
+
+    def load_table(self, table):
+        '''
+        Table the COPY of a logentry table goes to
+        '''
+        if self.layout['ip_encoding'] == 'int':
+            return '{}_load'.format(table)
+        return table
+
+
+    def encode_ips(self, table='logentry'):
+        '''
+        Moves the rows COPYed to the load table of a logentry table into it,
+        IPv4 addresses as integers, with the ip_key it is distributed on
+        '''
+        if self.load_table(table) == table:
+            return
+        conn = self.connRedshift.connect()
+        query = dedent('''
+        INSERT INTO {table}
+        (SELECT
+            date,
+            CASE WHEN ip ~ '{pattern}' THEN {to_int} END,
+            CASE WHEN ip ~ '{pattern}' THEN NULL ELSE ip END,
+            CASE WHEN ip ~ '{pattern}' THEN {to_int} ELSE {hash} END,
+            risk, asn, country
+        FROM {load})
+        ''').format(table=table, load=self.load_table(table),
+                    pattern=IPV4_PATTERN, to_int=IPV4_TO_INT, hash=IP_HASH)
+        conn.execute(query)
+        conn.execute('TRUNCATE {}'.format(self.load_table(table)))
+        conn.close()
+
+
+    def ip_columns(self):
+        return 'ip4, ip6' if self.layout['ip_encoding'] == 'int' else 'ip'
+
+
+    def ip_text(self):
+        return IP_TEXT if self.layout['ip_encoding'] == 'int' else 'ip'
+
+
+    def require_s3(self, name):
+        '''
+        Redshift COPY and UNLOAD only reach S3
+        '''
+        if not is_s3_path(self.config.get(name) or ''):
+            raise ValueError('Redshift needs an s3:// {}, use "engine": "local" '
+                             'for local paths'.format(name))
+
+
+    def load_data(self, table='logentry'):
+        self.require_s3('dest_path')
         conn = self.connRedshift.connect()
-        manifest = join(self.config.get('dest_path'), 'clean.manifest')
+        if self.config.get('manifest_shards', 1) > 1:
+            # one COPY per shard, see upload_manifest()
+            bucket, key = split_path(self.config.get('dest_path'))
+            manifests = json.loads(
+                self.storage.read(bucket, join(key, 'clean.shards.json')).decode())['manifests']
+        else:
+            manifests = [join(self.config.get('dest_path'), 'clean.manifest')]
         copycmd = dedent('''
-        COPY logentry FROM '%s'
+        COPY {table} FROM '%s'
         CREDENTIALS 'aws_iam_role=%s'
         IGNOREHEADER AS 1
         DELIMITER ',' gzip
         TIMEFORMAT AS 'auto'
         MANIFEST
         ''')
-        logging.info('Loading data into db ... ')
-        conn.execute(copycmd%(manifest, self.config.get('role_arn_redshift')))
+        copycmd = copycmd.format(table=self.load_table(table))
+        for i, manifest in enumerate(manifests):
+            logging.info('Loading data into db ... {}/{}'.format(i + 1, len(manifests)))
+            result = conn.execute(copycmd%(manifest, self.config.get('role_arn_redshift')))
+            self.metrics.add('rows', result.rowcount)
         conn.close()
+        self.encode_ips(table)
         logging.info('Data Loaded')
 
 
-    def load_ref_data(self):
-        conn = self.connRedshift.connect()
-        url = ''
+    def risk_inventory(self):
+        '''
+        (inventory entry, resource) of the risk reference data
+        '''
+        inventory = {}
         for inv in self.config.get('inventory'):
             if inv.get('name') == 'risk':
-                url = inv.get('url')
-        dp = datapackage.DataPackage(url)
-        risks = dp.resources[0].data
-        query = dedent('''
-        INSERT INTO dim_risk
-        VALUES (%(id)s, %(slug)s, %(title)s, %(is_archived)s, %(taxonomy)s, %(measurement_units)s, %(amplification_factor)s, %(description)s)''')
+                inventory = inv
+        descriptor = refdata.read_descriptor(inventory.get('url', ''), self.refdata_cache)
+        return inventory, descriptor['resources'][0]
+
+
+    def risk_data(self):
+        '''
+        Risk rows with values typed by the Table Schema
+        '''
+        inventory, resource = self.risk_inventory()
+        risks = []
+        for path in refdata.resource_paths(inventory.get('url', ''), resource):
+            with refdata.open_resource(path, self.refdata_cache) as stream:
+                risks.extend(refdata.iter_rows(stream, resource['schema']))
+        return risks
+
+
+    def load_ref_data(self):
+        conn = self.connRedshift.connect()
+        _, resource = self.risk_inventory()
+        columns = [field['name'] for field in resource['schema']['fields']]
+        risks = self.risk_data()
+        ids = [risk['id'] for risk in risks]
+        duplicates = sorted(set(i for i in ids if ids.count(i) > 1))
+        if duplicates:
+            # aggregate() joins dim_risk on id, duplicates would multiply count rows
+            raise ValueError('Duplicate risk ids in reference data: {}'.format(
+                ', '.join(str(i) for i in duplicates)))
         for risk in risks:
-            # description is too long and not needed here
-            risk['description']=''
-            conn.execute(query,risk)
+            if 'description' in risk:
+                # description is too long and not needed here
+                risk['description']=''
+        rows = refdata.insert_rows(conn, 'dim_risk', columns, risks)
+        self.metrics.add('rows', rows)
+        logging.info('{} risks loaded'.format(rows))
         conn.close()
 
 
     def count_data(self):
         cmd = 'SELECT count(*) FROM logentry'
-        cursor = self.connRedshift.raw_connection().cursor()
-        cursor.execute(cmd)
-        logging.info(cursor.fetchone())
+        rows = self.connRedshift.execute(cmd).scalar()
+        self.metrics.add('rows', rows)
+        logging.info('{} rows in logentry'.format(rows))
+        return rows
 
 
-    def aggregate(self):
-        conn = self.connRedshift.connect()
+    def new_days(self, conn):
+        '''
+        WHERE clause and parameters selecting the rows of the days found in
+        logentry_stage. The literal bounds let the date sort key skip the
+        blocks of older days, the IN list leaves out the days in between.
+        '''
+        first, last = conn.execute(
+            "SELECT MIN(date_trunc('day', date)), MAX(date_trunc('day', date)) FROM logentry_stage"
+        ).fetchone()
+        params = {'new_from': first,
+                  'new_to': last + datetime.timedelta(days=1) if last is not None else None}
+        where = dedent('''\
+            WHERE date >= %(new_from)s AND date < %(new_to)s
+                AND date_trunc('day', date) IN ({})''').format(NEW_DAYS)
+        return where, params
+
+
+    def aggregate(self, only_new_days=False, conn=None):
+        '''
+        Writes count once, amplified counts included. Risks missing from
+        dim_risk keep a zero amplified count, risks with a NULL
+        amplification_factor get a NULL one, as the UPDATE this replaced did.
+        load_ref_data() keeps dim_risk ids unique.
+        '''
+        close = conn is None
+        conn = conn or self.connRedshift.connect()
         logging.info('Aggregating ...')
+        where, params = '', {'threshold': self.country_count_threshold}
+        if only_new_days:
+            where, days = self.new_days(conn)
+            params.update(days)
+            conn.execute('DELETE FROM count ' + where, days)
         query = dedent('''
         INSERT INTO count
         (SELECT
-            date, risk, country, asn, count(*) as count, 0 as count_amplified
+            foo.date, foo.risk, foo.country, foo.asn, foo.count,
+            CASE WHEN r.id IS NULL THEN 0 ELSE foo.count * r.amplification_factor END
         FROM(
-            SELECT DISTINCT (ip), date_trunc('day', date) AS date, risk, asn, country FROM logentry
+            SELECT date, risk, country, asn, count(*) as count
+            FROM(
+                SELECT DISTINCT {ip}, date_trunc('day', date) AS date, risk, asn, country FROM logentry {where}
+            ) AS ips
+            GROUP BY date, asn, risk, country HAVING count(*) > %(threshold)s
         ) AS foo
-        GROUP BY date, asn, risk, country HAVING count(*) > %(threshold)s ORDER BY date DESC, country ASC, asn ASC, risk ASC)
-        ''')
-        conn.execute(query, {'threshold': self.country_count_threshold})
-        conn.close()
+        LEFT JOIN dim_risk AS r ON foo.risk = r.id)
+        ''').format(ip=self.ip_columns(), where=where)
+        result = conn.execute(query, params)
+        self.metrics.add('rows', result.rowcount)
+        if close:
+            conn.close()
+        logging.info('Aggregation Finished!')
 
 
-    def update_amplified_count(self):
-        conn = self.connRedshift.connect()
-        logging.info('Calculating Amplificated Counts ...')
+    def build_sketches(self, only_new_days=False, conn=None):
+        '''
+        Stores the HyperLogLog registers of the distinct IPs behind every row
+        of count, so period level distinct counts can be merged later on
+        '''
+        close = conn is None
+        conn = conn or self.connRedshift.connect()
+        logging.info('Building distinct IP sketches ...')
+        where, params = '', {}
+        if only_new_days:
+            where, params = self.new_days(conn)
+            conn.execute('DELETE FROM count_sketch ' + where, params)
+        reg, rank = hll.register_sql(self.ip_text(), self.sketch_precision)
+        # registers are only kept for rows that passed the count threshold
         query = dedent('''
-        UPDATE count
-        SET count_amplified = count*amplification_factor
-        FROM dim_risk WHERE risk=id
-        ''')
-        conn.execute(query)
-        conn.close()
-        logging.info('Aggregation Finished!')
+        INSERT INTO count_sketch
+        (SELECT
+            r.date, r.risk, r.country, r.asn, r.reg, MAX(r.rank)
+        FROM(
+            SELECT date_trunc('day', date) AS date, risk, country, asn,
+                {reg} AS reg, {rank} AS rank
+            FROM logentry {where}
+        ) AS r
+        JOIN count c ON c.date = r.date AND c.risk = r.risk
+            AND COALESCE(c.country, '') = COALESCE(r.country, '')
+            AND COALESCE(c.asn, -1) = COALESCE(r.asn, -1)
+        GROUP BY r.date, r.risk, r.country, r.asn, r.reg)
+        ''').format(reg=reg, rank=rank, where=where)
+        self.metrics.add('rows', conn.execute(query, params).rowcount)
+        if close:
+            conn.close()
 
 
     def unload(self, table):
+        if self.config.get('parallel_unload'):
+            return self.unload_parallel(table)
+        self.require_s3('agg_path')
         conn = self.connRedshift.connect()
         conn.execute(dedent('''
-        UNLOAD('SELECT * FROM count')
+        UNLOAD('SELECT * FROM %s')
         TO '%s'
         iam_role '%s'
         DELIMITER AS ','
         ALLOWOVERWRITE
         PARALLEL OFF
-        ''')%(join(self.config.get('agg_path'), table), self.config['role_arn_redshift'] ))
+        ''')%(table, join(self.config.get('agg_path'), table), self.config['role_arn_redshift'] ))
         conn.close()
 
-        bucket, key = split_s3_path(self.config.get('agg_path'))
+        bucket, key = split_path(self.config.get('agg_path'))
         self.add_extention(bucket, '%s000'%(join(key, table)))
-        self.delete_key(bucket, '%s000'%(join(key, table)))
         logging.info('Data Unloaded To s3')
 
 
-    def add_extention(self, bucket, key):
-        copy_source = {
-            'Bucket': bucket,
-            'Key': key
-        }
-        new_key = '%s.csv'%(key.split('0')[0])
-        self.conns3.meta.client.copy(copy_source, bucket, new_key)
+    def unload_parallel(self, table):
+        '''
+        Lets every slice write its own part file and lists them in
+        <agg_path>/<table>_part_manifest. The parts are then concatenated into
+        <table>.csv, so readers of the single file keep working.
+        '''
+        self.require_s3('agg_path')
+        conn = self.connRedshift.connect()
+        conn.execute(dedent('''
+        UNLOAD('SELECT * FROM %s')
+        TO '%s'
+        iam_role '%s'
+        DELIMITER AS ','
+        ALLOWOVERWRITE
+        MANIFEST
+        ''')%(table, join(self.config.get('agg_path'), '%s_part_' % table), self.config['role_arn_redshift'] ))
+        conn.close()
+        self.merge_parts(table)
+        logging.info('Data Unloaded To s3 In Parallel')
 
 
-    def delete_key(self, bucket, key):
-        self.conns3.Object(bucket, key).delete()
+    def merge_parts(self, table):
+        '''
+        Concatenates the part files listed in <table>_part_manifest into
+        <agg_path>/<table>.csv, what a PARALLEL OFF unload leaves. On S3 the
+        parts are copied server side, see S3IO.concat().
+        '''
+        bucket, key = split_path(self.config.get('agg_path'))
+        manifest_key = join(key, '%s_part_manifest' % table)
+        manifest = json.loads(self.storage.read(bucket, manifest_key).decode())
+        sizes = self.storage.list_sizes([(bucket, join(key, '%s_part_' % table))])
+        parts = []
+        for entry in manifest['entries']:
+            part_bucket, part_key = split_path(entry['url'])
+            parts.append((part_bucket, part_key, sizes[(part_bucket, part_key)]))
+        self.storage.concat(parts, bucket, join(key, '%s.csv' % table))
+
+
+    def unload_parquet(self):
+        '''
+        Unloads count as Parquet partitioned by day to parquet_path, replacing
+        what the previous run left there
+        '''
+        self.require_s3('agg_path')
+        conn = self.connRedshift.connect()
+        conn.execute(dedent('''
+        UNLOAD('SELECT date::date AS date, risk, country, asn, count, count_amplified FROM count')
+        TO '%s'
+        iam_role '%s'
+        FORMAT AS PARQUET
+        PARTITION BY (date)
+        CLEANPATH
+        ''')%(join(self.parquet_path, ''), self.config['role_arn_redshift'] ))
+        conn.close()
+        logging.info('Data Unloaded To s3 As Parquet')
+
+
+    def upload_parquet(self, csv_path):
+        '''
+        Converts a local count CSV to Parquet and uploads it to parquet_path.
+        Files of the previous run not overwritten, e.g. days no longer in
+        count, are deleted afterwards, like CLEANPATH in unload_parquet().
+        '''
+        directory = join(self.tmpdir, 'parquet')
+        bucket, key = split_path(self.parquet_path)
+        uploads = [
+            (path, bucket, join(key, os.path.relpath(path, directory)))
+            for path in columnar.write_count_parquet(csv_path, directory)]
+        previous = self.storage.list_sizes([(bucket, join(key, ''))])
+        self.storage.upload_many(uploads)
+        written = set(target for _, _, target in uploads)
+        stale = sorted(name for _, name in previous if name not in written)
+        if stale:
+            self.storage.delete_many(bucket, stale)
+            logging.info('{} stale Parquet files deleted'.format(len(stale)))
+
+
+    def add_extention(self, bucket, key):
+        # UNLOAD ... PARALLEL OFF names its only file <prefix>000
+        new_key = '%s.csv'%(re.sub(r'000$', '', key))
+        self.storage.move(bucket, key, bucket, new_key)
 
 
 class LoadToRDS(object):
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
         self.config = config
         self.tmpdir = tempfile.mkdtemp()
-        self.ref_data_urls = [inventory.get('url') for inventory in config.get('inventory')]
-        self.connRDS = create_engine(config.get('rds_uri'))
-        self.conns3 = boto3.resource(
-            's3'
-        )
+        self.metrics = metrics or RunMetrics()
+        # with blue_green the load is built in staging_schema and published
+        # to publish_schema at the end, see publish()
+        self.blue_green = config.get('blue_green', False)
+        # a namespaced feed publishes to its own schema, see get_namespace()
+        self.namespace = get_namespace(config)
+        schema_prefix = self.namespace + '_' if self.namespace else ''
+        self.staging_schema = config.get('staging_schema', schema_prefix + 'staging')
+        self.publish_schema = config.get('publish_schema', self.namespace or 'public')
+        self.previous_schema = config.get('previous_schema', schema_prefix + 'previous')
+        # outlives the staging schema and is never swapped, see publish()
+        self.version_table = '{}.refdata_version'.format(self.publish_schema)
+        # range partitions of fact_count and the cubes by date, see
+        # create_partitions()
+        self.partition_by = config.get('partition_by')
+        if self.partition_by not in [None] + PARTITION_UNITS:
+            raise ValueError('partition_by must be one of {}'.format(', '.join(PARTITION_UNITS)))
+        self.partitioned_tables = ['fact_count'] + [
+            'agg_risk_country_{}'.format(time) for time in TIME_GRANULARITIES]
+        # days date_from <= date < date_to replaced in the published tables,
+        # see load_window()
+        self.window = parse_window(config.get('load_window'))
+        connect_args = {}
+        if self.blue_green and not self.window:
+            connect_args['options'] = '-csearch_path={}'.format(self.staging_schema)
+        elif self.namespace or self.blue_green:
+            connect_args['options'] = '-csearch_path={}'.format(self.publish_schema)
+        # one pooled connection per concurrent load
+        self.connRDS = self.metrics.instrument_engine(create_engine(
+            config.get('rds_uri'),
+            pool_size=max(5, config.get('rds_load_workers', 4)),
+            connect_args=connect_args
+        ))
+        self.storage = get_storage(config, self.metrics)
         self.tablenames = [
             'fact_count', 'agg_risk_country_week',
             'agg_risk_country_month', 'agg_risk_country_quarter', 'dim_asn',
-            'agg_risk_country_year', 'dim_risk', 'dim_country', 'dim_date'
+            'agg_risk_country_year', 'dim_risk', 'dim_country', 'dim_date',
+            'fact_count_sketch'
         ]
+        # HyperLogLog registers per fact_count row, see hll.py
+        self.sketches = self.config.get('distinct_sketches', False)
+        self.sketch_precision = self.config.get(
+            'sketch_precision', hll.DEFAULT_PRECISION)
+        self.refdata_cache = refdata.get_cache(config.get('refdata_cache_dir'))
+        # {name: fingerprint} of the reference data loaded by this run,
+        # recorded once the new dims are in place, see record_refdata_versions()
+        self.refdata_versions = {}
+
+
+    @property
+    def conns3(self):
+        return self.storage.resource
+
+
+    @conns3.setter
+    def conns3(self, resource):
+        self.storage.resource = resource
+
+    checkpoint_keys = [
+        'agg_path', 'inventory', 'distinct_sketches', 'sketch_precision',
+        'parallel_unload', 'blue_green', 'partition_by', 'namespace', 'load_window'
+    ]
+
+    def stages(self):
+        '''
+        Returns the (name, func) steps of run()
+        '''
+        if self.window:
+            stages = []
+            if self.partition_by and self.config.get('partition_retention'):
+                stages.append(('detach_old_partitions', self.detach_old_partitions))
+            stages.append(('load_window', self.load_window))
+            if self.config.get('static_export'):
+                stages.append(('export_static', self.export_static))
+            stages.append(('cleanup', lambda: shutil.rmtree(self.tmpdir)))
+            return stages
+        stages = []
+        if self.blue_green:
+            stages.append(('prepare_staging', self.prepare_staging))
+        elif self.namespace:
+            stages.append(('create_namespace', self.create_namespace))
+        stages.extend([
+            ('index_usage_report', self.index_usage_report),
+            ('load_ref_data_rds', self.load_ref_data_rds),
+            ('create_tables', self.create_tables),
+            ('download_and_load', self.download_and_load),
+        ])
+        # before the cubes, dim_date and the all-time rows are built
+        if self.partition_by and self.config.get('partition_retention'):
+            stages.append(('detach_old_partitions', self.detach_old_partitions))
+        stages.append(('populate_tables', self.populate_tables))
+        stages.extend([
+            ('update_dim_country', self.update_dim_country_if_entry_does_not_present),
+            ('update_dim_asn', self.update_dim_asn_if_entry_does_not_present),
+            ('create_constraints', self.create_constraints),
+            ('create_indexes', self.create_indexes),
+        ])
+        if self.blue_green:
+            stages.append(('publish', self.publish))
+        # only once the cubes are published and complete
+        if self.config.get('static_export'):
+            stages.append(('export_static', self.export_static))
+        stages.append(('cleanup', lambda: shutil.rmtree(self.tmpdir)))
+        return stages
 
 
     def run(self):
-        self.load_ref_data_rds()
-        self.create_tables()
-        self.download_and_load()
-        self.populate_tables()
-        self.update_dim_country_if_entry_does_not_present()
-        self.update_dim_asn_if_entry_does_not_present()
-        self.create_constraints()
-        self.create_indexes()
-        shutil.rmtree(self.tmpdir)
+        for name, func in self.stages():
+            with self.metrics.stage('load.{}'.format(name)):
+                func()
 
 
     def drop_tables(self, tables):
@@ -293,58 +1042,411 @@ class LoadToRDS(object):
             self.connRDS.execute("DROP TABLE IF EXISTS %(table)s CASCADE",{"table": AsIs(tablename)})
 
 
+    def prepare_staging(self):
+        '''
+        Starts the load from an empty staging schema. Every table is built
+        there, so the published tables keep serving until publish().
+        '''
+        conn = self.connRDS.connect()
+        conn.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(self.staging_schema))
+        conn.execute('CREATE SCHEMA {}'.format(self.staging_schema))
+        conn.close()
+        if self.namespace:
+            self.create_namespace()
+
+
+    def create_namespace(self):
+        '''
+        Creates the schema the tables of a namespaced feed are published to
+        '''
+        conn = self.connRDS.connect()
+        conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(self.publish_schema))
+        conn.close()
+
+
+    def swap_tables(self, source, target, retired):
+        '''
+        In one transaction, moves every table of schema source into target and
+        the tables of target it replaces into the emptied schema retired.
+        Indexes and constraints move with their tables. Waits at most
+        publish_lock_timeout for frontend queries to release a table and
+        retries, rather than queueing them behind the swap.
+        '''
+        attempts = self.config.get('publish_attempts', 3)
+        for attempt in range(1, attempts + 1):
+            conn = self.connRDS.connect()
+            try:
+                with conn.begin():
+                    conn.execute("SET LOCAL lock_timeout = '{}'".format(
+                        self.config.get('publish_lock_timeout', '5s')))
+                    # refdata_version describes the published dims, it stays
+                    tables = [row[0] for row in conn.execute(
+                        'SELECT tablename FROM pg_tables WHERE schemaname=%(schema)s '
+                        "AND tablename <> 'refdata_version'", schema=source)]
+                    conn.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(retired))
+                    conn.execute('CREATE SCHEMA {}'.format(retired))
+                    for table in tables:
+                        if self.table_exists(conn, '{}.{}'.format(target, table)):
+                            # partitions the new generation has no equivalent of
+                            # retire with their parent
+                            replaced = [table] + [
+                                partition.split('.')[-1] for partition in
+                                self.partitions(conn, '{}.{}'.format(target, table))
+                                if partition.split('.')[-1] not in tables]
+                            for name in replaced:
+                                conn.execute('ALTER TABLE {}.{} SET SCHEMA {}'.format(
+                                    target, name, retired))
+                        conn.execute('ALTER TABLE {}.{} SET SCHEMA {}'.format(
+                            source, table, target))
+                return tables
+            except OperationalError as e:
+                if attempt == attempts:
+                    raise
+                logging.info('Swap attempt {} failed, retrying: {}'.format(attempt, e))
+            finally:
+                conn.close()
+
+
+    def publish(self):
+        '''
+        Swaps the staged tables in, the ones they replace are kept in
+        previous_schema until the next publish
+        '''
+        tables = self.swap_tables(
+            self.staging_schema, self.publish_schema, self.previous_schema)
+        logging.info('Published {} tables to {}'.format(len(tables), self.publish_schema))
+        self.record_refdata_versions()
+
+
+    def rollback_publish(self):
+        '''
+        Puts the previous generation back, the one it replaces goes to staging
+        '''
+        tables = self.swap_tables(
+            self.previous_schema, self.publish_schema, self.staging_schema)
+        logging.info('Rolled back {} tables in {}'.format(len(tables), self.publish_schema))
+        # the dims put back may be older than the recorded versions
+        self.connRDS.execute('DELETE FROM {}'.format(self.version_table))
+
+
     def download_and_load(self):
-        logging.info('Downloading csv file ...')
-        bucket, key = split_s3_path(self.config.get('agg_path'))
-        s3paths = [(join(self.tmpdir,'count.csv'),join(key,'count.csv'))]
-        bucket = self.conns3.Bucket(bucket)
-        for path in s3paths:
-            bucket.download_file(path[1], path[0])
-
-        logging.info('Loading into RDS ...')
-        # TODO: replace shelling out to psql
-        copy_command = dedent('''
-        psql {uri} -c "\COPY fact_count FROM {tmp}/count.csv WITH delimiter as ',' null '' csv;"
-        ''')
-        os.system(copy_command.format(tmp=self.tmpdir,uri=self.config.get('rds_uri')))
+        if self.config.get('parallel_unload'):
+            return self.download_and_load_parallel()
+        logging.info('Loading count data from s3 into RDS ...')
+        files = self.unloaded_files()
+        targets = dict((table, self.load_target(table)) for table, _, _ in files)
+        # count.csv and count_sketch.csv stream in side by side
+        self.storage.map(lambda f: self.download_and_copy(targets[f[0]], f[1], f[2]), files)
+        for table, target in targets.items():
+            self.route_partitions(table, target)
+
+
+    def download_and_load_parallel(self):
+        '''
+        Streams the part files listed in the UNLOAD manifests into RDS
+        concurrently, each worker on its own connection
+        '''
+        files = self.unloaded_files()
+        targets = dict((table, self.load_target(table)) for table, _, _ in files)
+        self.copy_files(files, targets)
+        for table, target in targets.items():
+            self.route_partitions(table, target)
+
+
+    def unloaded_files(self):
+        '''
+        Returns (table, bucket, key) of the files unload() wrote to agg_path:
+        count.csv and count_sketch.csv, or with parallel_unload the part files
+        listed in their manifests
+        '''
+        bucket, key = split_path(self.config.get('agg_path'))
+        tables = [('count', 'fact_count')]
+        if self.sketches:
+            tables.append(('count_sketch', 'fact_count_sketch'))
+        if not self.config.get('parallel_unload'):
+            return [(table, bucket, join(key, '%s.csv' % name)) for name, table in tables]
+        files = []
+        for name, table in tables:
+            manifest_key = join(key, '%s_part_manifest' % name)
+            manifest = json.loads(self.storage.read(bucket, manifest_key).decode())
+            for entry in manifest['entries']:
+                part_bucket, part_key = split_path(entry['url'])
+                files.append((table, part_bucket, part_key))
+        return files
+
+
+    def copy_files(self, files, targets, where=None, params=None):
+        '''
+        COPYs the (table, bucket, key) files into targets[table] on
+        rds_load_workers connections, only the rows matching where if given
+        '''
+        workers = self.config.get('rds_load_workers', 4)
+        logging.info('Loading {} parts into RDS with {} workers ...'.format(
+            len(files), workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() re-raises the first failed part
+            rows = list(pool.map(
+                lambda f: self.download_and_copy(targets[f[0]], f[1], f[2], where, params),
+                files))
+        logging.info('{} rows loaded from {} parts'.format(sum(rows), len(files)))
+        return sum(rows)
+
+
+    def is_partitioned(self, conn, table):
+        return bool(conn.execute(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%(table)s)",
+            table=table).scalar())
+
+
+    def partitions(self, conn, table):
+        return [row[0] for row in conn.execute(
+            'SELECT inhrelid::regclass::text FROM pg_inherits '
+            'WHERE inhparent = to_regclass(%(table)s) ORDER BY 1', table=table)]
+
+
+    def create_partitions(self, conn, table, dates):
+        '''
+        Creates the partitions of table missing for the dates the query
+        returns, e.g. fact_count_p20160901 for September 2016
+        '''
+        starts = conn.execute(dedent('''
+            SELECT DISTINCT date_trunc('{unit}', date)::date FROM ({dates}) AS d
+            WHERE date IS NOT NULL
+            ''').format(unit=self.partition_by, dates=dates))
+        for (start,) in starts:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS {table}_p{start:%Y%m%d} PARTITION OF {table} "
+                "FOR VALUES FROM ('{start}') TO ('{end}')".format(
+                    table=table, start=start, end=add_periods(start, self.partition_by, 1)))
+
+
+    def keep_partitions(self, conn):
+        '''
+        Detaches the fact_count partitions of the previous load as
+        <partition>_kept before the table is rebuilt. route_partitions() puts
+        back the ones whose rows did not change, with their indexes. With
+        blue_green the published partitions keep serving and are not reused.
+        '''
+        if not self.partition_by or self.blue_green or not self.is_partitioned(conn, 'fact_count'):
+            return
+        # left behind by a load that failed before route_partitions()
+        for kept in self.kept_partitions(conn, 'fact_count'):
+            conn.execute('DROP TABLE {}'.format(kept))
+        for partition in self.partitions(conn, 'fact_count'):
+            if partition.endswith('_default'):
+                continue
+            conn.execute('ALTER TABLE fact_count DETACH PARTITION {}'.format(partition))
+            conn.execute('ALTER TABLE {0} RENAME TO {0}_kept'.format(partition))
+
+
+    def kept_partitions(self, conn, table):
+        return [row[0] for row in conn.execute(
+            "SELECT relname FROM pg_class WHERE relname LIKE %(pattern)s "
+            "AND relkind = 'r' AND relnamespace = current_schema()::regnamespace ORDER BY 1",
+            pattern='{}\\_p%\\_kept'.format(table))]
+
+
+    def reuse_partitions(self, conn, table, target):
+        '''
+        Attaches back the kept partitions of table holding the same rows as
+        target for their period and removes those rows from target. Kept
+        partitions that changed are dropped. Returns the partitions reused.
+        '''
+        checksum = dedent('''
+            SELECT count(*), SUM(hashtextextended(t::text, 0)) FROM {table} t
+            WHERE date >= %(start)s AND date < %(end)s
+            ''')
+        reused = []
+        for kept in self.kept_partitions(conn, table):
+            partition = kept[:-len('_kept')]
+            start = datetime.datetime.strptime(partition[-8:], '%Y%m%d').date()
+            end = add_periods(start, self.partition_by, 1)
+            period = {'start': start, 'end': end}
+            old = tuple(conn.execute(checksum.format(table=kept), **period).fetchone())
+            new = tuple(conn.execute(checksum.format(table=target), **period).fetchone())
+            if old != new:
+                conn.execute('DROP TABLE {}'.format(kept))
+                continue
+            conn.execute('ALTER TABLE {} RENAME TO {}'.format(kept, partition))
+            conn.execute(
+                "ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                    table, partition, start, end))
+            conn.execute(
+                'DELETE FROM {} WHERE date >= %(start)s AND date < %(end)s'.format(target), **period)
+            reused.append(partition)
+        if reused:
+            logging.info('Reused {} unchanged partitions of {}: {}'.format(
+                len(reused), table, ', '.join(reused)))
+        return reused
+
+
+    def load_target(self, table):
+        '''
+        Table COPY writes into. Partitioned tables are loaded through an
+        unlogged copy, since their partitions are only known once the data is.
+        '''
+        if table not in self.partitioned_tables or not self.partition_by:
+            return table
+        target = '{}_load'.format(table)
+        conn = self.connRDS.connect()
+        conn.execute('DROP TABLE IF EXISTS {}'.format(target))
+        conn.execute('CREATE UNLOGGED TABLE {} (LIKE {})'.format(target, table))
+        conn.close()
+        return target
+
+
+    def route_partitions(self, table, target):
+        '''
+        Moves the rows loaded into target into the partitions of table
+        '''
+        if target == table:
+            return
+        conn = self.connRDS.connect()
+        with conn.begin():
+            self.reuse_partitions(conn, table, target)
+            self.create_partitions(conn, table, 'SELECT date FROM {}'.format(target))
+            conn.execute('INSERT INTO {} SELECT * FROM {}'.format(table, target))
+            conn.execute('DROP TABLE {}'.format(target))
+        conn.close()
+
+
+    def detach_old_partitions(self):
+        '''
+        Detaches and drops the date partitions older than partition_retention
+        months or years, which costs no more than a catalog change. Runs
+        before the cubes are built, so they and dim_date only hold the days
+        kept. Sketches of the dropped days are deleted too.
+        '''
+        today = datetime.date.today()
+        current = datetime.date(today.year, 1 if self.partition_by == 'year' else today.month, 1)
+        cutoff = add_periods(current, self.partition_by, -self.config['partition_retention'])
+        cutoff_name = 'p{:%Y%m%d}'.format(cutoff)
+        conn = self.connRDS.connect()
+        for table in self.partitioned_tables:
+            for partition in self.partitions(conn, table):
+                suffix = partition[len(table) + 1:]
+                if suffix != 'default' and suffix < cutoff_name:
+                    conn.execute('ALTER TABLE {} DETACH PARTITION {}'.format(table, partition))
+                    conn.execute('DROP TABLE {}'.format(partition))
+                    logging.info('Dropped partition {}'.format(partition))
+        for table in ['fact_count_sketch', 'dim_date']:
+            if self.table_exists(conn, table):
+                conn.execute('DELETE FROM {} WHERE date < %(cutoff)s'.format(table), cutoff=cutoff)
+        conn.close()
+
+
+    def download_and_copy(self, table, bucket, key, where=None, params=None):
+        body = self.storage.get(bucket, key)['Body']
+        try:
+            return self.copy_stream(table, body, where=where, params=params)
+        finally:
+            body.close()
+
+
+    def copy_stream(self, table, stream, options="delimiter as ',' null '' csv",
+                    where=None, params=None):
+        '''
+        COPYs a binary file-like object into table on a pooled connection,
+        reading it COPY_BUFFER_SIZE bytes at a time. where keeps only the rows
+        matching it (COPY ... WHERE, PostgreSQL 12+). Returns the rows loaded.
+        '''
+        conn = self.connRDS.raw_connection()
+        try:
+            cursor = conn.cursor()
+            copy = 'COPY {} FROM STDIN WITH {}'.format(table, options)
+            if where:
+                copy += ' WHERE ' + cursor.mogrify(where, params).decode()
+            cursor.copy_expert(copy, stream, size=COPY_BUFFER_SIZE)
+            rows = cursor.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        self.metrics.add('rows', rows)
+        logging.info('{} rows copied into {}'.format(rows, table))
+        return rows
+
+
+    def table_exists(self, conn, table):
+        return conn.execute(
+            'SELECT to_regclass(%(table)s) IS NOT NULL', table=table).scalar()
+
+
+    def dim_tables(self):
+        '''
+        Yields (load table, dim table) for every inventory entry,
+        e.g. (data__risk___risk, dim_risk)
+        '''
+        for inventory in self.config.get('inventory'):
+            url = inventory.get('url')
+            resource = refdata.read_descriptor(url, self.refdata_cache)['resources'][0]
+            yield refdata.table_name(resource), 'dim_{}'.format(inventory.get('name'))
 
 
     def load_ref_data_rds(self):
+        '''
+        Creates a table from the Table Schema of every inventory resource and
+        COPYs its CSV in, e.g. data/risk.csv -> data__risk___risk
+
+        Datapackages whose content hash matches the one recorded in
+        refdata_version at their last load are skipped and their published
+        dim table is kept as is.
+        '''
         logging.info('Loading reference_data to RDS ...')
         conn = self.connRDS.connect()
-        # creating dim_asn table here with other ref data
-        conn.execute('DROP TABLE IF EXISTS data__asn___asn CASCADE')
-        create_asn = 'CREATE TABLE data__asn___asn(number BIGINT, title TEXT, country TEXT)'
-        conn.execute(create_asn)
-
-        for url in self.ref_data_urls:
-            # Loading of asn with push_datapackage takes more then 2 hours
-            # So have to download locally and save (takes ~5 seconds)
-            if 'asn' not in url:
-                push_datapackage(descriptor=url, backend='sql', engine=conn)
-            else:
-                dp = datapackage.DataPackage(url)
-                # local path will be returned if not found remote one (for tests)
-                if dp.resources[0].remote_data_path:
-                    r = requests.get(dp.resources[0].remote_data_path)
-                    with open(join(self.tmpdir, 'asn.csv'),"wb") as fp:
-                        fp.write(r.content)
-                else:
-                    shutil.copy(dp.resources[0].local_data_path,join(self.tmpdir, 'asn.csv'))
-                # TODO: replace shelling out
-                copy_command = dedent('''
-                psql {uri} -c "\COPY data__asn___asn FROM {tmp}/asn.csv WITH delimiter as ',' csv header;"
-                ''')
-                os.system(copy_command.format(tmp=self.tmpdir,uri=self.config.get('rds_uri')))
+        conn.execute(dedent('''
+        CREATE TABLE IF NOT EXISTS {}(
+            name VARCHAR(64) PRIMARY KEY,
+            fingerprint VARCHAR(64),
+            loaded_at TIMESTAMP
+            )''').format(self.version_table))
+        versions = dict(conn.execute(
+            'SELECT name, fingerprint FROM {}'.format(self.version_table)).fetchall())
+        for inventory in self.config.get('inventory'):
+            name = inventory.get('name')
+            url = inventory.get('url')
+            fingerprint = refdata.fingerprint(url, self.refdata_cache)
+            if (versions.get(name) == fingerprint and
+                    self.table_exists(conn, '{}.dim_{}'.format(self.publish_schema, name))):
+                logging.info('{} reference data unchanged, skipping reload'.format(name))
+                continue
+            descriptor = refdata.read_descriptor(url, self.refdata_cache)
+            for resource in descriptor['resources']:
+                table = refdata.table_name(resource)
+                conn.execute('DROP TABLE IF EXISTS %s CASCADE' % table)
+                conn.execute(refdata.create_table_sql(
+                    table, resource['schema'], inventory.get('column_types')))
+                for path in refdata.resource_paths(url, resource):
+                    with refdata.open_resource(path, self.refdata_cache) as stream:
+                        self.copy_stream(table, stream, "delimiter as ',' csv header")
+            self.refdata_versions[name] = fingerprint
         conn.close()
 
 
+    def record_refdata_versions(self):
+        '''
+        Records the reference data loaded by this run, once its dims replaced
+        the published ones: in create_tables(), or with blue_green in publish()
+        '''
+        conn = self.connRDS.connect()
+        with conn.begin():
+            for name, fingerprint in sorted(self.refdata_versions.items()):
+                conn.execute(
+                    'DELETE FROM {} WHERE name=%(name)s'.format(self.version_table), name=name)
+                conn.execute(
+                    'INSERT INTO {} VALUES (%(name)s, %(fingerprint)s, %(now)s)'.format(self.version_table),
+                    name=name, fingerprint=fingerprint, now=datetime.datetime.utcnow())
+        conn.close()
+        self.refdata_versions = {}
+
+
     def create_tables(self):
         conn=self.connRDS.connect()
-        self.drop_tables(self.tablenames)
-        create_risk ='ALTER TABLE data__risk___risk RENAME TO dim_risk'
-        create_country = 'ALTER TABLE data__country___country RENAME TO dim_country'
-        create_asn = 'ALTER TABLE data__asn___asn RENAME TO dim_asn'
+        # dims are only replaced when load_ref_data_rds loaded a new version
+        dims = list(self.dim_tables())
+        reloaded = [(table, dim) for table, dim in dims if self.table_exists(conn, table)]
+        kept = [dim for table, dim in dims if (table, dim) not in reloaded]
+        self.keep_partitions(conn)
+        self.drop_tables([t for t in self.tablenames if t not in kept])
         create_time = dedent('''
         CREATE TABLE dim_date(
             date DATE, month INT,
@@ -352,41 +1454,123 @@ class LoadToRDS(object):
             week INT, week_start DATE,
             week_end DATE
             )''')
+        partition = ' PARTITION BY RANGE (date)' if self.partition_by else ''
         create_count = dedent('''
         CREATE TABLE fact_count(
             date DATE, risk INT,
             country VARCHAR(2),
             asn BIGINT, count BIGINT,
             count_amplified FLOAT
+            )''') + partition
+        create_sketch = dedent('''
+        CREATE TABLE fact_count_sketch(
+            date DATE, risk INT,
+            country VARCHAR(2),
+            asn BIGINT, reg SMALLINT,
+            rank SMALLINT
             )''')
         create_cube = dedent('''
         CREATE TABLE agg_risk_country_{time}(
             date DATE, risk INT,
             country VARCHAR(2),
             count BIGINT,
-            count_amplified FLOAT
-            )''')
-
-        conn.execute(create_risk)
-        conn.execute(create_country)
-        conn.execute(create_asn)
+            count_amplified FLOAT,
+            count_distinct BIGINT,
+            grp SMALLINT
+            )''') + partition
+
+        for table, dim in reloaded:
+            conn.execute('ALTER TABLE {} RENAME TO {}'.format(table, dim))
+        if self.blue_green:
+            # staging starts empty, unchanged dims come from the published ones
+            for dim in kept:
+                published = '{}.{}'.format(self.publish_schema, dim)
+                if not self.table_exists(conn, dim) and self.table_exists(conn, published):
+                    conn.execute('CREATE TABLE {} AS SELECT * FROM {}'.format(dim, published))
         conn.execute(create_time)
         conn.execute(create_count)
+        conn.execute(create_sketch)
         self.create_or_update_cubes(conn, create_cube)
+        if self.partition_by:
+            # takes the all-time cube rows, their date is NULL
+            for table in self.partitioned_tables:
+                conn.execute('CREATE TABLE {0}_default PARTITION OF {0} DEFAULT'.format(table))
         conn.close()
+        if not self.blue_green:
+            self.record_refdata_versions()
 
 
     def create_or_update_cubes(self, conn, cmd):
-        time_granularities = [
-            'week', 'month', 'quarter', 'year'
-        ]
-        for time in time_granularities:
+        for time in TIME_GRANULARITIES:
             conn.execute(cmd.format(time=time))
 
 
     def populate_tables(self):
+        '''
+        Scans fact_count once into cube_base, a GROUPING SETS rollup by day
+        with NULL risk / country already replaced by 100 / 'T'. dim_date and
+        all cubes are derived from that much smaller table. grp keeps rollup
+        rows apart from fact rows that have a NULL key of their own.
+        With distinct_sketches, sketch_base does the same for the registers.
+        '''
         logging.info('Populating cubes')
         conn=self.connRDS.connect()
+        with conn.begin():
+            self.create_cube_base(conn)
+            if self.sketches:
+                self.create_sketch_base(conn)
+            self.metrics.add('rows', self.insert_dates(
+                conn, 'SELECT date FROM cube_base WHERE grp = 0 GROUP BY date'))
+            self.populate_cubes(conn)
+        conn.close()
+
+
+    def create_cube_base(self, conn, date_from=None, date_to=None):
+        '''
+        Creates cube_base from the fact_count rows with date_from <= date <
+        date_to, or all of them
+        '''
+        create_base = dedent('''
+        CREATE TEMP TABLE cube_base ON COMMIT DROP AS
+        SELECT date, COALESCE(risk, 100) AS risk, COALESCE(country, 'T') AS country,
+            GROUPING(risk, country) AS grp,
+            SUM(count) AS count, SUM(count_amplified) AS count_amplified
+        FROM fact_count{where}
+        GROUP BY GROUPING SETS ((date, risk, country), (date, risk), (date, country), (date))
+        ''')
+        if date_from is None:
+            conn.execute(create_base.format(where=''))
+        else:
+            conn.execute(create_base.format(
+                where=' WHERE date >= %(date_from)s AND date < %(date_to)s'),
+                date_from=date_from, date_to=date_to)
+
+
+    def create_sketch_base(self, conn, date_from=None, date_to=None):
+        '''
+        Creates sketch_base, the registers of fact_count_sketch merged by day
+        in the grouping sets of cube_base, with the same grp
+        '''
+        create_base = dedent('''
+        CREATE TEMP TABLE sketch_base ON COMMIT DROP AS
+        SELECT date, COALESCE(risk, 100) AS risk, COALESCE(country, 'T') AS country,
+            GROUPING(risk, country) AS grp, reg, MAX(rank) AS rank
+        FROM fact_count_sketch{where}
+        GROUP BY GROUPING SETS (
+            (date, risk, country, reg), (date, risk, reg), (date, country, reg), (date, reg))
+        ''')
+        if date_from is None:
+            conn.execute(create_base.format(where=''))
+        else:
+            conn.execute(create_base.format(
+                where=' WHERE date >= %(date_from)s AND date < %(date_to)s'),
+                date_from=date_from, date_to=date_to)
+
+
+    def insert_dates(self, conn, dates):
+        '''
+        Adds the dates the query returns to dim_date, returns their number
+        '''
         update_date = dedent('''
         INSERT INTO dim_date
         (SELECT
@@ -397,164 +1581,742 @@ class LoadToRDS(object):
             EXTRACT(WEEK FROM date) as week,
             date_trunc('week', date) as week_start,
             (date_trunc('week', date)+'6 days') as week_end
-        FROM fact_count GROUP BY date)
-        ''')
+        FROM ({dates}) AS d)
+        ''').format(dates=dates)
+        return conn.execute(update_date).rowcount
+
+
+    def populate_cubes(self, conn, buckets=None):
+        '''
+        Fills the cubes from cube_base and, with distinct_sketches, their
+        count_distinct from sketch_base, merging the registers of the days of
+        a row so IPs seen on several days are counted once. Both are grouped
+        by grp, which keeps fact rows with a NULL risk or country apart from
+        the rollup rows. buckets limits that to {time: (start, end)} date
+        ranges of every cube, whose rows are replaced, see window_buckets(),
+        and leaves the all-time rows to update_all_time().
+        '''
+        # the second grouping set gives the all-time rows, with a NULL date
         populate_cube = dedent('''
         INSERT INTO agg_risk_country_{time}
-            (SELECT date_trunc('{time}', date) AS date, risk, country,
-            SUM(count) AS count, SUM(count_amplified) FROM fact_count
-        GROUP BY CUBE(date_trunc('{time}', date), country, risk) ORDER BY date DESC, country)
-        ''')
-        update_cube_risk = dedent('''
-        UPDATE agg_risk_country_{time}
-        SET risk=100
-        WHERE risk IS null;
+        SELECT c.date, c.risk, c.country, c.count, c.count_amplified, {count_distinct}, c.grp
+        FROM (
+            SELECT date_trunc('{time}', date) AS date, grp, risk, country,
+                SUM(count) AS count, SUM(count_amplified) AS count_amplified
+            FROM cube_base{where}
+            GROUP BY GROUPING SETS ((date_trunc('{time}', date), grp, risk, country){all_time})
+        ) AS c{distinct}
         ''')
-        update_cube_country = dedent('''
-        UPDATE agg_risk_country_{time}
-        SET country='T'
-        WHERE country IS null;
-        ''')
-        conn.execute(update_date)
-        self.create_or_update_cubes(conn, populate_cube)
-        self.create_or_update_cubes(conn, update_cube_risk)
-        self.create_or_update_cubes(conn, update_cube_country)
-        conn.close()
+        distinct = dedent('''
+        LEFT JOIN (
+            SELECT date, grp, risk, country, {estimate} AS count_distinct
+            FROM (
+                SELECT date_trunc('{{time}}', date) AS date, grp, risk, country, reg,
+                    MAX(rank) AS rank
+                FROM sketch_base{{where}}
+                GROUP BY GROUPING SETS ((date_trunc('{{time}}', date), grp, risk, country, reg){{all_time}})
+            ) AS registers
+            GROUP BY date, grp, risk, country
+        ) AS d ON c.date IS NOT DISTINCT FROM d.date AND c.grp = d.grp
+            AND c.risk = d.risk AND c.country = d.country''').rstrip().format(
+            estimate=hll.estimate_sql('rank', self.sketch_precision))
+
+        def insert(time, where='', all_time=False, **params):
+            sets = ', (grp, risk, country{})' if all_time else ''
+            count_distinct, join = 'NULL', ''
+            if self.sketches:
+                count_distinct = 'd.count_distinct'
+                join = distinct.format(time=time, where=where, all_time=sets.format(', reg'))
+            conn.execute(populate_cube.format(
+                time=time, where=where, all_time=sets.format(''),
+                count_distinct=count_distinct, distinct=join), **params)
+
+        if self.partition_by:
+            for time in TIME_GRANULARITIES:
+                self.create_partitions(
+                    conn, 'agg_risk_country_{}'.format(time),
+                    "SELECT date_trunc('{}', date) AS date FROM cube_base".format(time))
+        if buckets is None:
+            for time in TIME_GRANULARITIES:
+                insert(time, all_time=True)
+            return
+        for time in TIME_GRANULARITIES:
+            start, end = buckets[time]
+            conn.execute(
+                'DELETE FROM agg_risk_country_{} WHERE date >= %(start)s AND date < %(end)s'.format(time),
+                start=start, end=end)
+            insert(time, ' WHERE date >= %(start)s AND date < %(end)s', start=start, end=end)
 
 
-    def update_dim_country_if_entry_does_not_present(self):
+    def create_window_rollup(self, conn, table, date_from, date_to):
         '''
-        Checks if there is new country in fact table that does not present in dim_country
-        and updates if so. Inserts values like so: (country_id, uknown, unknown, unknown, unknown)
+        Creates table with the all-time grouping sets of the fact_count rows
+        with date_from <= date < date_to, keyed by grp like cube_base
         '''
+        conn.execute(dedent('''
+        CREATE TEMP TABLE {table} ON COMMIT DROP AS
+        SELECT COALESCE(risk, 100) AS risk, COALESCE(country, 'T') AS country,
+            GROUPING(risk, country) AS grp,
+            COALESCE(SUM(count), 0) AS count, SUM(count_amplified) AS count_amplified
+        FROM fact_count WHERE date >= %(date_from)s AND date < %(date_to)s
+        GROUP BY GROUPING SETS ((risk, country), (risk), (country), ())
+        ''').format(table=table), date_from=date_from, date_to=date_to)
 
-        conn = self.connRDS.connect()
-        cmd = dedent('''
-        SELECT DISTINCT country FROM fact_count fc WHERE NOT EXISTS (
-            SELECT 1 FROM dim_country dc WHERE fc.country=dc.id
-        ) AND country IS NOT NULL;
+
+    def update_all_time(self, conn):
+        '''
+        Moves the all-time cube rows by the difference between the window
+        rollups window_old and window_new, see create_window_rollup(), instead
+        of rescanning fact_count. Rows left without facts are removed. A row
+        whose non-NULL amplified counts all left the window keeps 0 rather
+        than NULL. With distinct_sketches their count_distinct is merged
+        again from every sketch, as distinct IPs cannot be subtracted.
+        '''
+        conn.execute(dedent('''
+        CREATE TEMP TABLE window_delta ON COMMIT DROP AS
+        SELECT grp, risk, country, COALESCE(n.count, 0) - COALESCE(o.count, 0) AS count,
+            n.count_amplified AS new_amplified, o.count_amplified AS old_amplified
+        FROM window_new n FULL JOIN window_old o USING (grp, risk, country)
+        '''))
+        update = dedent('''
+        UPDATE agg_risk_country_{time} c SET count = c.count + d.count,
+            count_amplified = CASE
+                WHEN c.count_amplified IS NULL AND d.new_amplified IS NULL THEN NULL
+                ELSE COALESCE(c.count_amplified, 0) + COALESCE(d.new_amplified, 0)
+                    - COALESCE(d.old_amplified, 0) END
+        FROM window_delta d
+        WHERE c.date IS NULL AND c.grp = d.grp AND c.risk = d.risk AND c.country = d.country
         ''')
-        results = conn.execute(cmd).fetchall()
-        if not len(results):
-            conn.close()
+        insert = dedent('''
+        INSERT INTO agg_risk_country_{time} (date, risk, country, count, count_amplified, grp)
+        SELECT NULL, risk, country, count, new_amplified, grp FROM window_delta d
+        WHERE d.count > 0 AND NOT EXISTS (
+            SELECT 1 FROM agg_risk_country_{time} c
+            WHERE c.date IS NULL AND c.grp = d.grp AND c.risk = d.risk AND c.country = d.country)
+        ''')
+        for time in TIME_GRANULARITIES:
+            conn.execute(update.format(time=time))
+            conn.execute(insert.format(time=time))
+            conn.execute(
+                'DELETE FROM agg_risk_country_{} WHERE date IS NULL AND count <= 0'.format(time))
+        if not self.sketches:
             return
-        logging.info (dedent('''
-        Warning: New country ID(s) in fact table that do not present in country dimension.
-        Updating dim_country as follows:
-        id | name    | slug    | region  | continent
-        ---+---------+---------+---------+----------'''))
-        for country in results:
-
-            cmd = dedent('''
-            INSERT INTO dim_country VALUES('%s','unknown','unknown','unknown','unknown')
-            ''' % country[0])
-            conn.execute(cmd)
-            logging.info ('%s | unknown | unknown | unknown | unknown' % country[0])
-        logging.info ('\nUpdate reference data for counrtry with new entries here: https://github.com/cybergreen-net/refdata-country')
+        conn.execute(dedent('''
+        CREATE TEMP TABLE distinct_all_time ON COMMIT DROP AS
+        SELECT grp, risk, country, {estimate} AS count_distinct
+        FROM (
+            SELECT COALESCE(risk, 100) AS risk, COALESCE(country, 'T') AS country,
+                GROUPING(risk, country) AS grp, reg, MAX(rank) AS rank
+            FROM fact_count_sketch
+            GROUP BY GROUPING SETS ((risk, country, reg), (risk, reg), (country, reg), (reg))
+        ) AS registers
+        GROUP BY grp, risk, country
+        ''').format(estimate=hll.estimate_sql('rank', self.sketch_precision)))
+        for time in TIME_GRANULARITIES:
+            conn.execute(dedent('''
+            UPDATE agg_risk_country_{time} c SET count_distinct = d.count_distinct
+            FROM distinct_all_time d
+            WHERE c.date IS NULL AND c.grp = d.grp AND c.risk = d.risk AND c.country = d.country
+            ''').format(time=time))
+
+
+    def load_window(self):
+        '''
+        Replaces the days date_from <= date < date_to of load_window in the
+        published fact_count with the ones unloaded to agg_path and recomputes
+        the cube buckets holding them, in one transaction. Readers see the
+        tables before or after the reload, and the constraints and indexes
+        stay in place. Only the rows of the window are copied in, and the
+        all-time rows are moved by the difference of the window rollups.
+        '''
+        date_from, date_to = self.window
+        window = {'date_from': date_from, 'date_to': date_to}
+        files = self.unloaded_files()
+        staged = dict((table, '{}_window'.format(table)) for table, _, _ in files)
+        conn = self.connRDS.connect()
+        for table, target in staged.items():
+            conn.execute('DROP TABLE IF EXISTS {}'.format(target))
+            conn.execute('CREATE UNLOGGED TABLE {} (LIKE {})'.format(target, table))
         conn.close()
+        self.copy_files(files, staged, 'date >= %(date_from)s AND date < %(date_to)s', window)
+        # the foreign keys of fact_count are checked on insert
+        self.update_dim_country_if_entry_does_not_present(staged['fact_count'])
+        self.update_dim_asn_if_entry_does_not_present(staged['fact_count'])
+
+        buckets = window_buckets(date_from, date_to)
+        conn = self.connRDS.connect()
+        with conn.begin():
+            self.insert_dates(conn, dedent('''
+                SELECT DISTINCT date FROM {} w
+                WHERE NOT EXISTS (SELECT 1 FROM dim_date dd WHERE dd.date = w.date)
+                ''').format(staged['fact_count']))
+            self.create_window_rollup(conn, 'window_old', date_from, date_to)
+            for table, target in sorted(staged.items()):
+                if self.partition_by and table in self.partitioned_tables:
+                    self.create_partitions(conn, table, 'SELECT date FROM {}'.format(target))
+                deleted = conn.execute(
+                    'DELETE FROM {} WHERE date >= %(date_from)s AND date < %(date_to)s'.format(table),
+                    **window).rowcount
+                inserted = conn.execute('INSERT INTO {} SELECT * FROM {}'.format(table, target)).rowcount
+                logging.info('Replaced {} rows of {} with {} from {} to {}'.format(
+                    deleted, table, inserted, date_from, date_to))
+                if table == 'fact_count':
+                    self.metrics.add('rows', inserted)
+            conn.execute(dedent('''
+                DELETE FROM dim_date dd
+                WHERE date >= %(date_from)s AND date < %(date_to)s
+                    AND NOT EXISTS (SELECT 1 FROM fact_count fc WHERE fc.date = dd.date)
+                '''), **window)
+            start = min(start for start, _ in buckets.values())
+            end = max(end for _, end in buckets.values())
+            self.create_cube_base(conn, start, end)
+            if self.sketches:
+                self.create_sketch_base(conn, start, end)
+            self.populate_cubes(conn, buckets)
+            self.create_window_rollup(conn, 'window_new', date_from, date_to)
+            self.update_all_time(conn)
+        conn.close()
+        self.drop_tables(staged.values())
 
 
-    def update_dim_asn_if_entry_does_not_present(self):
+    def export_static(self):
         '''
-        Checks if there is new ASN in fact table that does not present in dim_asn
-        and updates if so. Inserts values like so: (AS_number, uknown, country_id)
+        Uploads the cube time series of the published cubes as static JSON
+        next to agg_path, see export.py. Documents whose content is already
+        there are skipped, those out of the index for static_export_grace
+        seconds are deleted.
         '''
+        path = self.config.get('static_export_path') or join(self.config.get('agg_path'), 'static')
+        bucket, prefix = split_path(path)
+        existing = set(key for _, key in self.storage.list_sizes([(bucket, join(prefix, ''))]))
+        conn = self.connRDS.connect()
+        index = {}
+        uploads = []
+        for time in TIME_GRANULARITIES:
+            rows = conn.execute(dedent('''
+                SELECT date, risk, country, count, count_amplified, count_distinct
+                FROM {schema}.agg_risk_country_{time} WHERE date IS NOT NULL ORDER BY date
+                ''').format(schema=self.publish_schema, time=time))
+            for name, document in export.build_documents(time, rows).items():
+                body = export.render(document)
+                key = join(prefix, export.content_key(name, body))
+                index[name] = key[len(prefix):].lstrip('/')
+                if key not in existing:
+                    uploads.append((key, body))
+        conn.close()
+
+        self.storage.map(lambda item: self.storage.put(
+            bucket, item[0], item[1], ContentType='application/json',
+            ContentEncoding='gzip', CacheControl=export.CACHE_CONTROL), uploads)
+        # the index goes last, it must never point at a missing document
+        self.storage.put(
+            bucket, join(prefix, 'index.json'), json.dumps(index, sort_keys=True).encode('utf-8'),
+            ContentType='application/json', CacheControl=export.INDEX_CACHE_CONTROL)
+        logging.info('{} static documents, {} uploaded to {}'.format(
+            len(index), len(uploads), path))
+        self.prune_static(bucket, prefix, existing, index)
+        return index
 
+
+    def prune_static(self, bucket, prefix, existing, index):
+        '''
+        Deletes documents left out of index.json for longer than
+        static_export_grace, tracked in retired.json
+        '''
+        retired_key = join(prefix, export.RETIRED)
+        retired = {}
+        if retired_key in existing:
+            retired = json.loads(self.storage.read(bucket, retired_key).decode())
+        documents = set(key[len(prefix):].lstrip('/') for key in existing
+                        if key.endswith('.json.gz'))
+        pruned, expired = export.prune(
+            documents, set(index.values()), retired, time.time(),
+            self.config.get('static_export_grace', export.DEFAULT_GRACE))
+        if expired:
+            self.storage.delete_many(bucket, [join(prefix, key) for key in expired])
+            logging.info('{} retired static documents deleted'.format(len(expired)))
+        if pruned != retired:
+            self.storage.put(
+                bucket, retired_key, json.dumps(pruned, sort_keys=True).encode('utf-8'),
+                ContentType='application/json')
+
+
+    def backfill_dimension(self, cmd, dimension, refdata_url):
+        '''
+        Runs a backfill statement whose `result(key, added)` CTE lists every
+        missing key and whether it was inserted, and logs a summary with at
+        most `backfill_log_limit` keys of each kind
+        '''
+        limit = self.config.get('backfill_log_limit', 20)
+        report = dedent('''
+        SELECT key, added, total FROM (
+            SELECT key, added,
+                row_number() OVER (PARTITION BY added ORDER BY key) AS n,
+                count(*) OVER (PARTITION BY added) AS total
+            FROM result
+        ) r WHERE n <= {limit}
+        ''').format(limit=limit)
         conn = self.connRDS.connect()
-        cmd = dedent('''
-        SELECT DISTINCT asn, country FROM fact_count fc WHERE NOT EXISTS (
-            SELECT 1 FROM dim_asn da WHERE fc.asn=da.number
-        ) AND asn IS NOT NULL;
-        ''')
-        results = conn.execute(cmd).fetchall()
-        if not len(results):
-            conn.close()
-            return
-        logging.info (dedent('''
-        Warning: New AS numbers in fact table that do not present in asn dimension.
-        Updating dim_asn as follows:
-
-        number    | title   | country
-        ----------+---------+--------'''))
-        inserted = []
-        duplicates = []
-        for asn in results:
-            if asn[0] in inserted:
-                duplicates.append(asn)
-                continue
-            inserted.append(asn[0])
-            cmd = dedent('''
-            INSERT INTO dim_asn VALUES(%d,'unknown','%s')
-            ''' % (asn[0], asn[1] or 'XY'))
-            conn.execute(cmd)
-            space = ' '*(10-len(str(asn[0])))
-            logging.info ('%s%s| unknown | %s' % (asn[0], space, asn[1] or 'XY'))
-        logging.info ('\nThis AS numbers were ignored as they already exists with different country ID:')
-        for num in duplicates:
-            logging.info ('%s | %s'%(num[0], num[1]))
-        logging.info ('\nUpdate reference data for counrtry with new entries here: https://github.com/cybergreen-net/refdata-asn')
+        with conn.begin():
+            rows = conn.execute(cmd + report).fetchall()
         conn.close()
+        totals = {True: 0, False: 0}
+        keys = {True: [], False: []}
+        for key, added, total in rows:
+            totals[added] = total
+            keys[added].append(key)
+        self.metrics.add('rows', totals[True])
+        for added, message in [
+                (True, 'Warning: {total} new ID(s) in fact table that do not present in {dim}, added as unknown: {keys}{more}'),
+                (False, '{total} ID(s) missing from {dim} were skipped: {keys}{more}')]:
+            if totals[added]:
+                logging.info(message.format(
+                    total=totals[added], dim=dimension, keys=', '.join(keys[added]),
+                    more=' ...' if totals[added] > len(keys[added]) else ''))
+        if totals[True]:
+            logging.info('Update reference data with new entries here: {}'.format(refdata_url))
+        return {'added': totals[True], 'skipped': totals[False]}
+
+
+    def update_dim_country_if_entry_does_not_present(self, table='fact_count'):
+        '''
+        Checks if there is new country in fact table that does not present in dim_country
+        and updates if so. Inserts values like so: (country_id, uknown, unknown, unknown, unknown)
+        '''
+        cmd = dedent('''
+        WITH missing AS (
+            SELECT DISTINCT country FROM {table} fc WHERE NOT EXISTS (
+                SELECT 1 FROM dim_country dc WHERE fc.country=dc.id
+            ) AND country IS NOT NULL
+        ), inserted AS (
+            INSERT INTO dim_country
+            SELECT country, 'unknown', 'unknown', 'unknown', 'unknown' FROM missing
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        ), result AS (
+            SELECT m.country AS key, i.id IS NOT NULL AS added
+            FROM missing m LEFT JOIN inserted i ON m.country=i.id
+        )''').format(table=table)
+        return self.backfill_dimension(
+            cmd, 'dim_country', 'https://github.com/cybergreen-net/refdata-country')
+
+
+    def update_dim_asn_if_entry_does_not_present(self, table='fact_count'):
+        '''
+        Checks if there is new ASN in fact table that does not present in dim_asn
+        and updates if so. Inserts values like so: (AS_number, uknown, country_id).
+        An ASN seen with several countries is added once, with the country
+        it has the highest count in (the lowest code on a tie), the other
+        pairs are reported as skipped.
+        '''
+        cmd = dedent('''
+        WITH missing AS (
+            SELECT asn, COALESCE(country, 'XY') AS country, SUM(count) AS seen
+            FROM {table} fc WHERE NOT EXISTS (
+                SELECT 1 FROM dim_asn da WHERE fc.asn=da.number
+            ) AND asn IS NOT NULL
+            GROUP BY 1, 2
+        ), inserted AS (
+            INSERT INTO dim_asn
+            SELECT DISTINCT ON (asn) asn, 'unknown', country
+            FROM missing ORDER BY asn, seen DESC, country
+            ON CONFLICT DO NOTHING
+            RETURNING number, country
+        ), result AS (
+            SELECT m.asn || ' | ' || m.country AS key, i.number IS NOT NULL AS added
+            FROM missing m LEFT JOIN inserted i
+            ON m.asn=i.number AND m.country=i.country
+        )''').format(table=table)
+        return self.backfill_dimension(
+            cmd, 'dim_asn', 'https://github.com/cybergreen-net/refdata-asn')
+
+
+    def add_missing_constraints(self, conn, table, constraints):
+        '''
+        Adds those of the (name, definition) constraints the table does not
+        have yet. Dims kept from a previous load still carry theirs.
+        '''
+        existing = set(row[0] for row in conn.execute(
+            'SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%(table)s)',
+            table=table))
+        missing = [
+            'ADD CONSTRAINT {} {}'.format(name, definition)
+            for name, definition in constraints if name not in existing
+        ]
+        if missing:
+            conn.execute('ALTER TABLE {} {}'.format(table, ', '.join(missing)))
+
+
+    def run_parallel(self, func, items, workers=None):
+        '''
+        Calls func(conn, item) for every item concurrently, each worker on its
+        own pooled connection
+        '''
+        def run(item):
+            conn = self.connRDS.connect()
+            try:
+                return func(conn, item)
+            finally:
+                conn.close()
+        workers = workers or self.config.get('rds_index_workers',
+                                             self.config.get('rds_load_workers', 4))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() re-raises the first failure
+            return list(pool.map(run, items))
 
 
     def create_constraints(self):
+        '''
+        Adds the primary keys, one table per worker, then the foreign keys as
+        NOT VALID, which skips the scan, and validates them in parallel. A
+        validation locks its table against another one, so the FKs of one
+        table are validated by the same worker.
+        '''
+        primary_keys = {}
+        for table, name, definition in PRIMARY_KEY_SPEC:
+            primary_keys.setdefault(table, []).append((name, definition))
+        self.run_parallel(lambda conn, table: self.add_missing_constraints(
+            conn, table, primary_keys[table]), sorted(primary_keys))
+
         conn = self.connRDS.connect()
-        risk_constraints = 'ALTER TABLE dim_risk ADD PRIMARY KEY (id);'
-        country_constraints = 'ALTER TABLE dim_country ADD PRIMARY KEY (id);'
-        asn_constraints = '''
-        ALTER TABLE dim_asn
-        ADD PRIMARY KEY (number),
-        ADD CONSTRAINT fk_country_asn FOREIGN KEY (country) REFERENCES dim_country(id)
-        '''
-        time_constraints = 'ALTER TABLE dim_date ADD PRIMARY KEY (date)'
-        count_counstraints = dedent('''
-        ALTER TABLE fact_count
-        ADD CONSTRAINT fk_count_risk FOREIGN KEY (risk) REFERENCES dim_risk(id),
-        ADD CONSTRAINT fk_count_country FOREIGN KEY (country) REFERENCES dim_country(id),
-        ADD CONSTRAINT fk_count_asn FOREIGN KEY (asn) REFERENCES dim_asn(number),
-        ADD CONSTRAINT fk_count_time FOREIGN KEY (date) REFERENCES dim_date(date);
-        ''')
-        cube_counstraints = dedent('''
-        ALTER TABLE agg_risk_country_{time}
-        ADD CONSTRAINT fk_cube_risk_{time} FOREIGN KEY (risk) REFERENCES dim_risk(id),
-        ADD CONSTRAINT fk_cube_country_{time} FOREIGN KEY (country) REFERENCES dim_country(id)
-        ''')
-        conn.execute(risk_constraints)
-        conn.execute(country_constraints)
-        conn.execute(asn_constraints)
-        conn.execute(time_constraints)
-        conn.execute(count_counstraints)
-        self.create_or_update_cubes(conn, cube_counstraints)
+        foreign_keys = {}
+        for table, name, definition in expand_spec(FOREIGN_KEY_SPEC):
+            foreign_keys.setdefault(table, []).append((name, definition))
+        partitioned = set(table for table in foreign_keys if self.is_partitioned(conn, table))
+        for table in sorted(set(foreign_keys) - partitioned):
+            self.add_missing_constraints(conn, table, [
+                (name, definition + ' NOT VALID') for name, definition in foreign_keys[table]])
+        pending = {}
+        for table, name in conn.execute(dedent('''
+            SELECT conrelid::regclass::text, conname FROM pg_constraint
+            WHERE contype = 'f' AND NOT convalidated
+                AND connamespace = current_schema()::regnamespace
+            ''')):
+            pending.setdefault(table, []).append(name)
         conn.close()
 
+        def validate(conn, table):
+            if table in partitioned:
+                # Postgres has no NOT VALID FKs on partitioned tables
+                self.add_missing_constraints(conn, table, foreign_keys[table])
+            for name in pending.get(table, []):
+                conn.execute('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(table, name))
+        self.run_parallel(validate, sorted(set(pending) | partitioned))
+        logging.info('{} foreign keys validated'.format(sum(len(v) for v in pending.values())))
+
 
     def create_indexes(self):
+        '''
+        Builds the indexes of INDEX_SPEC concurrently, skipping the ones
+        another index makes redundant
+        '''
+        spec = expand_spec(INDEX_SPEC)
+        redundant = redundant_indexes(spec)
+        if redundant:
+            logging.info('Skipping redundant indexes: {}'.format(', '.join(sorted(redundant))))
         conn = self.connRDS.connect()
-        idx_dict = {
-            # Index to speedup /api/v1/count
-            'idx_date_country': 'CREATE INDEX idx_date_country ON fact_count(date DESC, country);',
-            "idx_all": "CREATE INDEX idx_all ON fact_count(date, country, risk, asn);",
-            "idx_all_desc": "CREATE INDEX idx_all_desc ON fact_count(date DESC, country, risk, asn);",
-            "idx_risk": "CREATE INDEX idx_risk ON fact_count(risk);",
-            "idx_asn": "CREATE INDEX idx_asn ON fact_count(asn);",
-            "idx_country": "CREATE INDEX idx_country ON fact_count(country);",
-            "idx_date": "CREATE INDEX idx_date ON fact_count(date);",
-            "idx_all_cube": "CREATE INDEX idx_all_cube_{time} ON agg_risk_country_{time}(date, country, risk);",
-            "idx_all_desc_cube": "CREATE INDEX idx_all_desc_cube_{time} ON agg_risk_country_{time}(date DESC, country, risk);",
-            "idx_risk_cube": "CREATE INDEX idx_risk_cube_{time} ON agg_risk_country_{time}(risk);",
-            "idx_country_cube": "CREATE INDEX idx_country_cube_{time} ON agg_risk_country_{time}(country);",
-            "idx_date_cube": "CREATE INDEX idx_date_cube_{time} ON agg_risk_country_{time}(date);"
-        }
-        for idx in idx_dict:
-            if 'cube' not in idx:
-                conn.execute(idx_dict[idx])
-            else:
-                self.create_or_update_cubes(conn, idx_dict[idx])
+        partitions = {}
+        for table in set(entry[0] for entry in spec):
+            if self.is_partitioned(conn, table):
+                partitions[table] = self.partitions(conn, table)
+        statements = []
+        attach = []
+        for table, name, columns in spec:
+            if name in redundant:
+                continue
+            if table not in partitions:
+                statements.append('CREATE INDEX {} ON {}({})'.format(name, table, columns))
+                continue
+            # the parent index becomes valid once every partition has its own
+            conn.execute('CREATE INDEX {} ON ONLY {}({})'.format(name, table, columns))
+            for partition in partitions[table]:
+                index = '{}_{}'.format(name, partition[len(table) + 1:])
+                # reused partitions still have theirs, see reuse_partitions()
+                statements.append('CREATE INDEX IF NOT EXISTS {} ON {}({})'.format(
+                    index, partition, columns))
+                attach.append('ALTER INDEX {} ATTACH PARTITION {}'.format(name, index))
+        self.run_parallel(lambda conn, statement: conn.execute(statement), statements)
+        for statement in attach:
+            conn.execute(statement)
+        conn.close()
+        logging.info('{} indexes built'.format(len(statements)))
+
+
+    def index_usage_report(self):
+        '''
+        Logs how often the workload used every index of the published tables
+        since they were loaded, from pg_stat_user_indexes, and writes it to
+        index_report_path when set. Runs before the load replaces them.
+        '''
+        conn = self.connRDS.connect()
+        rows = conn.execute(dedent('''
+            SELECT relname, indexrelname, idx_scan, idx_tup_read,
+                pg_relation_size(indexrelid) AS size
+            FROM pg_stat_user_indexes
+            WHERE schemaname = %(schema)s AND relname = ANY(%(tables)s)
+            ORDER BY idx_scan, size DESC
+            '''), schema=self.publish_schema, tables=self.tablenames).fetchall()
         conn.close()
+        report = [
+            {'table': table, 'index': index, 'scans': scans,
+             'tuples_read': tuples, 'bytes': size}
+            for table, index, scans, tuples, size in rows
+        ]
+        unused = [entry['index'] for entry in report if entry['scans'] == 0]
+        logging.info('{} of {} indexes unused since the last load: {}'.format(
+            len(unused), len(report), ', '.join(unused)))
+        if self.config.get('index_report_path'):
+            with open(self.config['index_report_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+def add_periods(start, unit, n):
+    '''
+    Start of the month or year n periods after start
+    '''
+    if unit == 'year':
+        return datetime.date(start.year + n, 1, 1)
+    year, month = divmod(start.year * 12 + start.month - 1 + n, 12)
+    return datetime.date(year, month + 1, 1)
+
+
+def parse_window(window):
+    '''
+    (date_from, date_to) of a ['2016-09-01', '2016-09-08'] load_window
+    '''
+    if not window:
+        return None
+    date_from, date_to = [datetime.datetime.strptime(day, '%Y-%m-%d').date() for day in window]
+    if date_from >= date_to:
+        raise ValueError('load_window must end after it starts, got {}'.format(window))
+    return date_from, date_to
+
+
+def window_buckets(date_from, date_to):
+    '''
+    Returns {time: (start, end)}, the dates of the cube buckets holding the
+    days date_from <= date < date_to
+    '''
+    buckets = {}
+    for time in TIME_GRANULARITIES:
+        start = datetime.date.fromordinal(truncate(date_from.toordinal(), time))
+        last = datetime.date.fromordinal(truncate(date_to.toordinal() - 1, time))
+        if time == 'week':
+            end = last + datetime.timedelta(days=7)
+        elif time == 'quarter':
+            end = add_periods(last, 'month', 3)
+        else:
+            end = add_periods(last, time, 1)
+        buckets[time] = (start, end)
+    return buckets
+
+
+def logentry_layout(config):
+    layout = dict(LOGENTRY_LAYOUT, **config.get('logentry_layout', {}))
+    if layout['ip_encoding'] not in IP_ENCODINGS:
+        raise ValueError('ip_encoding must be one of {}'.format(IP_ENCODINGS))
+    return layout
+
+
+def logentry_columns(ip_encoding):
+    if ip_encoding == 'int':
+        ip = [('ip4', 'INTEGER'), ('ip6', 'VARCHAR(45)'), ('ip_key', 'INTEGER')]
+    else:
+        ip = [('ip', 'VARCHAR(45)')]
+    return [('date', 'TIMESTAMP')] + ip + [
+        ('risk', 'INT'), ('asn', 'BIGINT'), ('country', 'VARCHAR(2)')]
+
+
+def create_logentry_sql(table, layout, redshift=False, exists=''):
+    '''
+    CREATE TABLE of a logentry table, with its distribution key, sort key
+    and column encodings when the database is Redshift
+    '''
+    columns = []
+    for name, sql_type in logentry_columns(layout['ip_encoding']):
+        column = '{} {}'.format(name, sql_type)
+        if redshift and layout['encode'].get(name):
+            column += ' ENCODE {}'.format(layout['encode'][name])
+        columns.append(column)
+    sql = 'CREATE TABLE {}{}(\n{}\n)'.format(exists, table, ',\n'.join(columns))
+    if redshift:
+        distkey = layout['distkey']
+        if distkey == 'ip':
+            distkey = 'ip_key' if layout['ip_encoding'] == 'int' else 'ip'
+        if distkey:
+            sql += '\nDISTKEY({})'.format(distkey)
+        if layout['sortkey']:
+            sql += '\nCOMPOUND SORTKEY({})'.format(', '.join(layout['sortkey']))
+    return sql
+
+
+def manifest_size(entries):
+    return sum(entry.get('meta', {}).get('content_length', 0) for entry in entries)
+
+
+def shard_manifest(entries, shards):
+    '''
+    Splits manifest entries into at most `shards` manifests of about the same
+    total content_length, placing the largest files first into the lightest
+    shard. Without sizes the shards get the same number of files.
+    '''
+    heap = [(0, i, []) for i in range(min(shards, len(entries)))]
+    for entry in sorted(entries, key=lambda e: -e.get('meta', {}).get('content_length', 1)):
+        size, i, shard = heapq.heappop(heap)
+        shard.append(entry)
+        heapq.heappush(heap, (size + entry.get('meta', {}).get('content_length', 1), i, shard))
+    return [{'entries': shard} for _, _, shard in sorted(heap, key=lambda item: item[1])]
+
+
+def expand_spec(spec):
+    '''
+    Returns the spec with every {time} entry repeated for each cube
+    '''
+    expanded = []
+    for entry in spec:
+        if '{time}' in entry[0]:
+            expanded.extend(tuple(part.format(time=time) for part in entry)
+                            for time in TIME_GRANULARITIES)
+        else:
+            expanded.append(entry)
+    return expanded
+
+
+def index_columns(columns):
+    return tuple(
+        (column.split()[0], column.upper().endswith(' DESC'))
+        for column in columns.split(',')
+    )
+
+
+def redundant_indexes(spec):
+    '''
+    Names of the indexes whose columns lead another index of the same table,
+    in the same order or all reversed, since a btree serves both directions
+    '''
+    redundant = set()
+    for table, name, columns in spec:
+        cols = index_columns(columns)
+        flipped = tuple((column, not desc) for column, desc in cols)
+        for other_table, other, other_columns in spec:
+            other_cols = index_columns(other_columns)
+            if (other_table == table and other != name and other not in redundant
+                    and len(other_cols) > len(cols)
+                    and other_cols[:len(cols)] in (cols, flipped)):
+                redundant.add(name)
+                break
+    return redundant
+
+
+def checkpoint_inputs(config, keys):
+    return dict((key, config.get(key)) for key in keys)
+
+
+def run_feed(config, resume=False, from_stage=None):
+    '''
+    Runs the aggregate and load stages of one feed config, with its own
+    connections, temp dirs, checkpoint and metrics
+    '''
+    metrics = RunMetrics()
+    aggregator = Aggregator(config, metrics)
+    loader = LoadToRDS(config, metrics)
+    namespace = get_namespace(config)
+    store = CheckpointStore(config.get('checkpoint_path') or join(
+        tempfile.gettempdir(), 'cybergreen-checkpoint{}.json'.format(
+            '-' + namespace if namespace else '')))
+    pipelines = []
+    for prefix, stage, inputs in [
+            ('aggregate', aggregator, aggregator.checkpoint_inputs()),
+            ('load', loader, checkpoint_inputs(config, loader.checkpoint_keys))]:
+        pipelines.append((
+            prefix, inputs,
+            [(name, metrics.timed('{}.{}'.format(prefix, name), func))
+             for name, func in stage.stages()]
+        ))
+    try:
+        run_stages(pipelines, store, resume=resume, from_stage=from_stage)
+    finally:
+        # failed runs are reported too
+        metrics.write(config.get('metrics_path'), config.get('metrics_textfile'))
+
+
+# paths a feed writes to, no two feeds may share one
+FEED_OWN_KEYS = ['agg_path', 'dest_path', 'checkpoint_path', 'metrics_path', 'metrics_textfile']
+
+
+def feed_configs(config, feeds):
+    '''
+    Returns a config per feed: the keys of each feed over the shared config
+    '''
+    configs = []
+    for feed in feeds:
+        feed_config = dict(config)
+        feed_config.update(feed)
+        configs.append(feed_config)
+    namespaces = [get_namespace(feed_config) for feed_config in configs]
+    if None in namespaces or len(set(namespaces)) != len(namespaces):
+        raise ValueError('Every feed needs its own namespace, got {}'.format(namespaces))
+    for key in FEED_OWN_KEYS:
+        values = [feed_config.get(key) for feed_config in configs if feed_config.get(key)]
+        if len(set(values)) != len(values):
+            raise ValueError('Every feed needs its own {}, got {}'.format(key, values))
+    return configs
+
+
+def run_feeds(configs, workers=2, resume=False, from_stage=None):
+    '''
+    Runs the feeds on a pool of workers threads, so a night takes as long as
+    the slowest feed rather than all of them. Every feed runs to the end even
+    when another one fails. Raises RuntimeError naming the failed feeds.
+    '''
+    def run(config):
+        namespace = config['namespace']
+        logging.info('Feed {} started'.format(namespace))
+        try:
+            run_feed(config, resume=resume, from_stage=from_stage)
+        except Exception:
+            logging.exception('Feed {} failed'.format(namespace))
+            return namespace
+        logging.info('Feed {} done'.format(namespace))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failed = [namespace for namespace in pool.map(run, configs) if namespace]
+    if failed:
+        raise RuntimeError('Feeds failed: {}'.format(', '.join(failed)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Aggregate CyberGreen data and load it to RDS')
+    parser.add_argument('--config', default=rpath('config.json'))
+    parser.add_argument('--resume', action='store_true',
+                        help='skip stages completed by the previous run')
+    parser.add_argument('--from-stage',
+                        help='skip all stages before this one, e.g. load.create_indexes')
+    parser.add_argument('--rollback', action='store_true',
+                        help='republish the previous generation of RDS tables')
+    parser.add_argument('--feeds',
+                        help='JSON list of feed configs over --config, each with a namespace')
+    parser.add_argument('--feed-workers', type=int, default=2,
+                        help='number of feeds run at the same time')
+    parser.add_argument('--window', nargs=2, metavar=('DATE_FROM', 'DATE_TO'),
+                        help='only replace the days DATE_FROM <= date < DATE_TO in RDS')
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    if args.window:
+        config['load_window'] = args.window
+    if args.feeds:
+        configs = feed_configs(config, load_config(args.feeds))
+        if args.rollback:
+            for feed_config in configs:
+                LoadToRDS(feed_config).rollback_publish()
+            return
+        return run_feeds(configs, workers=args.feed_workers,
+                         resume=args.resume, from_stage=args.from_stage)
+    if args.rollback:
+        return LoadToRDS(config).rollback_publish()
+    run_feed(config, resume=args.resume, from_stage=args.from_stage)
 
 
 if __name__ == '__main__':
-    config = load_config(rpath('config.json'))
-    aggregator = Aggregator(config)
-    aggregator.run()
-    loader = LoadToRDS(config)
-    loader.run()
+    main()
@@ -0,0 +1,161 @@
+'''
+Per-stage run metrics.
+
+Every stage records its wall time, the rows it affected, the bytes it read
+from and wrote to S3 and the time spent opening database connections. Calls
+like S3 requests are also timed per operation over the whole run. The report
+is written as JSON and as a Prometheus textfile, for the node_exporter textfile
+collector.
+'''
+from __future__ import print_function
+
+from contextlib import contextmanager
+from os.path import dirname
+from sqlalchemy import event
+
+import threading
+import datetime
+import tempfile
+import logging
+import json
+import time
+import os
+
+COUNTERS = ['rows', 's3_bytes_read', 's3_bytes_written', 'connect_seconds']
+PROMETHEUS_PREFIX = 'cybergreen_stage_'
+OPERATION_PREFIX = 'cybergreen_operation_'
+PROMETHEUS_HELP = {
+    'wall_seconds': 'Wall time of the stage',
+    'rows': 'Rows loaded, inserted or updated by the stage',
+    's3_bytes_read': 'Bytes read from S3 by the stage',
+    's3_bytes_written': 'Bytes written to S3 by the stage',
+    'connect_seconds': 'Time spent opening database connections',
+    'success': '1 if the stage completed, 0 if it failed',
+}
+
+
+class RunMetrics(object):
+    def __init__(self):
+        self.started_at = datetime.datetime.utcnow().isoformat()
+        self.stages = []
+        self.current = None
+        # operation -> count, seconds and max_seconds of its calls
+        self.operations = {}
+        # parallel loads add to the stage from worker threads
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name):
+        record = dict((counter, 0) for counter in COUNTERS)
+        record.update(name=name, status='running')
+        self.stages.append(record)
+        self.current = record
+        start = time.time()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_seconds'] = time.time() - start
+            self.current = None
+            logging.info('{name} {status} in {wall_seconds:.1f}s, {rows} rows, '
+                         '{s3_bytes_read} bytes from s3, {s3_bytes_written} bytes to s3'
+                         .format(**record))
+
+
+    def timed(self, name, func):
+        '''
+        Returns func running as stage name
+        '''
+        def run():
+            with self.stage(name):
+                return func()
+        return run
+
+
+    def add(self, counter, value):
+        '''
+        Adds to a counter of the running stage. Negative values, like the -1
+        rowcount of statements that do not report one, are ignored.
+        '''
+        if value is None or value < 0:
+            return
+        with self.lock:
+            if self.current is not None:
+                self.current[counter] += value
+
+
+    def observe(self, operation, seconds):
+        '''
+        Records the latency of one call of an operation, like s3.get
+        '''
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+    def instrument_engine(self, engine):
+        '''
+        Times every new DBAPI connection the engine opens
+        '''
+        @event.listens_for(engine, 'do_connect')
+        def connect(dialect, conn_rec, cargs, cparams):
+            start = time.time()
+            connection = dialect.connect(*cargs, **cparams)
+            self.add('connect_seconds', time.time() - start)
+            return connection
+        return engine
+
+
+    def report(self):
+        return {'started_at': self.started_at, 'stages': self.stages,
+                'operations': self.operations}
+
+
+    def prometheus(self):
+        lines = []
+        for metric in ['wall_seconds'] + COUNTERS + ['success']:
+            name = PROMETHEUS_PREFIX + metric
+            lines.append('# HELP {} {}'.format(name, PROMETHEUS_HELP[metric]))
+            lines.append('# TYPE {} gauge'.format(name))
+            for record in self.stages:
+                if metric == 'success':
+                    value = 1 if record['status'] == 'ok' else 0
+                else:
+                    value = record.get(metric, 0)
+                lines.append('{}{{stage="{}"}} {}'.format(name, record['name'], value))
+        for metric, help in [('count', 'Calls of the operation'),
+                             ('seconds', 'Total time spent in the operation'),
+                             ('max_seconds', 'Slowest call of the operation')]:
+            name = OPERATION_PREFIX + metric
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            for operation in sorted(self.operations):
+                lines.append('{}{{operation="{}"}} {}'.format(
+                    name, operation, self.operations[operation][metric]))
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, json_path=None, textfile_path=None):
+        if json_path:
+            write_atomic(json_path, json.dumps(self.report(), indent=2))
+            logging.info('Run report written to {}'.format(json_path))
+        if textfile_path:
+            write_atomic(textfile_path, self.prometheus())
+
+
+def write_atomic(path, text):
+    # the textfile collector may read at any time, never show it half a file
+    fd, tmp = tempfile.mkstemp(dir=dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
@@ -0,0 +1,293 @@
+'''
+Reference data (risk, country, asn, ...) datapackage helpers.
+
+Tables are created from each resource's Table Schema and filled from the raw
+CSV, with COPY on Postgres and batched multi-row INSERTs on Redshift, so any
+inventory entry in config.json loads the same way.
+
+Remote descriptors and resources go through RefDataCache, an on-disk store
+keyed by url and content hash that revalidates with ETag / Last-Modified and
+is shared by every stage of the process.
+'''
+from __future__ import print_function
+
+from contextlib import contextmanager
+from os.path import dirname, exists, join, splitext
+
+import threading
+import tempfile
+import hashlib
+import logging
+import requests
+import json
+import csv
+import io
+import os
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+# Table Schema type -> SQL type
+SQL_TYPES = {
+    'string': 'TEXT',
+    'number': 'FLOAT',
+    'integer': 'BIGINT',
+    'boolean': 'BOOLEAN',
+    'date': 'DATE',
+    'datetime': 'TIMESTAMP',
+    'time': 'TIME',
+    'year': 'INT',
+}
+CHUNK_SIZE = 64 * 1024
+# Table Schema default trueValues
+TRUE_VALUES = ['true', 'True', 'TRUE', '1']
+
+
+def is_remote(url):
+    return url.startswith('http://') or url.startswith('https://')
+
+
+class RefDataCache(object):
+    '''
+    Blobs are stored under their sha256, index.json maps every url to its blob
+    and validators. A url is revalidated at most once per process.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.blob_dir = join(cache_dir, 'blobs')
+        if not exists(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        self.index_path = join(cache_dir, 'index.json')
+        self.index = {}
+        if exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.fresh = set()
+        self.lock = threading.Lock()
+
+
+    def blob(self, digest):
+        return join(self.blob_dir, digest)
+
+
+    def fetch(self, url):
+        '''
+        Returns a local path holding the current content of url
+        '''
+        with self.lock:
+            if not is_remote(url):
+                self.index[url] = {'sha256': file_digest(url)}
+                return url
+            entry = self.index.get(url)
+            cached = entry is not None and exists(self.blob(entry['sha256']))
+            if cached and url in self.fresh:
+                return self.blob(entry['sha256'])
+            headers = {}
+            if cached and entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if cached and entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            r = requests.get(url, headers=headers, stream=True)
+            if cached and r.status_code == 304:
+                r.close()
+                logging.info('{} not modified, using cached copy'.format(url))
+            else:
+                r.raise_for_status()
+                entry = {
+                    'sha256': self.store(r),
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }
+                self.index[url] = entry
+                self.save_index()
+                logging.info('{} fetched into cache'.format(url))
+            self.fresh.add(url)
+            return self.blob(entry['sha256'])
+
+
+    def store(self, response):
+        sha = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                sha.update(chunk)
+                f.write(chunk)
+        response.close()
+        digest = sha.hexdigest()
+        os.rename(tmp, self.blob(digest))
+        return digest
+
+
+    def save_index(self):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(tmp, self.index_path)
+
+
+    def digest(self, url):
+        self.fetch(url)
+        return self.index[url]['sha256']
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(cache_dir=None):
+    '''
+    Cache shared by everything in this process that uses the same directory
+    '''
+    cache_dir = cache_dir or join(tempfile.gettempdir(), 'cybergreen-refdata')
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = RefDataCache(cache_dir)
+        return _caches[cache_dir]
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_descriptor(url, cache=None):
+    if cache is not None:
+        url = cache.fetch(url)
+    elif is_remote(url):
+        r = requests.get(url)
+        r.raise_for_status()
+        return r.json()
+    with open(url) as f:
+        return json.load(f)
+
+
+def fingerprint(url, cache):
+    '''
+    Content hash of a datapackage: its descriptor and all of its data
+    '''
+    sha = hashlib.sha256(cache.digest(url).encode())
+    for resource in read_descriptor(url, cache)['resources']:
+        for path in resource_paths(url, resource):
+            sha.update(cache.digest(path).encode())
+    return sha.hexdigest()
+
+
+def resource_paths(url, resource):
+    '''
+    Returns the locations of a resource's data, resolved against the
+    descriptor url
+    '''
+    paths = resource['path']
+    if not isinstance(paths, list):
+        paths = [paths]
+    if is_remote(url):
+        return [urljoin(url, path) for path in paths]
+    return [join(dirname(url), path) for path in paths]
+
+
+def table_name(resource):
+    '''
+    Same naming push_datapackage used, e.g. data/risk.csv -> data__risk___risk
+    '''
+    path = resource['path']
+    if isinstance(path, list):
+        path = path[0]
+    return '{}___{}'.format(splitext(path)[0].replace('/', '__'), resource['name'])
+
+
+def create_table_sql(table, schema, column_types=None):
+    '''
+    CREATE TABLE statement for a Table Schema. column_types overrides the SQL
+    type of individual fields, e.g. {"number": "BIGINT"} for ASNs.
+    '''
+    column_types = column_types or {}
+    columns = [
+        '{} {}'.format(field['name'], column_types.get(
+            field['name'], SQL_TYPES.get(field.get('type', 'string'), 'TEXT')))
+        for field in schema['fields']
+    ]
+    return 'CREATE TABLE {}({})'.format(table, ', '.join(columns))
+
+
+@contextmanager
+def open_resource(path, cache=None):
+    '''
+    Binary stream of a resource's raw CSV, read lazily
+    '''
+    if cache is not None:
+        path = cache.fetch(path)
+    if is_remote(path):
+        r = requests.get(path, stream=True)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        try:
+            yield r.raw
+        finally:
+            r.close()
+    else:
+        with open(path, 'rb') as f:
+            yield f
+
+
+def cast_value(field, value):
+    '''
+    Python value of a CSV cell for its Table Schema field, None when empty
+    '''
+    if value == '' or value is None:
+        return None
+    kind = field.get('type', 'string')
+    if kind == 'integer':
+        return int(value)
+    if kind == 'number':
+        return float(value)
+    if kind == 'boolean':
+        return value in TRUE_VALUES
+    return value
+
+
+def iter_rows(stream, schema=None):
+    '''
+    Yields CSV rows as dicts, empty values as None. With a Table Schema the
+    values are cast to the types of their fields.
+    '''
+    fields = dict((field['name'], field) for field in (schema or {}).get('fields', []))
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    for row in csv.DictReader(text):
+        yield dict((k, cast_value(fields.get(k, {}), v)) for k, v in row.items())
+
+
+def insert_rows(conn, table, columns, rows, batch_size=500):
+    '''
+    Inserts rows with one multi-row INSERT per batch. For Redshift, which has
+    no COPY FROM STDIN. Returns the number of rows inserted.
+    '''
+    inserted = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            inserted += _insert_batch(conn, table, columns, batch)
+            batch = []
+    if batch:
+        inserted += _insert_batch(conn, table, columns, batch)
+    return inserted
+
+
+def _insert_batch(conn, table, columns, batch):
+    params = {}
+    values = []
+    for i, row in enumerate(batch):
+        names = []
+        for j, column in enumerate(columns):
+            name = 'v{}_{}'.format(i, j)
+            params[name] = row.get(column)
+            names.append('%({})s'.format(name))
+        values.append('({})'.format(', '.join(names)))
+    conn.execute('INSERT INTO {} ({}) VALUES {}'.format(
+        table, ', '.join(columns), ', '.join(values)), params)
+    return len(batch)
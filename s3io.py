@@ -0,0 +1,228 @@
+'''
+S3 transfers of the pipeline.
+
+All calls go through one boto3 client per process, whose connection pool is
+sized for the concurrent batch operations (`s3_workers`, default 16). Large
+uploads and copies are multipart with tunable part size and concurrency,
+small objects like manifests are uploaded straight from memory. Objects are
+concatenated on the S3 side with UploadPartCopy. Every call is
+timed per operation into RunMetrics, see metrics.observe(). The local
+filesystem counterpart is storage.LocalStorage.
+
+Config keys: s3_workers, s3_multipart_threshold_mb (default 64),
+s3_multipart_chunksize_mb (default 16), s3_max_concurrency (default 10),
+s3_max_attempts (default 5).
+'''
+from __future__ import print_function
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+import threading
+import boto3
+import os
+
+try:
+    from .storage import Storage
+except (ImportError, SystemError, ValueError):
+    from storage import Storage
+
+MB = 1024 * 1024
+# DeleteObjects takes at most 1000 keys
+DELETE_BATCH_SIZE = 1000
+# every part of a multipart upload but the last is at least 5 MB, at most 5 GB
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+
+_resources = {}
+_lock = threading.Lock()
+
+
+def get_resource(pool_size, max_attempts):
+    '''
+    Returns the S3 resource shared by everything in this process with the
+    same pool settings. Its client is thread safe, the resource is not and is
+    only used to hand out the client.
+    '''
+    with _lock:
+        key = (pool_size, max_attempts)
+        if key not in _resources:
+            _resources[key] = boto3.session.Session().resource('s3', config=Config(
+                max_pool_connections=pool_size,
+                retries={'max_attempts': max_attempts}))
+        return _resources[key]
+
+
+class S3IO(Storage):
+    name = 's3'
+
+    def __init__(self, config, metrics, resource=None):
+        super(S3IO, self).__init__(config, metrics)
+        self.resource = resource or get_resource(
+            self.workers, config.get('s3_max_attempts', 5))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=config.get('s3_multipart_threshold_mb', 64) * MB,
+            multipart_chunksize=config.get('s3_multipart_chunksize_mb', 16) * MB,
+            max_concurrency=config.get('s3_max_concurrency', 10))
+
+
+    @property
+    def client(self):
+        return self.resource.meta.client
+
+
+    def url(self, bucket, key):
+        return 's3://{}/{}'.format(bucket, key)
+
+
+    def get(self, bucket, key):
+        '''
+        Returns the get_object response, its Body streams the content. Only
+        the time to the response headers is recorded.
+        '''
+        with self.timed('get'):
+            obj = self.client.get_object(Bucket=bucket, Key=key)
+        self.metrics.add('s3_bytes_read', obj['ContentLength'])
+        return obj
+
+
+    def read(self, bucket, key):
+        with self.timed('read'):
+            body = self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        self.metrics.add('s3_bytes_read', len(body))
+        return body
+
+
+    def list_sizes(self, locations):
+        '''
+        Returns {(bucket, key): size} of the objects under the (bucket,
+        prefix) locations, listed concurrently
+        '''
+        def list_prefix(location):
+            bucket, prefix = location
+            sizes = {}
+            with self.timed('list'):
+                pages = self.client.get_paginator('list_objects_v2').paginate(
+                    Bucket=bucket, Prefix=prefix)
+                for page in pages:
+                    for obj in page.get('Contents', []):
+                        sizes[(bucket, obj['Key'])] = obj['Size']
+            return sizes
+        sizes = {}
+        for listed in self.map(list_prefix, sorted(set(locations))):
+            sizes.update(listed)
+        return sizes
+
+
+    def put(self, bucket, key, body, **extra):
+        '''
+        Uploads bytes from memory in one request
+        '''
+        with self.timed('put'):
+            self.client.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+        self.metrics.add('s3_bytes_written', len(body))
+
+
+    def upload_file(self, path, bucket, key):
+        with self.timed('upload_file'):
+            self.client.upload_file(path, bucket, key, Config=self.transfer_config)
+        self.metrics.add('s3_bytes_written', os.path.getsize(path))
+
+
+    def copy(self, bucket, key, target_bucket, target_key):
+        with self.timed('copy'):
+            self.client.copy({'Bucket': bucket, 'Key': key}, target_bucket, target_key,
+                             Config=self.transfer_config)
+
+
+    def delete_many(self, bucket, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            with self.timed('delete'):
+                response = self.client.delete_objects(Bucket=bucket, Delete={
+                    'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            if response.get('Errors'):
+                raise IOError('Could not delete {} keys from {}: {}'.format(
+                    len(response['Errors']), bucket, response['Errors'][0]))
+
+
+    def concat_segments(self, parts):
+        '''
+        Splits the (bucket, key, size) parts into the parts of a multipart
+        upload: ('copy', [range]) copied within S3, or ('upload', [ranges])
+        downloaded and sent as one part. Ranges are (bucket, key, start, end)
+        byte ranges, end excluded. Small parts, and the bytes that take a
+        preceding run of them to MIN_PART_SIZE, are downloaded, so every part
+        but the last is large enough and at most about 2 * MIN_PART_SIZE is
+        held in memory.
+        '''
+        segments = []
+        run, run_size = [], 0
+        for part_bucket, part_key, size in parts:
+            pos = 0
+            while pos < size:
+                if run or size - pos < MIN_PART_SIZE:
+                    end = min(size, pos + MIN_PART_SIZE - run_size) if run else size
+                    run.append((part_bucket, part_key, pos, end))
+                    run_size += end - pos
+                    pos = end
+                    if run_size >= MIN_PART_SIZE:
+                        segments.append(('upload', run))
+                        run, run_size = [], 0
+                    continue
+                end = min(size, pos + MAX_PART_SIZE)
+                if size - end < MIN_PART_SIZE:
+                    # a short tail would be left, copy it in this part
+                    end = size if size - pos <= MAX_PART_SIZE else size - MIN_PART_SIZE
+                segments.append(('copy', [(part_bucket, part_key, pos, end)]))
+                pos = end
+        if run:
+            segments.append(('upload', run))
+        return segments
+
+
+    def read_range(self, bucket, key, start, end):
+        with self.timed('read'):
+            body = self.client.get_object(
+                Bucket=bucket, Key=key, Range='bytes={}-{}'.format(start, end - 1))['Body'].read()
+        self.metrics.add('s3_bytes_read', len(body))
+        return body
+
+
+    def concat(self, parts, bucket, key):
+        '''
+        Writes the (bucket, key, size) parts one after the other to key with
+        a multipart upload, copying within S3 what concat_segments() allows
+        '''
+        segments = self.concat_segments([part for part in parts if part[2]])
+        if not segments:
+            return self.put(bucket, key, b'')
+        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+        def send(item):
+            number, (kind, ranges) = item
+            if kind == 'copy':
+                part_bucket, part_key, start, end = ranges[0]
+                with self.timed('upload_part_copy'):
+                    response = self.client.upload_part_copy(
+                        Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                        CopySource={'Bucket': part_bucket, 'Key': part_key},
+                        CopySourceRange='bytes={}-{}'.format(start, end - 1))
+                return {'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+            body = b''.join(self.read_range(*piece) for piece in ranges)
+            with self.timed('upload_part'):
+                response = self.client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body)
+            self.metrics.add('s3_bytes_written', len(body))
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        try:
+            uploaded = self.map(send, list(enumerate(segments, 1)))
+            with self.timed('complete_multipart_upload'):
+                self.client.complete_multipart_upload(
+                    Bucket=bucket, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts': uploaded})
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
@@ -0,0 +1,180 @@
+'''
+Storage backends for the pipeline paths.
+
+source_path, dest_path and agg_path are s3:// or file:// URIs. Both backends
+take (bucket, key) locations: s3io.S3IO for S3, and LocalStorage for a local
+filesystem, where the bucket is empty and the key is an absolute path. That
+lets the local engine, the RDS load and the benchmarks run on local disk
+without AWS. On local disk, copies are hard links and moves are renames, so
+no data is copied.
+'''
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os.path import dirname, exists, getsize, join
+
+import tempfile
+import logging
+import shutil
+import errno
+import time
+import os
+
+
+class Storage(object):
+    '''
+    What the backends share: per operation timing and concurrent batches
+    '''
+    # prefix of the operation names recorded in RunMetrics
+    name = None
+
+    def __init__(self, config, metrics):
+        self.metrics = metrics
+        self.workers = config.get('s3_workers', 16)
+
+
+    @contextmanager
+    def timed(self, operation):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.metrics.observe('{}.{}'.format(self.name, operation), time.time() - start)
+
+
+    def map(self, func, items):
+        '''
+        Runs func on every item on s3_workers threads and returns the results
+        in order. The first failure is re-raised.
+        '''
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(func, items))
+
+
+    def upload_many(self, items):
+        '''
+        Uploads (path, bucket, key) items concurrently
+        '''
+        self.map(lambda item: self.upload_file(*item), items)
+
+
+    def copy_many(self, items):
+        '''
+        Copies (bucket, key, target_bucket, target_key) items concurrently
+        '''
+        self.map(lambda item: self.copy(*item), items)
+        logging.info('{} objects copied'.format(len(items)))
+
+
+    def move(self, bucket, key, target_bucket, target_key):
+        self.copy(bucket, key, target_bucket, target_key)
+        self.delete_many(bucket, [key])
+
+
+def makedirs(path):
+    try:
+        os.makedirs(dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class LocalStorage(Storage):
+    name = 'local'
+
+    def url(self, bucket, key):
+        return 'file://' + key
+
+
+    def get(self, bucket, key):
+        with self.timed('get'):
+            obj = {'Body': open(key, 'rb'), 'ContentLength': getsize(key)}
+        self.metrics.add('s3_bytes_read', obj['ContentLength'])
+        return obj
+
+
+    def read(self, bucket, key):
+        with self.timed('read'):
+            with open(key, 'rb') as f:
+                body = f.read()
+        self.metrics.add('s3_bytes_read', len(body))
+        return body
+
+
+    def list_sizes(self, locations):
+        sizes = {}
+        with self.timed('list'):
+            for bucket, prefix in sorted(set(locations)):
+                if not exists(dirname(prefix)):
+                    continue
+                for directory, _, names in os.walk(dirname(prefix)):
+                    for name in names:
+                        path = join(directory, name)
+                        if path.startswith(prefix):
+                            sizes[(bucket, path)] = getsize(path)
+        return sizes
+
+
+    def put(self, bucket, key, body, **extra):
+        '''
+        Writes bytes to key, readers never see half a file. The S3 headers
+        in extra do not apply.
+        '''
+        makedirs(key)
+        with self.timed('put'):
+            fd, tmp = tempfile.mkstemp(dir=dirname(key))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, key)
+        self.metrics.add('s3_bytes_written', len(body))
+
+
+    def upload_file(self, path, bucket, key):
+        self.copy(None, path, bucket, key)
+        self.metrics.add('s3_bytes_written', getsize(path))
+
+
+    def copy(self, bucket, key, target_bucket, target_key):
+        makedirs(target_key)
+        with self.timed('copy'):
+            if exists(target_key):
+                os.remove(target_key)
+            try:
+                os.link(key, target_key)
+            except OSError:
+                # another filesystem
+                shutil.copyfile(key, target_key)
+
+
+    def move(self, bucket, key, target_bucket, target_key):
+        makedirs(target_key)
+        with self.timed('move'):
+            os.rename(key, target_key)
+
+
+    def delete_many(self, bucket, keys):
+        with self.timed('delete'):
+            for key in keys:
+                try:
+                    os.remove(key)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+
+    def concat(self, parts, bucket, key):
+        '''
+        Writes the (bucket, key, size) parts one after the other to key,
+        readers never see half a file
+        '''
+        makedirs(key)
+        with self.timed('concat'):
+            fd, tmp = tempfile.mkstemp(dir=dirname(key))
+            with os.fdopen(fd, 'wb') as f:
+                for _, part, _ in parts:
+                    with open(part, 'rb') as body:
+                        shutil.copyfileobj(body, f)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, key)
@@ -4,16 +4,29 @@
 import unittest
 import tempfile
 import datetime
+import gzip
+import hashlib
 import json
 import os
+import shutil
 
-from io import StringIO
+from io import BytesIO, StringIO
 from textwrap import dedent
 
+import mock
+
 from psycopg2.extensions import AsIs
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 
-from aggregator.main import Aggregator, LoadToRDS
+from aggregator.benchmarks.generate import generate
+from aggregator.main import (
+    Aggregator, LoadToRDS, INDEX_SPEC, LOGENTRY_LAYOUT, create_logentry_sql, expand_spec,
+    feed_configs, redundant_indexes, run_feeds, shard_manifest, window_buckets)
+from aggregator.factstore import FactStore
+from aggregator.hll import Sketch
+from aggregator.metrics import RunMetrics
+from aggregator.storage import LocalStorage
 
 config = json.loads(open('tests/config.test.json').read())
 
@@ -37,6 +50,13 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         self.aggregator.create_tables()
 
 
+    def load_scan(self, scan_csv, table='logentry'):
+        self.cursor.copy_expert(
+            'COPY {} from STDIN csv header'.format(self.aggregator.load_table(table)),
+            StringIO(scan_csv))
+        self.aggregator.encode_ips(table)
+
+
     def test_all_tables_created(self):
         '''
         Checks if all necessary tables are created for redshift
@@ -103,12 +123,12 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-20T00:00:01+00:00,190.81.134.82,2,12252,US
         2016-09-29T00:00:01+00:00,190.81.135.11,2,12252,US
         ''')
-        self.cursor.copy_expert('COPY logentry from STDIN csv header', StringIO(scan_csv))
+        self.load_scan(scan_csv)
 
         self.aggregator.aggregate()
 
         # count table should have 2 entries - 1 with cout of 2 and other with count of 1
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -129,12 +149,12 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-20T00:00:01+00:00,190.81.135.11,2,12252,US
         2016-09-29T00:00:01+00:00,190.81.135.11,2,12252,US
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
 
         self.aggregator.aggregate()
 
         # count table should have 2 entries with 1 count each
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -156,7 +176,7 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-29T00:00:01+00:00,190.81.134.12,0,12252,US
         2016-09-29T00:00:01+00:00,190.81.134.11,1,12252,US
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
 
         self.aggregator.aggregate()
 
@@ -181,12 +201,12 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-29T00:00:01+00:00,190.81.134.11,2,12252,US
         2016-09-29T00:00:01+00:00,190.81.134.34,2,3333,DE
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
 
         self.aggregator.aggregate()
 
         # count table should have 2 entries - US with count of 2, and DE with count of 1
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -206,12 +226,12 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-29T00:00:01+00:00,190.81.134.11,2,12252,US
         2016-09-29T00:00:01+00:00,190.81.134.34,2,3333,US
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
 
         self.aggregator.aggregate()
 
         # count table should have 2 entries - AS 12252 with count of 2, and AS 3333 with count of 1
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -247,12 +267,12 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-28T00:00:01+00:00,190.81.134.83,1,1225,DE
         2016-09-28T00:00:01+00:00,190.81.134.83,1,1224,DE
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
 
         self.aggregator.aggregate()
 
         # count table should have 2 entries - US with count of 2, and DE with count of 1
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -289,15 +309,14 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-28T00:00:01+00:00,71.3.0.1,4,4444,US
         2016-09-28T00:00:01+00:00,71.3.0.1,5,4444,US
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
         # import ref data
         self.cursor.copy_expert("COPY dim_risk from STDIN csv header", StringIO(self.scan_csv))
 
         self.aggregator.aggregate()
-        self.aggregator.update_amplified_count()
         self.maxDiff = None
 
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -332,15 +351,14 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
         2016-09-28T00:00:01+00:00,71.3.0.3,5,4444,US
         2016-09-28T00:00:01+00:00,71.3.0.4,5,4444,US
         ''')
-        self.cursor.copy_expert("COPY logentry from STDIN csv header", StringIO(scan_csv))
+        self.load_scan(scan_csv)
         # import ref data
         self.cursor.copy_expert("COPY dim_risk from STDIN csv header", StringIO(self.scan_csv))
 
         self.aggregator.aggregate()
-        self.aggregator.update_amplified_count()
         self.maxDiff = None
 
-        self.cursor.execute('select * from count;')
+        self.cursor.execute('select * from count ORDER BY date DESC, country, asn, risk;')
         self.assertEqual(
             self.cursor.fetchall(),
             [
@@ -351,8 +369,247 @@ class RedshiftFunctionsTestCase(unittest.TestCase):
             ])
 
 
+    def test_unknown_risk_not_amplified(self):
+        '''
+        Checks if risks missing from dim_risk keep a zero amplified count
+        '''
+        self.load_scan(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-28T00:00:01+00:00,71.3.0.1,1,4444,US
+        2016-09-28T00:00:01+00:00,71.3.0.1,9,4444,US
+        '''))
+        self.cursor.copy_expert("COPY dim_risk from STDIN csv header", StringIO(self.scan_csv))
+
+        self.aggregator.aggregate()
+
+        self.cursor.execute('select risk, count_amplified from count ORDER BY risk')
+        self.assertEqual(self.cursor.fetchall(), [(1, 41), (9, 0)])
+
+
+    def test_null_factor_not_amplified(self):
+        '''
+        Checks if risks with a NULL amplification factor get a NULL amplified count
+        '''
+        self.load_scan(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-28T00:00:01+00:00,71.3.0.1,3,4444,US
+        '''))
+        self.cursor.copy_expert("COPY dim_risk from STDIN csv header", StringIO(
+            self.scan_csv + '3,,,false,,,,\n'))
+
+        self.aggregator.aggregate()
+
+        self.cursor.execute('select risk, count_amplified from count ORDER BY risk')
+        self.assertEqual(self.cursor.fetchall(), [(3, None)])
+
+
+    def test_duplicate_risk_ids_rejected(self):
+        '''
+        Checks if reference data with a risk id twice is not loaded
+        '''
+        risks = [{'id': 1.0, 'amplification_factor': 41.0},
+                 {'id': 1.0, 'amplification_factor': 2.0}]
+        with mock.patch.object(self.aggregator, 'risk_data', return_value=risks):
+            with self.assertRaises(ValueError):
+                self.aggregator.load_ref_data()
+
+
+    def test_incremental_tables_keep_history(self):
+        '''
+        Checks if logentry and count survive table creation in incremental mode
+        '''
+        scan_csv = dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-20T00:00:01+00:00,71.3.0.1,2,12252,US
+        ''')
+        self.load_scan(scan_csv)
+        self.cursor.connection.commit()
+
+        self.aggregator.create_tables(keep_history=True)
+
+        self.cursor.execute('SELECT count(*) FROM logentry')
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+        for table in ['logentry_stage', 'ingested_files']:
+            self.cursor.execute(
+                'select exists(select * from information_schema.tables where table_name=%(table)s)',
+                {'table': table})
+            self.assertEqual(self.cursor.fetchone()[0], True)
+
+
+    def test_aggregate_only_new_days(self):
+        '''
+        Checks if only days present in the staging table are re-aggregated
+        '''
+        # GIVEN one day already aggregated and a new file adding an IP to another day
+        self.aggregator.create_tables(keep_history=True)
+        history_csv = dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-20T00:00:01+00:00,71.3.0.1,2,12252,US
+        2016-09-29T00:00:01+00:00,71.3.0.1,2,12252,US
+        ''')
+        new_csv = dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-29T00:00:01+00:00,71.3.0.2,2,12252,US
+        ''')
+        self.load_scan(history_csv)
+        self.load_scan(new_csv, 'logentry_stage')
+        # stale count for 2016-09-20 must not be touched
+        self.cursor.execute(dedent('''
+            INSERT INTO count VALUES
+                ('2016-09-20', 2, 'US', 12252, 7, 0),
+                ('2016-09-29', 2, 'US', 12252, 1, 0)
+            '''))
+        self.cursor.connection.commit()
+
+        self.aggregator.merge_stage()
+        self.aggregator.aggregate(only_new_days=True)
+
+        self.cursor.execute('select * from count ORDER BY date;')
+        self.assertEqual(
+            self.cursor.fetchall(),
+            [
+                (datetime.datetime(2016, 9, 20, 0, 0), 2, 'US', 12252, 7, 0.0),
+                (datetime.datetime(2016, 9, 29, 0, 0), 2, 'US', 12252, 2, 0.0)
+            ])
+        # AND the scan is bounded by literal dates the sort key can prune on
+        conn = self.aggregator.connRedshift.connect()
+        self.assertEqual(self.aggregator.new_days(conn)[1], {
+            'new_from': datetime.datetime(2016, 9, 29), 'new_to': datetime.datetime(2016, 9, 30)})
+        conn.close()
+
+
+    def test_failed_merge_rolls_back(self):
+        '''
+        Checks if a run failing after the merge leaves logentry and
+        ingested_files as they were, so the retry does not count twice
+        '''
+        self.aggregator.create_tables(keep_history=True)
+        new_csv = dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-29T00:00:01+00:00,71.3.0.2,2,12252,US
+        ''')
+        self.load_scan(new_csv, 'logentry_stage')
+        self.cursor.connection.commit()
+        entries = [{'url': 's3://test.bucket/scan.20160929.csv.gz', 'mandatory': True}]
+
+        with mock.patch.object(self.aggregator, 'aggregate', side_effect=OperationalError('', {}, None)):
+            self.assertRaises(OperationalError, self.aggregator.merge_new_files, entries)
+        self.cursor.execute('SELECT count(*) FROM logentry')
+        self.assertEqual(self.cursor.fetchone()[0], 0)
+        self.assertEqual(self.aggregator.ingested_files(), set())
+
+        self.aggregator.merge_new_files(entries)
+        self.cursor.execute('SELECT count(*) FROM logentry')
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+        self.cursor.execute('SELECT sum(count) FROM count')
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+        self.assertEqual(self.aggregator.ingested_files(), set([entries[0]['url']]))
+        self.cursor.connection.commit()
+
+
+    def test_record_ingested_files(self):
+        '''
+        Checks if ingested manifest entries are remembered between runs
+        '''
+        self.aggregator.create_tables(keep_history=True)
+        entries = [
+            {'url': 's3://test.bucket/test/key/ntp-scan/ntp-scan.20000101.csv.gz', 'mandatory': True},
+            {'url': 's3://test.bucket/test/key/dns-scan/dns-scan.20000101.csv.gz', 'mandatory': True}
+        ]
+        self.aggregator.record_ingested(entries)
+        self.assertEqual(
+            self.aggregator.ingested_files(),
+            set(entry['url'] for entry in entries))
+
+
+    def test_ip_encoding(self):
+        '''
+        Checks if IPv4 addresses are stored as integers and anything else as
+        text, and both are counted once per day
+        '''
+        scan_csv = dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-20T00:00:01+00:00,0.0.0.0,2,12252,US
+        2016-09-20T00:00:01+00:00,255.255.255.255,2,12252,US
+        2016-09-20T00:00:01+00:00,2001:db8::1,2,12252,US
+        2016-09-20T00:00:02+00:00,2001:db8::1,2,12252,US
+        2016-09-20T00:00:01+00:00,300.1.1.1,2,12252,US
+        ''')
+        self.load_scan(scan_csv)
+        self.cursor.execute('SELECT ip4, ip6, ip_key FROM logentry ORDER BY ip4, ip6')
+        ipv6_key = int(hashlib.md5(b'2001:db8::1').hexdigest()[:7], 16)
+        self.assertEqual(self.cursor.fetchall(), [
+            (-2147483648, None, -2147483648), (2147483647, None, 2147483647),
+            (None, '2001:db8::1', ipv6_key), (None, '2001:db8::1', ipv6_key),
+            (None, '300.1.1.1', int(hashlib.md5(b'300.1.1.1').hexdigest()[:7], 16))])
+        self.aggregator.aggregate()
+        self.cursor.execute('SELECT count FROM count')
+        self.assertEqual(self.cursor.fetchall(), [(4,)])
+
+
+    def test_text_ip_encoding(self):
+        aggregator = Aggregator(config=dict(config, logentry_layout={'ip_encoding': 'text'}))
+        aggregator.create_tables()
+        self.assertEqual(aggregator.load_table('logentry'), 'logentry')
+        self.cursor.copy_expert('COPY logentry from STDIN csv header', StringIO(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-20T00:00:01+00:00,71.3.0.1,2,12252,US
+        2016-09-20T00:00:01+00:00,71.3.0.2,2,12252,US
+        ''')))
+        aggregator.aggregate()
+        self.cursor.execute('SELECT count FROM count')
+        self.assertEqual(self.cursor.fetchall(), [(2,)])
+
+
+    def test_redshift_layout(self):
+        sql = create_logentry_sql('logentry', LOGENTRY_LAYOUT, redshift=True)
+        self.assertIn('ip4 INTEGER ENCODE az64', sql)
+        self.assertIn('country VARCHAR(2) ENCODE bytedict', sql)
+        self.assertTrue(sql.endswith('DISTKEY(ip_key)\nCOMPOUND SORTKEY(date, risk, asn, country)'))
+        self.assertNotIn('ENCODE', create_logentry_sql('logentry', LOGENTRY_LAYOUT))
+
+
+    def test_namespaced_tables(self):
+        '''
+        Checks if feeds with their own namespace work on separate tables
+        '''
+        self.assertRaises(ValueError, Aggregator, dict(config, namespace='Feed-A'))
+        self.load_scan('ts,ip,risk_id,asn,cc\n2016-09-28T00:00:01+00:00,71.3.0.1,1,4444,US\n')
+        feed = Aggregator(dict(config, namespace='feed_a'))
+        try:
+            feed.create_tables()
+            conn = feed.connRedshift.connect()
+            self.assertEqual(conn.execute('SELECT count(*) FROM logentry').scalar(), 0)
+            self.assertEqual(conn.execute('SELECT current_schema()').scalar(), 'feed_a')
+            conn.close()
+            self.cursor.execute('select count(*) from public.logentry')
+            self.assertEqual(self.cursor.fetchone()[0], 1)
+        finally:
+            self.cursor.connection.commit()
+            feed.connRedshift.execute('DROP SCHEMA IF EXISTS feed_a CASCADE')
+
+
+    def test_sketch_registers(self):
+        '''
+        Checks if sketches built in SQL match the ones built in Python
+        '''
+        ips = ['71.3.0.{}'.format(i) for i in range(40)]
+        scan_csv = 'ts,ip,risk_id,asn,cc\n' + ''.join(
+            '2016-09-28T00:00:01+00:00,{},1,4444,US\n'.format(ip) for ip in ips)
+        self.load_scan(scan_csv)
+
+        self.aggregator.aggregate()
+        self.aggregator.build_sketches()
+
+        self.cursor.execute('select reg, rank from count_sketch')
+        self.assertEqual(dict(self.cursor.fetchall()), Sketch().update(ips).registers)
+
+
     def tearDown(self):
-        self.aggregator.drop_tables(self.aggregator.connRedshift, ['logentry', 'count', 'dim_risk'])
+        self.aggregator.drop_tables(self.aggregator.connRedshift, [
+            'logentry', 'count', 'dim_risk', 'logentry_stage', 'ingested_files',
+            'count_sketch', 'logentry_load', 'logentry_stage_load'
+        ])
 
 
 
@@ -361,7 +618,8 @@ class RDSFunctionsTestCase(unittest.TestCase):
 
     def setUp(self):
         self.loader = LoadToRDS(config=config)
-        self.cursor = self.loader.connRDS.raw_connection().cursor()
+        self.conn = self.loader.connRDS.raw_connection()
+        self.cursor = self.conn.cursor()
         self.tablenames = [
             'fact_count', 'agg_risk_country_week',
             'agg_risk_country_month', 'agg_risk_country_quarter',
@@ -416,6 +674,49 @@ class RDSFunctionsTestCase(unittest.TestCase):
         self.assertEqual(self.cursor.fetchone(), (111111.0, u'Test title', u'AA'))
 
 
+    def test_unchanged_refdata_not_reloaded(self):
+        '''
+        Checks if dims are kept when their datapackages did not change
+        '''
+        self.loader.create_tables()
+        self.loader.create_constraints()
+        self.loader.load_ref_data_rds()
+        self.cursor.execute("SELECT to_regclass('data__risk___risk')")
+        self.assertEqual(self.cursor.fetchone()[0], None)
+        self.loader.create_tables()
+        self.cursor.execute('SELECT count(*) FROM dim_risk')
+        self.assertEqual(self.cursor.fetchone()[0], 2)
+        self.conn.commit()
+        # dim primary keys survive from the previous load
+        self.loader.create_constraints()
+
+
+    def test_backfill_unknown_dimensions(self):
+        '''
+        Checks if unknown countries and ASNs are added once and the rest reported
+        '''
+        self.loader.create_tables()
+        self.loader.connRDS.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-09-03',0,'AA',111111,1,30.8),
+                ('2016-09-03',0,'QQ',222222,1,30.8),
+                ('2016-09-03',0,'AA',222222,1,30.8),
+                ('2016-09-04',0,'QQ',222222,5,30.8),
+                ('2016-09-03',0,NULL,333333,1,30.8)
+            """))
+        self.assertEqual(self.loader.update_dim_country_if_entry_does_not_present(),
+                         {'added': 1, 'skipped': 0})
+        self.assertEqual(self.loader.update_dim_asn_if_entry_does_not_present(),
+                         {'added': 2, 'skipped': 1})
+        self.assertEqual(self.loader.connRDS.execute(
+            "SELECT country FROM dim_asn WHERE number=222222").fetchall(), [('QQ',)])
+        self.assertEqual(self.loader.connRDS.execute(
+            "SELECT country FROM dim_asn WHERE number=333333").scalar(), 'XY')
+        self.assertEqual(self.loader.update_dim_asn_if_entry_does_not_present(),
+                         {'added': 0, 'skipped': 0})
+
+
     def test_rds_tables_created(self):
         '''
         Checks if all rds tables are created and temptables renamed
@@ -455,6 +756,107 @@ class RDSFunctionsTestCase(unittest.TestCase):
             self.assertNotEqual(self.cursor.fetchone(), None, msg=message.format(table=table))
 
 
+    def test_cubes_match_cube_queries(self):
+        '''
+        Checks if cubes derived from the daily rollup equal a GROUP BY CUBE
+        per granularity with NULL risk / country shown as 100 / 'T'
+        '''
+        self.loader.create_tables()
+        self.loader.connRDS.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-09-03',0,'AA',111111,1,30.8),
+                ('2016-09-04',0,'AA',222222,5,3),
+                ('2016-09-04',1,'ZZ',999999,33,1353),
+                ('2016-11-13',0,'ZZ',999999,4,25.2),
+                ('2016-11-13',0,NULL,999999,2,1),
+                ('2014-10-03',NULL,'AA',111111,2,1113.8)
+            """))
+        self.loader.populate_tables()
+        for time in ['week', 'month', 'quarter', 'year']:
+            expected = self.loader.connRDS.execute(dedent("""
+                SELECT date_trunc('{time}', date)::date, COALESCE(risk, 100), COALESCE(country, 'T'),
+                    SUM(count)::bigint, round(SUM(count_amplified)::numeric, 6)
+                FROM fact_count GROUP BY CUBE(date_trunc('{time}', date), country, risk)
+                ORDER BY 1, 2, 3, 4, 5""").format(time=time)).fetchall()
+            actual = self.loader.connRDS.execute(dedent("""
+                SELECT date, risk, country, count, round(count_amplified::numeric, 6)
+                FROM agg_risk_country_{time} ORDER BY 1, 2, 3, 4, 5""").format(time=time)).fetchall()
+            self.assertEqual(actual, expected)
+            store = FactStore.from_table(self.loader.connRDS)
+            self.assertEqual(
+                [(row[0], row[1], row[2], row[3], round(row[4], 6)) for row in store.cube(time)],
+                [(row[0], row[1], row[2], row[3], float(row[4])) for row in actual])
+        self.assertEqual(self.loader.connRDS.execute('SELECT count(*) FROM dim_date').scalar(), 4)
+
+
+    def test_blue_green_publish(self):
+        '''
+        Checks if a staged load replaces the published tables in one swap and
+        can be rolled back
+        '''
+        self.loader.create_tables()
+        self.loader.connRDS.execute("INSERT INTO fact_count VALUES ('2016-09-03',0,'AA',111111,1,30.8)")
+        staged = LoadToRDS(config=dict(config, blue_green=True))
+        staged.prepare_staging()
+        staged.load_ref_data_rds()
+        staged.create_tables()
+        staged.connRDS.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-09-03',0,'AA',111111,1,30.8),
+                ('2016-11-13',0,'ZZ',999999,33,1353)
+            """))
+        staged.populate_tables()
+        staged.create_constraints()
+        # the published table is untouched while staging is loaded
+        count = 'SELECT count(*) FROM public.fact_count'
+        self.assertEqual(self.loader.connRDS.execute(count).scalar(), 1)
+
+        staged.publish()
+        self.assertEqual(self.loader.connRDS.execute(count).scalar(), 2)
+        # the reference data versions stay with the published schema
+        self.assertEqual(self.loader.connRDS.execute(
+            "SELECT to_regclass('public.refdata_version') IS NOT NULL").scalar(), True)
+        self.assertEqual(self.loader.connRDS.execute(
+            "SELECT to_regclass('previous.refdata_version')").scalar(), None)
+        self.assertEqual(self.loader.connRDS.execute(
+            'SELECT count(*) FROM previous.fact_count').scalar(), 1)
+        self.assertTrue(self.loader.connRDS.execute(
+            "SELECT to_regclass('public.agg_risk_country_week') IS NOT NULL").scalar())
+
+        staged.rollback_publish()
+        self.assertEqual(self.loader.connRDS.execute(count).scalar(), 1)
+        staged.connRDS.dispose()
+        self.loader.connRDS.execute('DROP SCHEMA staging CASCADE')
+        self.loader.connRDS.execute('DROP SCHEMA previous CASCADE')
+
+
+    def test_blue_green_keeps_unchanged_refdata(self):
+        '''
+        Checks if a second blue/green load skips reference data that did not
+        change and still publishes its dims
+        '''
+        self.loader.connRDS.execute('DROP TABLE IF EXISTS public.refdata_version')
+        for run in range(2):
+            staged = LoadToRDS(config=dict(config, blue_green=True))
+            staged.prepare_staging()
+            staged.load_ref_data_rds()
+            reloaded = staged.connRDS.execute(
+                "SELECT to_regclass('staging.data__risk___risk') IS NOT NULL").scalar()
+            self.assertEqual(reloaded, run == 0)
+            staged.create_tables()
+            staged.create_constraints()
+            staged.publish()
+            self.assertEqual(self.loader.connRDS.execute(
+                'SELECT count(*) FROM public.dim_risk').scalar(), 2)
+            self.assertEqual(self.loader.connRDS.execute(
+                'SELECT count(*) FROM public.refdata_version').scalar(), 3)
+            staged.connRDS.dispose()
+        self.loader.connRDS.execute('DROP SCHEMA staging CASCADE')
+        self.loader.connRDS.execute('DROP SCHEMA previous CASCADE')
+
+
     def test_create_constraints(self):
         '''
         Checks if all constraints are created
@@ -487,7 +889,364 @@ class RDSFunctionsTestCase(unittest.TestCase):
 
         # TODO: check indexes created
 
+
+    def test_parallel_indexes_and_constraints(self):
+        '''
+        Checks if FKs end up validated and only non-redundant indexes are built
+        '''
+        self.loader.create_tables()
+        self.loader.connRDS.execute(
+            "INSERT INTO fact_count VALUES ('2016-09-03',0,'AA',111111,1,30.8)")
+        self.loader.populate_tables()
+        self.loader.create_constraints()
+        self.loader.create_indexes()
+        self.assertEqual(self.loader.connRDS.execute(
+            "SELECT count(*) FROM pg_constraint WHERE contype = 'f' AND NOT convalidated").scalar(), 0)
+        indexes = set(row[0] for row in self.loader.connRDS.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'fact_count'"))
+        self.assertEqual(indexes, set(['idx_all', 'idx_all_desc', 'idx_risk', 'idx_asn', 'idx_country']))
+        report = self.loader.index_usage_report()
+        self.assertIn('idx_all_cube_week', [entry['index'] for entry in report])
+
+
+    def test_partitioned_load(self):
+        '''
+        Checks if fact_count and the cubes are loaded into monthly partitions
+        with pruning, per partition indexes and cheap retention
+        '''
+        self.loader = LoadToRDS(config=dict(config, partition_by='month', partition_retention=1))
+        body = BytesIO(self.counts.lstrip().replace(',0,', ' 00:00:00,0,').encode())
+        self.loader.config['agg_path'] = 's3://test.bucket/agg'
+        self.loader.conns3 = mock.MagicMock()
+        self.loader.conns3.meta.client.get_object.return_value = {
+            'Body': body, 'ContentLength': len(body.getvalue())}
+        self.loader.create_tables()
+        self.loader.download_and_load()
+        self.loader.populate_tables()
+        self.loader.create_constraints()
+        self.loader.create_indexes()
+
+        conn = self.loader.connRDS
+        self.assertEqual(self.loader.partitions(conn, 'fact_count'), [
+            'fact_count_default', 'fact_count_p20141001', 'fact_count_p20160501',
+            'fact_count_p20160901', 'fact_count_p20161101'])
+        self.assertEqual(conn.execute('SELECT count(*) FROM fact_count_default').scalar(), 0)
+        self.assertEqual(conn.execute('SELECT sum(count) FROM fact_count').scalar(), 50)
+        self.assertEqual(conn.execute(
+            'SELECT count(*) FROM agg_risk_country_year_default WHERE date IS NULL').scalar(),
+            conn.execute('SELECT count(*) FROM agg_risk_country_year').scalar() -
+            conn.execute('SELECT count(*) FROM agg_risk_country_year WHERE date IS NOT NULL').scalar())
+        plan = '\n'.join(row[0] for row in conn.execute(
+            "EXPLAIN SELECT * FROM fact_count WHERE date >= '2016-11-01'"))
+        self.assertIn('fact_count_p20161101', plan)
+        self.assertNotIn('fact_count_p20160901', plan)
+        self.assertTrue(conn.execute(
+            "SELECT bool_and(indisvalid) FROM pg_index WHERE left(indexrelid::regclass::text, 4) = 'idx_'").scalar())
+
+        self.loader.detach_old_partitions()
+        self.assertEqual(self.loader.partitions(conn, 'fact_count'), ['fact_count_default'])
+        self.assertEqual(conn.execute('SELECT count(*) FROM fact_count').scalar(), 0)
+        self.assertEqual(conn.execute('SELECT count(*) FROM dim_date').scalar(), 0)
+        # retention applies before the cubes are built
+        stages = [name for name, _ in self.loader.stages()]
+        self.assertLess(stages.index('detach_old_partitions'), stages.index('populate_tables'))
+
+
+    def test_partitioned_reload_reuses_partitions(self):
+        '''
+        Checks if a second partitioned load keeps the partitions whose rows
+        did not change, with their indexes, and rebuilds the others
+        '''
+        self.loader = LoadToRDS(config=dict(config, partition_by='month'))
+        self.loader.config['agg_path'] = 's3://test.bucket/agg'
+        self.loader.conns3 = mock.MagicMock()
+        conn = self.loader.connRDS
+        oid = "SELECT to_regclass('{}')::oid"
+        oids = {}
+        for run, counts in enumerate([self.counts, self.counts.replace(
+                '2016-09-03,0,AA,111111,1,', '2016-09-03,0,AA,111111,2,')]):
+            body = BytesIO(counts.lstrip().replace(',0,', ' 00:00:00,0,').encode())
+            self.loader.conns3.meta.client.get_object.return_value = {
+                'Body': body, 'ContentLength': len(body.getvalue())}
+            self.loader.create_tables()
+            self.loader.download_and_load()
+            self.loader.populate_tables()
+            self.loader.create_constraints()
+            self.loader.create_indexes()
+            oids[run] = dict((partition, conn.execute(oid.format(partition)).scalar())
+                             for partition in self.loader.partitions(conn, 'fact_count'))
+
+        self.assertEqual(sorted(oids[0]), sorted(oids[1]))
+        self.assertEqual(
+            sorted(p for p in oids[0] if oids[0][p] == oids[1][p]),
+            ['fact_count_p20141001', 'fact_count_p20160501', 'fact_count_p20161101'])
+        self.assertEqual(conn.execute('SELECT sum(count) FROM fact_count').scalar(), 51)
+        self.assertEqual(self.loader.kept_partitions(conn, 'fact_count'), [])
+        self.assertTrue(conn.execute(
+            "SELECT bool_and(indisvalid) FROM pg_index WHERE left(indexrelid::regclass::text, 4) = 'idx_'").scalar())
+        self.assertEqual(conn.execute(dedent("""
+            SELECT count(*) FROM pg_inherits
+            WHERE inhrelid = to_regclass('idx_all_p20141001')""")).scalar(), 1)
+
+
+    def test_download_and_load_parallel(self):
+        '''
+        Checks if all part files listed in the UNLOAD manifest are loaded
+        '''
+        parts = {
+            'agg/count_part_0000_part_00': '2016-09-03 00:00:00,0,AA,111111,1,30.8\n',
+            'agg/count_part_0001_part_00': dedent('''\
+                2016-11-13 00:00:00,0,ZZ,999999,33,1353
+                2016-05-22 00:00:00,0,AA,111111,10,410
+                ''')
+        }
+        parts['agg/count_part_manifest'] = json.dumps({'entries': [
+            {'url': 's3://test.bucket/' + key} for key in sorted(parts)]})
+
+        def get_object(Bucket, Key):
+            return {'Body': BytesIO(parts[Key].encode()), 'ContentLength': len(parts[Key])}
+
+        self.loader.config = dict(config, agg_path='s3://test.bucket/agg', parallel_unload=True)
+        self.loader.conns3 = mock.MagicMock()
+        self.loader.conns3.meta.client.get_object.side_effect = get_object
+        self.loader.create_tables()
+
+        self.loader.download_and_load()
+
+        self.assertEqual(
+            [c[1]['Key'] for c in self.loader.conns3.meta.client.get_object.call_args_list][0],
+            'agg/count_part_manifest')
+        self.assertEqual(self.loader.metrics.operations['s3.get']['count'], 2)
+        self.assertEqual(
+            self.loader.connRDS.execute('SELECT sum(count) FROM fact_count').scalar(), 44)
+
+
+    def test_download_and_load(self):
+        '''
+        Checks if count.csv is streamed from s3 into fact_count and the
+        stream closed
+        '''
+        body = BytesIO(self.counts.lstrip().replace(',0,', ' 00:00:00,0,').encode())
+        size = len(body.getvalue())
+        self.loader.config = dict(config, agg_path='s3://test.bucket/agg')
+        self.loader.conns3 = mock.MagicMock()
+        self.loader.conns3.meta.client.get_object.return_value = {
+            'Body': body, 'ContentLength': size}
+        self.loader.create_tables()
+
+        with self.loader.metrics.stage('load.download_and_load') as stage:
+            self.loader.download_and_load()
+
+        self.loader.conns3.meta.client.get_object.assert_called_with(
+            Bucket='test.bucket', Key='agg/count.csv')
+        self.assertEqual(
+            self.loader.connRDS.execute('SELECT count(*) FROM fact_count').scalar(), 5)
+        self.assertEqual(stage['rows'], 5)
+        self.assertEqual(stage['s3_bytes_read'], size)
+        self.assertTrue(body.closed)
+
+
+    def test_load_window(self):
+        '''
+        Checks if a window reload replaces its days and the cube buckets
+        holding them the way a full load would
+        '''
+        self.assertEqual(window_buckets(datetime.date(2016, 9, 1), datetime.date(2016, 9, 8)), {
+            'week': (datetime.date(2016, 8, 29), datetime.date(2016, 9, 12)),
+            'month': (datetime.date(2016, 9, 1), datetime.date(2016, 10, 1)),
+            'quarter': (datetime.date(2016, 7, 1), datetime.date(2016, 10, 1)),
+            'year': (datetime.date(2016, 1, 1), datetime.date(2017, 1, 1))})
+        self.loader.create_tables()
+        self.loader.connRDS.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-08-31',0,'AA',111111,7,7),
+                ('2016-09-03',0,'AA',111111,1,30.8),
+                ('2016-09-04',0,'ZZ',999999,5,3),
+                ('2016-09-06',0,NULL,999999,6,6),
+                ('2016-11-13',0,'ZZ',999999,33,1353),
+                ('2014-10-03',0,'AA',111111,2,1113.8)
+            """))
+        self.loader.populate_tables()
+        self.loader.create_constraints()
+        all_time = dedent("""
+            SELECT risk, country, count FROM agg_risk_country_year
+            WHERE date IS NULL AND risk IN (0, 100) AND country = 'T' ORDER BY 1, 3""")
+
+        # GIVEN corrected counts for the first week of September, a new
+        # country among them, and a row outside the window
+        body = BytesIO(dedent('''\
+            2016-09-03 00:00:00,0,AA,111111,2,61.6
+            2016-09-05 00:00:00,0,QQ,999999,4,4
+            2016-09-06 00:00:00,0,,999999,6,6
+            2016-11-13 00:00:00,0,ZZ,999999,1,1
+            ''').encode())
+        self.loader = LoadToRDS(config=dict(
+            config, agg_path='s3://test.bucket/agg', load_window=['2016-09-01', '2016-09-08']))
+        self.loader.conns3 = mock.MagicMock()
+        self.loader.conns3.meta.client.get_object.return_value = {
+            'Body': body, 'ContentLength': len(body.getvalue())}
+        self.assertEqual([name for name, _ in self.loader.stages()], ['load_window', 'cleanup'])
+
+        with self.loader.metrics.stage('load.load_window') as stage:
+            self.loader.load_window()
+
+        # THEN only the 3 rows of the window were copied in, then inserted
+        # into fact_count, plus one new day in dim_date
+        self.assertEqual(stage['rows'], 3 + 3 + 1)
+        conn = self.loader.connRDS
+        self.assertEqual(conn.execute(
+            'SELECT date, country, count FROM fact_count ORDER BY date').fetchall(), [
+                (datetime.date(2014, 10, 3), 'AA', 2), (datetime.date(2016, 8, 31), 'AA', 7),
+                (datetime.date(2016, 9, 3), 'AA', 2), (datetime.date(2016, 9, 5), 'QQ', 4),
+                (datetime.date(2016, 9, 6), None, 6), (datetime.date(2016, 11, 13), 'ZZ', 33)])
+        self.assertEqual(
+            [row[0] for row in conn.execute('SELECT date FROM dim_date ORDER BY date')],
+            [datetime.date(2014, 10, 3), datetime.date(2016, 8, 31), datetime.date(2016, 9, 3),
+             datetime.date(2016, 9, 5), datetime.date(2016, 9, 6), datetime.date(2016, 11, 13)])
+        # THEN the NULL country facts stay apart from the rollup rows
+        self.assertEqual(conn.execute(all_time).fetchall(), [
+            (0, 'T', 6), (0, 'T', 54), (100, 'T', 6), (100, 'T', 54)])
+        self.assertEqual(conn.execute(all_time.replace('count FROM', 'grp FROM')).fetchall(), [
+            (0, 'T', 0), (0, 'T', 1), (100, 'T', 2), (100, 'T', 3)])
+        for time in ['week', 'month', 'quarter', 'year']:
+            expected = conn.execute(dedent("""
+                SELECT date_trunc('{time}', date)::date, COALESCE(risk, 100), COALESCE(country, 'T'),
+                    SUM(count)::bigint, round(SUM(count_amplified)::numeric, 6)
+                FROM fact_count GROUP BY CUBE(date_trunc('{time}', date), country, risk)
+                ORDER BY 1, 2, 3, 4, 5""").format(time=time)).fetchall()
+            actual = conn.execute(dedent("""
+                SELECT date, risk, country, count, round(count_amplified::numeric, 6)
+                FROM agg_risk_country_{time} ORDER BY 1, 2, 3, 4, 5""").format(time=time)).fetchall()
+            self.assertEqual(actual, expected)
+        self.assertEqual(conn.execute("SELECT to_regclass('fact_count_window')").scalar(), None)
+
+
+    def test_populate_distinct_counts(self):
+        '''
+        Checks if period distinct counts merge daily sketches instead of summing
+        '''
+        # GIVEN the same 3 IPs seen on two days of one week, plus one more IP on day two
+        day1 = Sketch().update(['71.3.0.1', '71.3.0.2', '71.3.0.3'])
+        day2 = Sketch().update(['71.3.0.1', '71.3.0.2', '71.3.0.3', '71.3.0.4'])
+        self.loader.create_tables()
+        self.cursor.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-09-05',0,'AA',111111,3,3),
+                ('2016-09-06',0,'AA',111111,4,4)
+            """))
+        for date, sketch in [('2016-09-05', day1), ('2016-09-06', day2)]:
+            for reg, rank in sketch.registers.items():
+                self.cursor.execute(
+                    "INSERT INTO fact_count_sketch VALUES (%s, 0, 'AA', 111111, %s, %s)",
+                    (date, reg, rank))
+        self.cursor.connection.commit()
+
+        self.loader.sketches = True
+        self.loader.populate_tables()
+
+        self.cursor.execute(dedent("""
+            SELECT count, count_distinct FROM agg_risk_country_week
+            WHERE date = '2016-09-05' AND risk = 0 AND country = 'AA'"""))
+        self.assertEqual(self.cursor.fetchone(), (7, 4))
+
+
+    def test_distinct_counts_with_null_country(self):
+        '''
+        Checks if the registers of NULL country facts stay apart from the rollup rows
+        '''
+        # GIVEN 3 IPs in AA and 5 IPs without a country, 2 of them also seen in AA
+        known = Sketch().update(['71.3.0.1', '71.3.0.2', '71.3.0.3'])
+        unknown = Sketch().update(['71.3.0.2', '71.3.0.3', '71.3.0.4', '71.3.0.5', '71.3.0.6'])
+        self.loader.create_tables()
+        self.cursor.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-09-05',0,'AA',111111,3,3),
+                ('2016-09-05',0,NULL,222222,5,5)
+            """))
+        for country, asn, sketch in [('AA', 111111, known), (None, 222222, unknown)]:
+            for reg, rank in sketch.registers.items():
+                self.cursor.execute(
+                    "INSERT INTO fact_count_sketch VALUES ('2016-09-05', 0, %s, %s, %s, %s)",
+                    (country, asn, reg, rank))
+        self.cursor.connection.commit()
+
+        self.loader.sketches = True
+        self.loader.populate_tables()
+
+        # THEN the NULL country row counts its own 5 IPs and the rollup all 6
+        for date in ["date = '2016-09-05'", 'date IS NULL']:
+            self.cursor.execute(dedent("""
+                SELECT risk, count, count_distinct FROM agg_risk_country_week
+                WHERE {} AND country = 'T' ORDER BY 1, 2""").format(date))
+            self.assertEqual(self.cursor.fetchall(), [(0, 5, 5), (0, 8, 6), (100, 5, 5), (100, 8, 6)])
+
+
+    def test_export_static(self):
+        '''
+        Checks if cube series are uploaded once per content and listed in index.json
+        '''
+        self.loader.create_tables()
+        self.loader.connRDS.execute(dedent("""
+            INSERT INTO fact_count
+            VALUES
+                ('2016-09-03',0,'AA',111111,1,30.8),
+                ('2016-11-13',1,'ZZ',999999,4,25.2)
+            """))
+        self.loader.populate_tables()
+        self.loader.config = dict(config, agg_path='s3://test.bucket/agg')
+        self.loader.conns3 = mock.MagicMock()
+        paginate = self.loader.conns3.meta.client.get_paginator.return_value.paginate
+        paginate.return_value = []
+        put_object = self.loader.conns3.meta.client.put_object
+
+        index = self.loader.export_static()
+
+        bodies = dict((c[1]['Key'], c[1]['Body']) for c in put_object.call_args_list)
+        self.assertEqual(json.loads(bodies['agg/static/index.json'].decode()), index)
+        document = json.loads(gzip.GzipFile(
+            fileobj=BytesIO(bodies['agg/static/' + index['month/country/AA']])).read().decode())
+        self.assertEqual(document['series']['0'], [['2016-09-01', 1, 30.8, None]])
+        self.assertEqual(document['series']['100'], [['2016-09-01', 1, 30.8, None]])
+        self.assertIn('year/risk/1', index)
+
+        # THEN a second run with nothing changed only uploads the index
+        paginate.return_value = [{'Contents': [{'Key': key, 'Size': 1} for key in bodies]}]
+        put_object.reset_mock()
+        self.assertEqual(self.loader.export_static(), index)
+        self.assertEqual(put_object.call_count, 1)
+
+        # THEN a document dropped from the index is kept for the grace period
+        stale = 'agg/static/month/country/XX.0123456789abcdef.json.gz'
+        listed = list(bodies) + [stale]
+        paginate.return_value = [{'Contents': [{'Key': key, 'Size': 1} for key in listed]}]
+        delete_objects = self.loader.conns3.meta.client.delete_objects
+        delete_objects.return_value = {}
+        self.loader.export_static()
+        self.assertFalse(delete_objects.called)
+        retired = json.loads(put_object.call_args_list[-1][1]['Body'].decode())
+        self.assertEqual(list(retired), ['month/country/XX.0123456789abcdef.json.gz'])
+
+        # AND deleted once it has passed
+        self.loader.conns3.meta.client.get_object.return_value = {
+            'Body': BytesIO(json.dumps(dict((k, v - 3600) for k, v in retired.items())).encode())}
+        paginate.return_value = [{'Contents': [
+            {'Key': key, 'Size': 1} for key in listed + ['agg/static/retired.json']]}]
+        self.loader.config['static_export_grace'] = 60
+        self.loader.export_static()
+        delete_objects.assert_called_once_with(Bucket='test.bucket', Delete={
+            'Objects': [{'Key': stale}], 'Quiet': True})
+
+        # AND the export runs on the published cubes
+        loader = LoadToRDS(dict(config, static_export=True, blue_green=True))
+        names = [name for name, _ in loader.stages()]
+        self.assertEqual(names[-3:], ['publish', 'export_static', 'cleanup'])
+        shutil.rmtree(loader.tmpdir)
+
     def tearDown(self):
+        self.conn.close()
         self.loader.drop_tables(self.tablenames)
 
 
@@ -525,3 +1284,147 @@ class MetadataTestCase(unittest.TestCase):
             ]}
         manifest = self.aggregator.create_manifest(datapackage, 's3://test.bucket/test/key')
         self.assertEquals(manifest,expected_manifest)
+
+
+    def test_create_manifest_skips_ingested(self):
+        '''
+        Checks if already ingested files are left out of the manifest
+        '''
+        datapackage = dedent('''{"resources":[
+        {"path": ["ntp-scan/ntp-scan.20000101.csv.gz", "ntp-scan/ntp-scan.20000102.csv.gz"],
+        "schema": {"fields": []}, "name": "openntp", "compression": "gz", "format": "csv"}],
+        "name": "cybergreen_enriched_data"}''')
+        skip = set(['s3://test.bucket/test/key/ntp-scan/ntp-scan.20000101.csv.gz'])
+        manifest = self.aggregator.create_manifest(datapackage, 's3://test.bucket/test/key', skip)
+        self.assertEqual(manifest, {'entries': [
+            {'url': u's3://test.bucket/test/key/ntp-scan/ntp-scan.20000102.csv.gz',
+             'mandatory': True}
+            ]})
+
+
+    def test_content_lengths(self):
+        '''
+        Checks if entry sizes come from listing their directories, and missing
+        files fail before the COPY
+        '''
+        self.aggregator.conns3 = mock.MagicMock()
+        paginate = self.aggregator.conns3.meta.client.get_paginator.return_value.paginate
+        paginate.return_value = [{'Contents': [
+            {'Key': 'test/key/ntp-scan/ntp-scan.20000101.csv.gz', 'Size': 100},
+            {'Key': 'test/key/ntp-scan/ntp-scan.20000102.csv.gz', 'Size': 50}]}]
+        entries = [
+            {'url': 's3://test.bucket/test/key/ntp-scan/ntp-scan.20000101.csv.gz', 'mandatory': True},
+            {'url': 's3://test.bucket/test/key/ntp-scan/ntp-scan.20000102.csv.gz', 'mandatory': True}]
+        self.aggregator.add_content_lengths(entries)
+        paginate.assert_called_once_with(Bucket='test.bucket', Prefix='test/key/ntp-scan/')
+        self.assertEqual([e['meta']['content_length'] for e in entries], [100, 50])
+
+        entries.append({'url': 's3://test.bucket/test/key/ntp-scan/gone.csv.gz', 'mandatory': True})
+        self.assertRaises(ValueError, self.aggregator.add_content_lengths, entries)
+
+
+    def test_shard_manifest(self):
+        '''
+        Checks if shards are balanced by size
+        '''
+        entries = [{'url': str(size), 'meta': {'content_length': size}}
+                   for size in [10, 70, 20, 30, 40, 50]]
+        shards = shard_manifest(entries, 3)
+        self.assertEqual(
+            [sum(e['meta']['content_length'] for e in shard['entries']) for shard in shards],
+            [80, 70, 70])
+        self.assertEqual(len(shard_manifest(entries[:2], 3)), 2)
+
+
+class IndexSpecTestCase(unittest.TestCase):
+
+    def test_redundant_indexes(self):
+        '''
+        Checks if indexes leading another index of their table are pruned
+        '''
+        self.assertEqual(redundant_indexes(expand_spec(INDEX_SPEC)), set([
+            'idx_date', 'idx_date_country', 'idx_date_cube_week', 'idx_date_cube_month',
+            'idx_date_cube_quarter', 'idx_date_cube_year']))
+
+
+    def test_reversed_prefix_is_redundant(self):
+        spec = [('t', 'a', 'x DESC'), ('t', 'b', 'x, y'), ('u', 'c', 'x')]
+        self.assertEqual(redundant_indexes(spec), set(['a']))
+
+
+class LocalFilesTestCase(unittest.TestCase):
+    # Stages run on local files, without Redshift
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = LocalStorage({}, RunMetrics())
+
+
+    def path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+
+    def test_merge_unloaded_parts(self):
+        '''
+        Checks if a parallel unload still leaves a single count.csv
+        '''
+        agg = 'file://' + self.path('agg')
+        aggregator = Aggregator(dict(config, engine='local', source_path=agg, dest_path=agg,
+                                     agg_path=agg, parallel_unload=True))
+        parts = ['count_part_0000_part_00', 'count_part_0001_part_00']
+        self.storage.put('', self.path('agg', parts[0]), b'2016-09-03 00:00:00,0,AA,111111,1,30.8\n')
+        self.storage.put('', self.path('agg', parts[1]), b'2016-11-13 00:00:00,0,ZZ,999999,33,1353\n')
+        self.storage.put('', self.path('agg', 'count_part_manifest'), json.dumps({'entries': [
+            {'url': 'file://' + self.path('agg', name)} for name in parts]}).encode())
+        aggregator.merge_parts('count')
+        self.assertEqual(self.storage.read('', self.path('agg', 'count.csv')), dedent('''\
+            2016-09-03 00:00:00,0,AA,111111,1,30.8
+            2016-11-13 00:00:00,0,ZZ,999999,33,1353
+            ''').encode())
+
+
+    def test_feeds_run_concurrently(self):
+        '''
+        Checks if feeds in their own namespaces run side by side and a failed
+        feed does not stop the others
+        '''
+        local = dict(config, engine='local', metrics_path=None, metrics_textfile=None)
+        feeds = []
+        for namespace, rows in [('feed_a', 300), ('feed_b', 500)]:
+            source = self.path(namespace, 'source')
+            os.makedirs(source)
+            names = generate(source, rows=rows, files=2, days=2, ips=50, asns=5, countries=3,
+                             risks=(0,))
+            with open(os.path.join(source, 'datapackage.json'), 'w') as f:
+                json.dump({'resources': [{'name': 'scan', 'path': names}]}, f)
+            feeds.append({
+                'namespace': namespace, 'source_path': 'file://' + source,
+                'dest_path': 'file://' + source,
+                'agg_path': 'file://' + self.path(namespace, 'agg'),
+                'checkpoint_path': self.path(namespace, 'checkpoint.json')})
+        self.assertRaises(ValueError, feed_configs, local, [{'namespace': 'feed_a'}, {}])
+        self.assertRaises(ValueError, feed_configs, local, [
+            dict(feeds[0], namespace='feed_c'), dict(feeds[1], agg_path=feeds[0]['agg_path'])])
+        self.assertRaises(ValueError, feed_configs, dict(local, metrics_path='metrics.json'), feeds)
+        configs = feed_configs(local, feeds)
+        loaders = [LoadToRDS(feed_config) for feed_config in configs]
+        try:
+            run_feeds(configs, workers=2)
+            for loader in loaders:
+                with open(self.path(loader.namespace, 'agg', 'count.csv')) as f:
+                    rows = len(f.readlines())
+                self.assertEqual(loader.connRDS.execute(
+                    'SELECT count(*) FROM {}.fact_count'.format(loader.namespace)).scalar(), rows)
+
+            configs[1]['dest_path'] = 'file://' + self.path('missing')
+            with self.assertRaises(RuntimeError) as failed:
+                run_feeds(configs, workers=2)
+            self.assertIn('feed_b', str(failed.exception))
+            self.assertNotIn('feed_a', str(failed.exception))
+        finally:
+            for loader in loaders:
+                loader.connRDS.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(loader.namespace))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from aggregator.benchmarks import harness
+from aggregator.benchmarks.generate import generate
+from aggregator.local_engine import iter_log_rows
+
+config = json.loads(open('tests/config.test.json').read())
+
+
+class GeneratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def read(self, names):
+        rows = []
+        for name in names:
+            with open(os.path.join(self.tmpdir, name), 'rb') as f:
+                rows.extend(iter_log_rows(f))
+        return rows
+
+
+    def test_deterministic(self):
+        '''
+        Checks if the same arguments produce the same rows
+        '''
+        first = self.read(generate(self.tmpdir, rows=500, files=2, seed=3))
+        second = self.read(generate(self.tmpdir, rows=500, files=2, seed=3))
+        self.assertEqual(len(first), 500)
+        self.assertEqual(first, second)
+
+
+    def test_ip_belongs_to_one_asn_and_country(self):
+        rows = self.read(generate(self.tmpdir, rows=2000, ips=100, asns=20, countries=5))
+        owners = {}
+        for date, ip, risk, asn, country in rows:
+            owners.setdefault(ip, set()).add((asn, country))
+        self.assertTrue(all(len(owner) == 1 for owner in owners.values()))
+
+
+    def test_skewed(self):
+        '''
+        Checks if a few IPs account for most rows
+        '''
+        rows = self.read(generate(self.tmpdir, rows=5000, ips=1000))
+        hits = {}
+        for row in rows:
+            hits[row[1]] = hits.get(row[1], 0) + 1
+        top = sorted(hits.values(), reverse=True)[:10]
+        self.assertGreater(sum(top), 5000 * 0.2)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class HarnessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def test_run_records_every_stage(self):
+        '''
+        Checks if a small benchmark runs end to end and is appended to the results
+        '''
+        results = os.path.join(self.tmpdir, 'results.jsonl')
+        params = {'rows': 2000, 'files': 2, 'days': 3, 'ips': 300, 'asns': 30,
+                  'countries': 5, 'skew': 1.1, 'seed': 0}
+        bench_config = dict(config, distinct_sketches=True)
+        result, previous = harness.run(bench_config, params, results, self.tmpdir)
+        self.assertEqual(previous, None)
+        stages = dict((s['name'], s) for s in result['stages'])
+        self.assertEqual(stages['aggregate.load_data']['rows'], 2000)
+        self.assertIn('load.create_indexes', stages)
+        self.assertIn('aggregate.build_sketches', stages)
+        result, previous = harness.run(bench_config, params, results, self.tmpdir)
+        self.assertEqual(previous['params'], result['params'])
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from aggregator.checkpoint import CheckpointStore, run_stages
+from aggregator.main import Aggregator
+from aggregator.metrics import RunMetrics
+from aggregator.storage import LocalStorage
+
+config = json.loads(open('tests/config.test.json').read())
+
+
+class CheckpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'checkpoint.json')
+        self.calls = []
+
+
+    def pipelines(self, fail_at=None, inputs=None):
+        def stage(name):
+            def func():
+                if name == fail_at:
+                    raise RuntimeError(name)
+                self.calls.append(name)
+            return name, func
+        return [
+            ('aggregate', inputs or {'agg_path': 's3://bucket/agg'},
+             [stage('load_data'), stage('unload')]),
+            ('load', {}, [stage('download_and_load'), stage('create_indexes')]),
+        ]
+
+
+    def test_resume_skips_completed_stages(self):
+        '''
+        Checks if a resumed run starts at the stage that failed
+        '''
+        with self.assertRaises(RuntimeError):
+            run_stages(self.pipelines(fail_at='create_indexes'), CheckpointStore(self.path))
+        self.calls = []
+        run_stages(self.pipelines(), CheckpointStore(self.path), resume=True)
+        self.assertEqual(self.calls, ['create_indexes'])
+
+
+    def test_resume_reruns_when_inputs_change(self):
+        '''
+        Checks if stages run again when the inputs they were recorded with changed
+        '''
+        run_stages(self.pipelines(), CheckpointStore(self.path))
+        self.calls = []
+        run_stages(self.pipelines(inputs={'agg_path': 's3://bucket/other'}),
+                   CheckpointStore(self.path), resume=True)
+        self.assertEqual(self.calls, ['load_data', 'unload', 'download_and_load', 'create_indexes'])
+
+
+    def test_from_stage(self):
+        '''
+        Checks if stages before --from-stage are skipped
+        '''
+        run_stages(self.pipelines(), CheckpointStore(self.path), from_stage='load.download_and_load')
+        self.assertEqual(self.calls, ['download_and_load', 'create_indexes'])
+        self.assertRaises(ValueError, run_stages, self.pipelines(),
+                          CheckpointStore(self.path), from_stage='load.nope')
+
+
+    def test_fresh_run_clears_checkpoints(self):
+        run_stages(self.pipelines(), CheckpointStore(self.path))
+        self.calls = []
+        run_stages(self.pipelines(), CheckpointStore(self.path))
+        self.assertEqual(len(self.calls), 4)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class CheckpointInputsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = LocalStorage({}, RunMetrics())
+
+
+    def path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+
+    def test_checkpoint_inputs_follow_datapackage(self):
+        '''
+        Checks if new files listed in datapackage.json change the aggregate
+        checkpoint inputs, so --resume does not skip them
+        '''
+        source = 'file://' + self.path('source')
+        local = dict(config, engine='local', source_path=source, dest_path=source,
+                     agg_path='file://' + self.path('agg'))
+        aggregator = Aggregator(local)
+        self.storage.put('', self.path('source', 'datapackage.json'), json.dumps(
+            {'resources': [{'name': 'scan', 'path': ['a.csv']}]}).encode())
+        before = aggregator.checkpoint_inputs()
+        self.assertEqual(before['dest_path'], source)
+        self.storage.put('', self.path('source', 'datapackage.json'), json.dumps(
+            {'resources': [{'name': 'scan', 'path': ['a.csv', 'b.csv']}]}).encode())
+        self.assertNotEqual(aggregator.checkpoint_inputs(), before)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
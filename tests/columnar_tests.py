@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from textwrap import dedent
+
+from aggregator import columnar
+from aggregator.main import Aggregator
+from aggregator.metrics import RunMetrics
+from aggregator.storage import LocalStorage
+
+config = json.loads(open('tests/config.test.json').read())
+
+
+@unittest.skipIf(columnar.pyarrow is None, 'pyarrow is not installed')
+class ParquetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv = os.path.join(self.tmpdir, 'count.csv')
+        with open(self.csv, 'w') as f:
+            f.write(dedent('''\
+                2016-09-03 00:00:00,0,AA,111111,1,30.8
+                2016-09-04 00:00:00,1,,222222,5,3
+                2016-09-04 00:00:00,0,ZZ,999999,33,1353
+                '''))
+        self.storage = LocalStorage({}, RunMetrics())
+
+
+    def path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+
+    def test_partitioned_by_day(self):
+        '''
+        Checks if every day is written to its own typed partition
+        '''
+        import pyarrow.dataset
+        directory = os.path.join(self.tmpdir, 'parquet')
+        # small blocks, the CSV is converted in more than one batch
+        paths = columnar.write_count_parquet(self.csv, directory, block_size=64)
+        self.assertEqual(
+            sorted(os.path.basename(os.path.dirname(path)) for path in set(paths)),
+            ['date=2016-09-03', 'date=2016-09-04'])
+
+        dataset = pyarrow.dataset.dataset(
+            directory, schema=columnar.schema(), partitioning='hive')
+        self.assertEqual(dataset.schema, columnar.schema())
+        rows = dataset.to_table(
+            filter=pyarrow.dataset.field('risk') == 1).to_pylist()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['country'], None)
+        self.assertEqual(rows[0]['asn'], 222222)
+        self.assertEqual(str(rows[0]['date']), '2016-09-04')
+
+
+    def test_upload_parquet_replaces_partitions(self):
+        '''
+        Checks if Parquet partitions of days no longer counted are deleted
+        '''
+        agg = 'file://' + self.path('agg')
+        aggregator = Aggregator(dict(config, engine='local', source_path=agg, dest_path=agg,
+                                     agg_path=agg, parquet_output=True))
+        stale = self.path('agg', 'parquet', 'count', 'date=2016-01-01', 'part-0.parquet')
+        self.storage.put('', stale, b'old')
+        aggregator.upload_parquet(self.csv)
+        self.assertEqual(
+            sorted(os.path.relpath(key, self.path('agg', 'parquet', 'count'))
+                   for _, key in self.storage.list_sizes([('', self.path('agg', 'parquet', ''))])),
+            ['date=2016-09-03/part-0.parquet', 'date=2016-09-04/part-0.parquet'])
+        shutil.rmtree(aggregator.tmpdir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
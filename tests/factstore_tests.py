@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import datetime
+import sys
+
+from io import StringIO
+from textwrap import dedent
+
+from aggregator.factstore import FactStore, truncate
+
+COUNT_CSV = dedent('''\
+    2016-09-03 00:00:00,0,AA,111111,1,30.8
+    2016-09-04 00:00:00,0,AA,222222,5,3
+    2016-09-04 00:00:00,1,ZZ,999999,33,1353
+    2016-11-13 00:00:00,0,ZZ,999999,4,25.2
+    2016-11-13 00:00:00,0,,999999,2,1
+    2014-10-03 00:00:00,,AA,111111,2,1113.8
+    ''')
+
+
+class FactStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FactStore.from_csv(StringIO(COUNT_CSV))
+
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.store), 6)
+        self.assertEqual(self.store.row(4), (datetime.date(2016, 11, 13), 0, None, 999999, 2, 1.0))
+        self.assertEqual(self.store.row(5)[1], None)
+        self.assertEqual(len(self.store.country_values), 3)
+
+
+    def test_truncate(self):
+        day = datetime.date(2016, 9, 4).toordinal()
+        self.assertEqual(datetime.date.fromordinal(truncate(day, 'week')), datetime.date(2016, 8, 29))
+        self.assertEqual(datetime.date.fromordinal(truncate(day, 'quarter')), datetime.date(2016, 7, 1))
+
+
+    def test_select_and_group_by(self):
+        selection = self.store.select(
+            date_from=datetime.date(2016, 1, 1), country=['AA', 'ZZ'])
+        self.assertEqual(list(selection), [0, 1, 2, 3])
+        self.assertEqual(self.store.group_by(['country', 'risk'], selection=selection), {
+            ('AA', 0): (6, 33.8), ('ZZ', 1): (33, 1353.0), ('ZZ', 0): (4, 25.2)})
+        self.assertEqual(
+            self.store.group_by(['date'], time='month', selection=self.store.select(asn=999999)),
+            {(datetime.date(2016, 9, 1),): (33, 1353.0), (datetime.date(2016, 11, 1),): (6, 26.2)})
+
+
+    def test_cube(self):
+        '''
+        Checks rollup rows and fact rows with NULL keys are kept apart
+        '''
+        rows = self.store.cube('year')
+        totals = [row for row in rows if row[0] is None and row[1] == 100 and row[2] == 'T']
+        # the all-time total and the fact row with both a NULL risk and country rollup
+        self.assertIn((None, 100, 'T', 47, 2526.8), [r[:4] + (round(r[4], 6),) for r in totals])
+        aa_2014 = [row for row in rows if row[0] == datetime.date(2014, 1, 1) and row[2] == 'AA']
+        # the NULL risk fact row, and the rollup of risk, both shown as risk 100
+        self.assertEqual([row[1:4] for row in aa_2014], [(100, 'AA', 2), (100, 'AA', 2)])
+
+
+    def test_memory(self):
+        '''
+        Checks the columns take an order of magnitude less than row tuples
+        '''
+        store = FactStore()
+        day = datetime.date(2016, 9, 3)
+        rows = [(day, i % 6, 'AA', 100000 + i % 1000, i, i * 1.5) for i in range(10000)]
+        store.extend(rows)
+        tuples = sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in rows)
+        self.assertLess(store.memory_bytes() * 10, tuples)
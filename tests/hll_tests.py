@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+
+from aggregator.hll import Sketch, register
+
+
+class SketchTestCase(unittest.TestCase):
+
+    def test_small_cardinality_exact(self):
+        '''
+        Checks if a handful of distinct values is counted exactly
+        '''
+        sketch = Sketch().update(['71.3.0.1', '71.3.0.2', '71.3.0.1', '190.81.134.82'])
+        self.assertEqual(sketch.cardinality(), 3)
+
+
+    def test_large_cardinality_within_error(self):
+        '''
+        Checks if the estimate stays within a few standard errors
+        '''
+        ips = ['10.{}.{}.{}'.format(i // 65536, (i // 256) % 256, i % 256)
+               for i in range(50000)]
+        estimate = Sketch().update(ips).cardinality()
+        self.assertLess(abs(estimate - 50000) / 50000.0, 0.05)
+
+
+    def test_merge_counts_union(self):
+        '''
+        Checks if merged sketches count values seen in both only once
+        '''
+        day1 = Sketch().update('192.168.0.{}'.format(i) for i in range(200))
+        day2 = Sketch().update('192.168.0.{}'.format(i) for i in range(100, 250))
+        union = Sketch().update('192.168.0.{}'.format(i) for i in range(250))
+        self.assertEqual(day1.merge(day2).registers, union.registers)
+
+
+    def test_register_range(self):
+        '''
+        Checks if registers stay within the sketch size
+        '''
+        for i in range(1000):
+            index, rank = register(str(i), 6)
+            self.assertTrue(0 <= index < 64)
+            self.assertTrue(1 <= rank <= 53)
+
+
+    def test_merge_different_precision(self):
+        self.assertRaises(ValueError, Sketch(10).merge, Sketch(12))
@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import gzip
+
+from io import BytesIO, StringIO
+from textwrap import dedent
+
+from aggregator.local_engine import LocalAggregator
+from aggregator.hll import Sketch
+
+
+def gzipped(text):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(text.encode('utf-8'))
+    buf.seek(0)
+    return buf
+
+
+class LocalAggregatorTestCase(unittest.TestCase):
+    # Same cases as the Redshift aggregation tests, run in-process.
+
+    def setUp(self):
+        self.aggregator = LocalAggregator(
+            amplification={1: 41, 2: 556.9, 4: 6.3, 5: 30.8})
+
+
+    def tearDown(self):
+        self.aggregator.close()
+
+
+    def test_group_by_day(self):
+        '''
+        Checks if entries with same dates are grouped and summed up
+        '''
+        self.aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-20T00:00:01+00:00,71.3.0.1,2,12252,US
+        2016-09-20T00:00:01+00:00,190.81.134.82,2,12252,US
+        2016-09-29T00:00:01+00:00,190.81.135.11,2,12252,US
+        ''')))
+        self.assertEqual(
+            sorted(self.aggregator.counts()),
+            [
+                ('2016-09-20 00:00:00', '2', 'US', '12252', 2, 556.9*2),
+                ('2016-09-29 00:00:00', '2', 'US', '12252', 1, 556.9)
+            ])
+
+
+    def test_group_by_distinct_ip(self):
+        '''
+        Checks if entries with same IP within same risk and date are ignored
+        '''
+        self.aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-20T00:00:01+00:00,190.81.135.11,2,12252,US
+        2016-09-20T00:00:01+00:00,190.81.135.11,2,12252,US
+        2016-09-29T00:00:01+00:00,190.81.135.11,2,12252,US
+        ''')))
+        self.assertEqual(
+            [row[4] for row in sorted(self.aggregator.counts())], [1, 1])
+
+
+    def test_unknown_risk_not_amplified(self):
+        '''
+        Checks if risks missing from the reference data keep a zero amplified count
+        '''
+        self.aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-29T00:00:01+00:00,71.3.0.1,0,12252,US
+        ''')))
+        self.assertEqual(
+            list(self.aggregator.counts()),
+            [('2016-09-29 00:00:00', '0', 'US', '12252', 1, 0.0)])
+
+
+    def test_null_factor_not_amplified(self):
+        '''
+        Checks if risks with a NULL amplification factor get a NULL amplified count
+        '''
+        self.aggregator.amplification[3] = None
+        self.aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-29T00:00:01+00:00,71.3.0.1,3,12252,US
+        ''')))
+        self.assertEqual(
+            list(self.aggregator.counts()),
+            [('2016-09-29 00:00:00', '3', 'US', '12252', 1, None)])
+
+
+    def test_threshold(self):
+        '''
+        Checks if groups with count not above the threshold are left out
+        '''
+        self.aggregator.threshold = 1
+        self.aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-29T00:00:01+00:00,190.81.134.82,2,12252,US
+        2016-09-29T00:00:01+00:00,190.81.134.11,2,12252,US
+        2016-09-29T00:00:01+00:00,190.81.134.34,2,3333,DE
+        ''')))
+        self.assertEqual(
+            [row[2] for row in self.aggregator.counts()], ['US'])
+
+
+    def test_spill_to_disk(self):
+        '''
+        Checks if results are the same when distinct keys exceed the memory budget
+        '''
+        scan_csv = dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-29T00:00:01+00:00,190.81.134.82,2,12252,US
+        2016-09-29T00:00:01+00:00,190.81.134.82,2,122,US
+        2016-09-29T00:00:01+00:00,190.81.134.83,2,1225,DE
+        2016-09-29T00:00:01+00:00,190.81.134.84,2,1225,DE
+        2016-09-28T00:00:01+00:00,190.81.134.82,1,12252,US
+        2016-09-28T00:00:01+00:00,190.81.134.82,1,12252,US
+        2016-09-29T00:00:01+00:00,190.81.134.83,2,1225,DE
+        ''')
+        spilling = LocalAggregator(
+            amplification=self.aggregator.amplification, max_keys=2, partitions=3)
+        spilling.add_file(gzipped(scan_csv))
+        self.aggregator.add_file(gzipped(scan_csv))
+        self.assertEqual(
+            sorted(spilling.counts()), sorted(self.aggregator.counts()))
+        spilling.close()
+
+
+    def test_split_large_partitions(self):
+        '''
+        Checks if spilled partitions above the memory budget are split before reading
+        '''
+        rows = [('2016-09-29T00:00:01+00:00', '10.0.{}.{}'.format(i, j), '2', str(asn), 'US')
+                for asn in range(8) for i in range(2) for j in range(3)]
+        spilling = LocalAggregator(
+            amplification=self.aggregator.amplification, max_keys=10, partitions=2,
+            max_depth=16)
+        spilling.add_rows(rows)
+        self.aggregator.add_rows(rows)
+        loaded = []
+        for groups in spilling.iter_partitions():
+            loaded.append(sum(len(ips) for ips in groups.values()))
+        self.assertTrue(max(loaded) <= 10)
+        self.assertEqual(sum(loaded), 48)
+        spilling.close()
+
+        spilling = LocalAggregator(
+            amplification=self.aggregator.amplification, max_keys=10, partitions=2)
+        spilling.add_rows(rows)
+        self.assertEqual(
+            sorted(spilling.counts()), sorted(self.aggregator.counts()))
+        spilling.close()
+
+
+    def test_write_csv(self):
+        '''
+        Checks if counts are written like the unloaded count table
+        '''
+        self.aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-28T00:00:01+00:00,71.3.0.1,1,4444,US
+        ''')))
+        out = StringIO()
+        self.assertEqual(self.aggregator.write_csv(out), 1)
+        self.assertEqual(out.getvalue(), '2016-09-28 00:00:00,1,US,4444,1,41\n')
+
+
+    def test_write_sketches(self):
+        '''
+        Checks if sketch registers are written for every count row
+        '''
+        aggregator = LocalAggregator(sketch_precision=12)
+        aggregator.add_file(gzipped(dedent('''\
+        ts,ip,risk_id,asn,cc
+        2016-09-28T00:00:01+00:00,71.3.0.1,1,4444,US
+        2016-09-28T00:00:01+00:00,71.3.0.2,1,4444,US
+        ''')))
+        out, sketches = StringIO(), StringIO()
+        aggregator.write_csv(out, sketches)
+        aggregator.close()
+        registers = dict(
+            (int(line.split(',')[4]), int(line.split(',')[5]))
+            for line in sketches.getvalue().splitlines())
+        self.assertEqual(registers, Sketch().update(['71.3.0.1', '71.3.0.2']).registers)
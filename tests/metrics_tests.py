@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from aggregator.metrics import RunMetrics
+
+
+class RunMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metrics = RunMetrics()
+
+
+    def test_counters_per_stage(self):
+        '''
+        Checks if counters go to the running stage only
+        '''
+        with self.metrics.stage('load.download_and_load'):
+            self.metrics.add('rows', 5)
+            self.metrics.add('rows', -1)
+            self.metrics.add('s3_bytes_read', 1024)
+        self.metrics.add('rows', 7)
+        stage = self.metrics.report()['stages'][0]
+        self.assertEqual((stage['status'], stage['rows'], stage['s3_bytes_read']), ('ok', 5, 1024))
+
+
+    def test_failed_stage_reported(self):
+        '''
+        Checks if a failing stage is recorded before the error propagates
+        '''
+        failing = self.metrics.timed('load.create_indexes', lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, failing)
+        self.assertEqual(self.metrics.report()['stages'][0]['status'], 'failed')
+        self.assertIn('cybergreen_stage_success{stage="load.create_indexes"} 0',
+                      self.metrics.prometheus())
+
+
+    def test_operation_latency(self):
+        self.metrics.observe('s3.get', 0.5)
+        self.metrics.observe('s3.get', 1.5)
+        self.assertEqual(self.metrics.report()['operations']['s3.get'],
+                         {'count': 2, 'seconds': 2.0, 'max_seconds': 1.5})
+        self.assertIn('cybergreen_operation_max_seconds{operation="s3.get"} 1.5',
+                      self.metrics.prometheus())
+
+
+    def test_write_report(self):
+        '''
+        Checks if the JSON report and the Prometheus textfile are written
+        '''
+        with self.metrics.stage('aggregate.count_data'):
+            self.metrics.add('rows', 42)
+        json_path = os.path.join(self.tmpdir, 'report.json')
+        textfile = os.path.join(self.tmpdir, 'aggregator.prom')
+        self.metrics.write(json_path, textfile)
+        with open(json_path) as f:
+            self.assertEqual(json.load(f)['stages'][0]['rows'], 42)
+        with open(textfile) as f:
+            self.assertIn('cybergreen_stage_rows{stage="aggregate.count_data"} 42\n', f.read())
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
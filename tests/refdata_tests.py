@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import tempfile
+import shutil
+import mock
+
+from aggregator import refdata
+
+
+class RefdataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.url = 'tests/fixtures/asn-datapackage.json'
+        self.resource = refdata.read_descriptor(self.url)['resources'][0]
+
+
+    def test_table_name(self):
+        '''
+        Checks if tables are named like push_datapackage named them
+        '''
+        self.assertEqual(refdata.table_name(self.resource), 'data__asn___asn')
+
+
+    def test_create_table_from_schema(self):
+        '''
+        Checks if column types follow the Table Schema unless overridden
+        '''
+        self.assertEqual(
+            refdata.create_table_sql('data__asn___asn', self.resource['schema']),
+            'CREATE TABLE data__asn___asn(number FLOAT, title TEXT, country TEXT)')
+        self.assertEqual(
+            refdata.create_table_sql('data__asn___asn', self.resource['schema'],
+                                     {'number': 'BIGINT'}),
+            'CREATE TABLE data__asn___asn(number BIGINT, title TEXT, country TEXT)')
+
+
+    def test_resource_paths(self):
+        '''
+        Checks if resource paths are resolved against the descriptor location
+        '''
+        self.assertEqual(
+            refdata.resource_paths(self.url, self.resource),
+            ['tests/fixtures/data/asn.csv'])
+        self.assertEqual(
+            refdata.resource_paths('https://example.com/refdata-asn/master/datapackage.json',
+                                   self.resource),
+            ['https://example.com/refdata-asn/master/data/asn.csv'])
+
+
+    def test_iter_rows(self):
+        '''
+        Checks if rows are read as dicts with empty values as None
+        '''
+        with refdata.open_resource('tests/fixtures/data/asn.csv') as stream:
+            rows = list(refdata.iter_rows(stream))
+        self.assertEqual(rows[0], {'number': '111111', 'title': 'Test title', 'country': 'AA'})
+
+
+
+    def test_iter_rows_typed(self):
+        '''
+        Checks if rows are cast to the types of their Table Schema fields
+        '''
+        url = 'tests/fixtures/risk-datapackage.json'
+        resource = refdata.read_descriptor(url)['resources'][0]
+        with refdata.open_resource(refdata.resource_paths(url, resource)[0]) as stream:
+            row = next(refdata.iter_rows(stream, resource['schema']))
+        self.assertEqual(
+            (row['id'], row['is_archived'], row['amplification_factor'], row['slug']),
+            (0.0, False, 0.13456, 'test-risk'))
+
+class RefDataCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = 'https://example.com/refdata-risk/master/data/risk.csv'
+
+
+    def response(self, status, body=b'', headers=None):
+        r = mock.Mock(status_code=status, headers=headers or {})
+        r.iter_content.return_value = [body]
+        return r
+
+
+    def test_revalidates_with_etag(self):
+        '''
+        Checks if a cached url is revalidated and served from disk on 304
+        '''
+        with mock.patch('requests.get') as get:
+            get.return_value = self.response(200, b'id,slug\n0,test\n', {'ETag': '"v1"'})
+            path = refdata.RefDataCache(self.cache_dir).fetch(self.url)
+            # a new process reads the index back from disk
+            get.return_value = self.response(304)
+            cache = refdata.RefDataCache(self.cache_dir)
+            self.assertEqual(cache.fetch(self.url), path)
+            self.assertEqual(get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+            # revalidated once per process
+            cache.fetch(self.url)
+            self.assertEqual(get.call_count, 2)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'id,slug\n0,test\n')
+
+
+    def test_fingerprint_follows_content(self):
+        '''
+        Checks if a datapackage fingerprint covers its data files
+        '''
+        cache = refdata.RefDataCache(self.cache_dir)
+        url = 'tests/fixtures/asn-datapackage.json'
+        self.assertEqual(refdata.fingerprint(url, cache), refdata.fingerprint(url, cache))
+        self.assertNotEqual(refdata.fingerprint(url, cache),
+                            refdata.fingerprint('tests/fixtures/risk-datapackage.json', cache))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
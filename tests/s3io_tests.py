@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import io
+import unittest
+
+import mock
+
+from aggregator.metrics import RunMetrics
+from aggregator.s3io import S3IO, MB
+
+
+class S3IOTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RunMetrics()
+        self.resource = mock.MagicMock()
+        self.client = self.resource.meta.client
+        self.client.delete_objects.return_value = {}
+        self.s3 = S3IO({'s3_workers': 4, 's3_multipart_chunksize_mb': 8}, self.metrics, self.resource)
+
+
+    def test_put_from_memory(self):
+        '''
+        Checks if small objects are uploaded without a temp file and timed
+        '''
+        with self.metrics.stage('aggregate.upload_manifest') as stage:
+            self.s3.put('bucket', 'clean.manifest', b'{"entries": []}')
+        self.client.put_object.assert_called_once_with(
+            Bucket='bucket', Key='clean.manifest', Body=b'{"entries": []}')
+        self.assertEqual(stage['s3_bytes_written'], 15)
+        self.assertEqual(self.metrics.operations['s3.put']['count'], 1)
+
+
+    def test_delete_in_batches(self):
+        self.s3.delete_many('bucket', ['key{}'.format(i) for i in range(2500)])
+        self.assertEqual(
+            [len(c[1]['Delete']['Objects']) for c in self.client.delete_objects.call_args_list],
+            [1000, 1000, 500])
+        self.client.delete_objects.return_value = {'Errors': [{'Key': 'key1'}]}
+        self.assertRaises(IOError, self.s3.delete_many, 'bucket', ['key1'])
+
+
+    def test_copy_many(self):
+        '''
+        Checks if batch copies run with the tuned transfer settings
+        '''
+        self.s3.copy_many([('bucket', 'count000', 'bucket', 'count.csv'),
+                           ('bucket', 'sketch000', 'bucket', 'sketch.csv')])
+        self.assertEqual(self.client.copy.call_count, 2)
+        config = self.client.copy.call_args[1]['Config']
+        self.assertEqual(config.multipart_chunksize, 8 * 1024 * 1024)
+        self.assertEqual(self.metrics.operations['s3.copy']['count'], 2)
+
+
+    def test_concat_copies_large_parts(self):
+        '''
+        Checks if parts are concatenated server side and only small ones downloaded
+        '''
+        parts = [('bucket', 'count_part_00', 1 * MB), ('bucket', 'count_part_01', 12 * MB),
+                 ('bucket', 'count_part_02', 2 * MB)]
+        self.assertEqual(self.s3.concat_segments(parts), [
+            ('upload', [('bucket', 'count_part_00', 0, 1 * MB),
+                        ('bucket', 'count_part_01', 0, 4 * MB)]),
+            ('copy', [('bucket', 'count_part_01', 4 * MB, 12 * MB)]),
+            ('upload', [('bucket', 'count_part_02', 0, 2 * MB)])])
+
+        self.client.create_multipart_upload.return_value = {'UploadId': 'id'}
+        self.client.upload_part_copy.return_value = {'CopyPartResult': {'ETag': 'copied'}}
+        self.client.upload_part.return_value = {'ETag': 'uploaded'}
+        self.client.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(b'data')}
+        self.s3.concat(parts, 'bucket', 'count.csv')
+        self.client.upload_part_copy.assert_called_once_with(
+            Bucket='bucket', Key='count.csv', UploadId='id', PartNumber=2,
+            CopySource={'Bucket': 'bucket', 'Key': 'count_part_01'},
+            CopySourceRange='bytes={}-{}'.format(4 * MB, 12 * MB - 1))
+        self.assertEqual(
+            [c[1]['Range'] for c in self.client.get_object.call_args_list],
+            ['bytes=0-{}'.format(1 * MB - 1), 'bytes=0-{}'.format(4 * MB - 1),
+             'bytes=0-{}'.format(2 * MB - 1)])
+        self.assertEqual(
+            self.client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts'],
+            [{'PartNumber': 1, 'ETag': 'uploaded'}, {'PartNumber': 2, 'ETag': 'copied'},
+             {'PartNumber': 3, 'ETag': 'uploaded'}])
@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+# NOTE: Launch all tests with `nosetests` command from git repo root dir.
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from aggregator.benchmarks.generate import generate
+from aggregator.main import Aggregator, LoadToRDS, get_storage
+from aggregator.metrics import RunMetrics
+from aggregator.storage import LocalStorage
+
+config = json.loads(open('tests/config.test.json').read())
+
+
+class LocalStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metrics = RunMetrics()
+        self.storage = LocalStorage({}, self.metrics)
+
+
+    def path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+
+    def test_put_read_list(self):
+        self.storage.put('', self.path('agg', 'count.csv'), b'1,2\n')
+        self.assertEqual(self.storage.read('', self.path('agg', 'count.csv')), b'1,2\n')
+        self.assertEqual(self.storage.list_sizes([('', self.path('agg', ''))]),
+                         {('', self.path('agg', 'count.csv')): 4})
+        self.assertEqual(self.storage.list_sizes([('', self.path('gone', ''))]), {})
+
+
+    def test_move_and_copy_without_copying_data(self):
+        '''
+        Checks if the unload rename is a rename and copies are hard links
+        '''
+        self.storage.put('', self.path('agg', 'count000'), b'1,2\n')
+        inode = os.stat(self.path('agg', 'count000')).st_ino
+        self.storage.move('', self.path('agg', 'count000'), '', self.path('agg', 'count.csv'))
+        self.assertFalse(os.path.exists(self.path('agg', 'count000')))
+        self.storage.copy('', self.path('agg', 'count.csv'), '', self.path('public', 'count.csv'))
+        self.assertEqual(os.stat(self.path('public', 'count.csv')).st_ino, inode)
+        self.storage.delete_many('', [self.path('agg', 'count.csv'), self.path('agg', 'gone')])
+        self.assertEqual(self.metrics.operations['local.move']['count'], 1)
+
+
+    def test_backend_from_paths(self):
+        local = dict(config, source_path='file:///data/src', dest_path='file:///data/src',
+                     agg_path='file:///data/agg')
+        self.assertIsInstance(get_storage(local, self.metrics), LocalStorage)
+        self.assertRaises(ValueError, get_storage,
+                          dict(local, agg_path='s3://bucket/agg'), self.metrics)
+
+
+    def test_local_pipeline(self):
+        '''
+        Checks if the local engine and the RDS load run on file:// paths only
+        '''
+        source = 'file://' + self.path('source')
+        local = dict(config, engine='local', source_path=source, dest_path=source,
+                     agg_path='file://' + self.path('agg'))
+        os.makedirs(self.path('source'))
+        names = generate(self.path('source'), rows=500, files=2, days=2, ips=50, asns=5, countries=3)
+        with open(self.path('source', 'datapackage.json'), 'w') as f:
+            json.dump({'resources': [{'name': 'scan', 'path': names}]}, f)
+
+        Aggregator(local).run()
+        with open(self.path('agg', 'count.csv')) as f:
+            rows = len(f.readlines())
+        self.assertGreater(rows, 0)
+
+        loader = LoadToRDS(local)
+        try:
+            loader.create_tables()
+            loader.download_and_load()
+            self.assertEqual(
+                loader.connRDS.execute('SELECT count(*) FROM fact_count').scalar(), rows)
+        finally:
+            loader.drop_tables(loader.tablenames)
+
+
+    def test_unloaded_file_renamed(self):
+        '''
+        Checks if only the 000 suffix of UNLOAD is replaced, zeros in the path kept
+        '''
+        agg = 'file://' + self.path('agg2020')
+        aggregator = Aggregator(dict(config, source_path=agg, dest_path=agg, agg_path=agg))
+        self.storage.put('', self.path('agg2020', 'count000'), b'1,2\n')
+        aggregator.add_extention('', self.path('agg2020', 'count000'))
+        self.assertEqual(self.storage.read('', self.path('agg2020', 'count.csv')), b'1,2\n')
+        shutil.rmtree(aggregator.tmpdir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)